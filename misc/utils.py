@@ -66,6 +66,35 @@ def defined_relations():
     {"Head Entity": "Microbiome", "Tail Entities": ["Microbiome"], "Predicate": "compared to"}
 ]
 
+#defined_relations names that differ from the entity type tags of the tagged texts (@DDF$, ...)
+LABEL_ALIASES = {"disease, disorder, or finding": "ddf",
+                 "anatomical loc.": "anatomical location"}
+
+def normalize_label(label):
+    """Lowercase entity type, defined_relations names mapped to the tag names"""
+    label = label.strip().lower()
+    return LABEL_ALIASES.get(label, label)
+
+def legal_label_pairs(relationships):
+    """{(subject type, object type)} allowed by defined_relations, with normalized labels"""
+    pairs = set()
+    for rel in relationships:
+        tails = rel["Tail Entities"] if isinstance(rel["Tail Entities"], list) else [rel["Tail Entities"]]
+        for tail in tails:
+            pairs.add((normalize_label(rel["Head Entity"]), normalize_label(tail)))
+    return pairs
+
+def legal_predicates(relationships):
+    """{(subject type, object type): [predicates]} allowed by defined_relations, with normalized labels"""
+    predicates = {}
+    for rel in relationships:
+        tails = rel["Tail Entities"] if isinstance(rel["Tail Entities"], list) else [rel["Tail Entities"]]
+        for tail in tails:
+            pair = predicates.setdefault((normalize_label(rel["Head Entity"]), normalize_label(tail)), [])
+            if rel["Predicate"] not in pair:
+                pair.append(rel["Predicate"])
+    return predicates
+
 def format_defined_relations(relationships):
 
     # Group relationships by head entity and predicate
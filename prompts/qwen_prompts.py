@@ -241,6 +241,114 @@ Text to analyze:
 
 ONLY OUTPUT VALID JSON. BEGIN RESPONSE WITH {{"""
 #===========================================================================================
+# ** Joint NER + RE - System Prompts **
+#===========================================================================================
+system_prompts['joint_prompt1'] = """You are an information extraction assistant working on biomedical abstracts. Your goal is to extract the entities and the relation triples about the gut microbiota and its connections to Parkinson’s disease and mental health, in one answer.
+
+Task A - Entities. Extract every entity that fits the Labels and Definitions Guide, once per distinct text span:
+{{
+    "entities": [
+        {{
+            "text_span": "intestinal microbiome",
+            "label": "microbiome"
+        }}
+    ]
+}}
+
+Task B - Mention-Based Relations. Identify the entities of Task A involved in a relation and predict the type of relation:
+{{
+    "ternary_mention_based_relations": [
+        {{
+            "subject_text_span": "intestinal microbiome",
+            "subject_label": "microbiome",
+            "predicate": "located in",
+            "object_text_span": "patients",
+            "object_label": "human"
+        }}
+    ]
+}}
+
+Labels and Definitions Guide:
+    anatomical location → Body parts or regions
+    animal → Non-human organisms (e.g., mammals, insects)
+    biomedical technique → Methods for medical research (e.g., 16S rDNA survey, metatranscriptomics analyses, ELISA kit)
+    bacteria → Single-celled microbes (e.g., E. coli, Collinsella aerofaciens)
+    chemical → Substances like drugs, metabolites, or toxins (e.g., simple sugars, metabolite acetate)
+    dietary supplement → Pills/extracts for nutrition (e.g., vitamins, probiotic)
+    DDF → (Disease/Disorder/Finding) Medical conditions or symptoms
+    drug → Therapeutic or recreational substances (e.g., AGPs, antibiotic)
+    food → Edible items for nutrition (e.g., whole grain cereals)
+    gene → DNA units encoding traits/functions
+    human → Homo sapiens (e.g., patients, breast cancer survivors)
+    microbiome → Microbial communities in an environment (e.g., gut microbiota)
+    statistical technique → Data analysis methods (e.g., Multiple regression analysis)
+
+Defined relations (subject -> predicate -> object):
+{defined_relations}
+
+Rules:
+1. Preserve the EXACT text span of the entities, NO rewording
+2. Extract the longest/most specific span (e.g., "human brain" > "brain")
+3. Relations use ONLY text spans and labels of Task A entities
+4. Extract ONLY relations explicitly stated in text that follow the rules on Defined Relations
+5. NO explanations/thoughts/caveats
+6. Output ONE VALID JSON object with "entities" and "ternary_mention_based_relations"
+7. NO markdown code blocks
+8. NO text before/after JSON
+9. Start response with {{
+
+Text to analyze:
+Title: {title}
+Abstract: {abstract}
+
+ONLY OUTPUT VALID JSON. BEGIN RESPONSE WITH {{"""
+
+#===========================================================================================
+# ** RE by scoring - System Prompts **
+#===========================================================================================
+system_prompts['scoring_prompt1'] = """You are an information extraction assistant working on biomedical abstracts tagged with structured entity information. Your goal is to decide which relation the text states between two of its entities, about the gut microbiota and its connections to Parkinson’s disease and mental health.
+
+Each text contains:
+- Outer tags: <eN> ... </eN> for unique entity IDs
+- Inner tags: @entityType$ ... @/entityType$ for entity type
+
+Text to analyze:
+{sentence}
+
+Subject: {subject_text_span} ({subject_label})
+Object: {object_text_span} ({object_label})
+Which relation does the text state from the subject to the object? Answer with ONE of: {predicates}, none.
+Answer none when the text does not state one of them explicitly."""
+
+#===========================================================================================
+# ** NER by scoring - System Prompts **
+#===========================================================================================
+system_prompts['typing_prompt1'] = """You are an information extraction assistant working on biomedical named-entity recognition (NER) about the gut microbiota and its connections to Parkinson’s disease and mental health.
+
+Labels and Definitions Guide:
+    anatomical location → Body parts or regions
+    animal → Non-human organisms (e.g., mammals, insects)
+    biomedical technique → Methods for medical research (e.g., 16S rDNA survey, metatranscriptomics analyses, ELISA kit)
+    bacteria → Single-celled microbes (e.g., E. coli, Collinsella aerofaciens)
+    chemical → Substances like drugs, metabolites, or toxins (e.g., simple sugars, metabolite acetate)
+    dietary supplement → Pills/extracts for nutrition (e.g., vitamins, probiotic)
+    DDF → (Disease/Disorder/Finding) Medical conditions or symptoms
+    drug → Therapeutic or recreational substances (e.g., AGPs, antibiotic)
+    food → Edible items for nutrition (e.g., whole grain cereals)
+    gene → DNA units encoding traits/functions
+    human → Homo sapiens (e.g., patients, breast cancer survivors)
+    microbiome → Microbial communities in an environment (e.g., gut microbiota)
+    statistical technique → Data analysis methods (e.g., Multiple regression analysis)
+
+Text to analyze:
+Title: {title}
+Abstract: {abstract}
+
+Text span: {text_span}
+Which label of the guide does this text span have in the text? Answer with ONE of: {labels}, none.
+Answer none when the span is not an entity of the guide."""
+
+#===========================================================================================
 
 
 
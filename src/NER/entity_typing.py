@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/24 09:18:36
+@author: SIRConceicao
+
+NER BY TYPING candidate spans, no generation
+
+The LLM NER scripts generate every entity as a JSON object, copying spans and offsets that
+nerout2json.validate_and_adjust_text_spans then has to repair. Here the spans come from
+the text itself and the model only gives their label:
+    - bent:        the BENT annotations of the test set (bent2json.py output), moved onto
+                   their span where the offsets are a few characters off
+    - gazetteer:   every occurrence of the entity spans of the train gold/platinum annotations
+    - noun_chunks: the spaCy noun chunks of the title and abstract (en_core_web_sm)
+Each distinct span is asked (typing_prompt1) which of the 13 legal labels, or none, it has,
+and the answers are scored by their log-likelihood in batched forward passes
+(llms_class.Base_Pipeline.score_continuations). The scores are divided by the number of
+tokens of their label, and a span keeps its most likely label when the softmax of these
+per-token scores reaches the threshold; where typed spans overlap, the longest one wins.
+The offsets are those of the text, end_idx inclusive as in the annotations.
+    -> data/processed/lasigeBioTM_subtask6_1_NER_<model>-typing.json
+With --dev the gold entities of the dev set give precision/recall/F1 at several
+thresholds, from the same scores (BENT only annotated the test set).
+'''
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+import json
+import math
+import argparse
+from prompts.qwen_prompts import system_prompts
+import llms_class
+from checkpoint import Checkpoint
+from parallel_runner import select_shard
+from call_metrics import Metrics_Log
+from constrained_decoding import LEGAL_ENTITY_LABELS
+
+PREDICTED_KEYS=('entities',)
+BENT_PATH="data/intermediate/articles_test_NER.json"
+GAZETTEER_PATHS=("data/GutBrainIE_Full_Collection_2025/Annotations/Train/gold_quality/json_format/train_gold.json",
+                 "data/GutBrainIE_Full_Collection_2025/Annotations/Train/platinum_quality/json_format/train_platinum.json")
+SOURCES=("bent","gazetteer","noun_chunks")
+SWEEP=(0.3,0.4,0.5,0.6,0.7,0.8,0.9)
+#==================================================================================================
+def load_data(doc_path):
+    with open(doc_path, 'r') as file:
+        data = json.load(file)
+    return data
+#==================================================================================================
+def messages_format(system_prompt,title,abstract,text_span):
+    """mistral and qwen format"""
+    prompt = system_prompt.format(title=title,abstract=abstract,text_span=text_span,labels=", ".join(LEGAL_ENTITY_LABELS))
+
+    messages = [
+        {"role": "user", "content": prompt}
+    ]
+
+    return messages
+#==================================================================================================
+# CANDIDATE SPANS: (location, start, end) with end exclusive
+#==================================================================================================
+def load_gazetteer(paths=GAZETTEER_PATHS, min_chars=3):
+    """Distinct lowercase entity spans of the annotations."""
+    spans=set()
+    for path in paths:
+        for doc in load_data(path).values():
+            spans.update(entity['text_span'].lower() for entity in doc['entities'] if len(entity['text_span'])>=min_chars)
+    return spans
+
+def gazetteer_spans(text, gazetteer):
+    """Every word-bounded occurrence of the gazetteer spans, overlapping ones included."""
+    lowered=text.lower()
+    found=[]
+    for span in gazetteer:
+        start=lowered.find(span)
+        while start>=0:
+            end=start+len(span)
+            if (start==0 or not lowered[start-1].isalnum()) and (end==len(lowered) or not lowered[end].isalnum()):
+                found.append((start,end))
+            start=lowered.find(span,start+1)
+    return found
+
+def align_span(text, start, span, max_offset=3):
+    """Start of span at most max_offset characters from start, None when it is not there."""
+    for offset in sorted(range(-max_offset,max_offset+1),key=abs):
+        if start+offset>=0 and text[start+offset:start+offset+len(span)]==span:
+            return start+offset
+    return None
+
+def align_bent(bent, max_offset=3):
+    """Move the BENT annotations onto their span, most are a character or two off (as in
+    nerout2json.validate_and_adjust_text_spans), and drop those that cannot be placed.
+    Returns (realigned, dropped)."""
+    realigned=dropped=0
+    for doc in bent.values():
+        meta=doc.get('metadata',doc)
+        entities=[]
+        for entity in doc.get('entities',[]):
+            start=align_span(meta[entity['location']],entity['start_idx'],entity['text_span'],max_offset)
+            if start is None:
+                dropped+=1
+                continue
+            if start!=entity['start_idx'] or entity['end_idx']!=start+len(entity['text_span']):
+                realigned+=1
+            entity['start_idx'],entity['end_idx']=start,start+len(entity['text_span'])
+            entities.append(entity)
+        doc['entities']=entities
+    return realigned,dropped
+
+def bent_spans(entities, location, text):
+    """BENT annotations of a location whose offsets match their span (see align_bent)."""
+    return [(entity['start_idx'],entity['end_idx']) for entity in entities
+            if entity['location']==location and text[entity['start_idx']:entity['end_idx']]==entity['text_span']]
+
+def noun_chunk_spans(nlp, text):
+    return [(chunk.start_char,chunk.end_char) for chunk in nlp(text).noun_chunks]
+
+def candidate_spans(title, abstract, sources, bent_entities=None, gazetteer=None, nlp=None):
+    """Distinct (location, start, end) candidates of the sources."""
+    candidates=set()
+    for location,text in (("title",title),("abstract",abstract)):
+        spans=[]
+        if "bent" in sources and bent_entities:
+            spans+=bent_spans(bent_entities,location,text)
+        if "gazetteer" in sources and gazetteer:
+            spans+=gazetteer_spans(text,gazetteer)
+        if "noun_chunks" in sources and nlp is not None:
+            spans+=noun_chunk_spans(nlp,text)
+        candidates.update((location,start,end) for start,end in spans if text[start:end].strip())
+    return sorted(candidates)
+#==================================================================================================
+def softmax(scores, lengths):
+    """Probabilities of the labels from their summed log-probabilities and token counts. The
+    mean log-probability per token is used, a sum favours the shortest label ("none")."""
+    means=[score/length for score,length in zip(scores,lengths)]
+    top=max(means)
+    weights=[math.exp(mean-top) for mean in means]
+    return [weight/sum(weights) for weight in weights]
+
+def typed_entities(candidates, texts, labels, threshold):
+    """Subtask 6.1 entities: the candidates whose span has a label at threshold, the longest
+    span first where they overlap. labels: {span: (label, probability)}."""
+    typed=[]
+    for location,start,end in candidates:
+        span=texts[location][start:end]
+        label,probability=labels.get(span,("none",0.0))
+        if label!="none" and probability>=threshold:
+            typed.append((location,start,end,span,label))
+
+    entities=[]
+    taken={"title":[],"abstract":[]}
+    for location,start,end,span,label in sorted(typed,key=lambda c:(c[1]-c[2],c[0],c[1])):
+        if any(start<other_end and other_start<end for other_start,other_end in taken[location]):
+            continue
+        taken[location].append((start,end))
+        entities.append({"start_idx":start,"end_idx":end-1,"location":location,"text_span":span,"label":label})
+    return sorted(entities,key=lambda entity:(entity["location"]!="title",entity["start_idx"]))
+
+def threshold_sweep(scored, gold):
+    """Precision/recall/F1 of the entities at the SWEEP thresholds.
+    scored: {pmid: (candidates, texts, labels)}, gold: {pmid: gold entities}."""
+    lines=[f"{'threshold':>10}{'P':>8}{'R':>8}{'F1':>8}{'entities':>10}"]
+    key=lambda entity:(entity["location"],entity["start_idx"],entity["end_idx"],entity["label"])
+    for threshold in SWEEP:
+        tp=predicted=expected=0
+        for pmid,entities in gold.items():
+            keys={key(entity) for entity in typed_entities(*scored[pmid],threshold)}
+            gold_keys={key(entity) for entity in entities}
+            tp+=len(keys&gold_keys)
+            predicted+=len(keys)
+            expected+=len(gold_keys)
+        precision=tp/predicted if predicted else 0.0
+        recall=tp/expected if expected else 0.0
+        f1=2*precision*recall/(precision+recall) if precision+recall else 0.0
+        lines.append(f"{threshold:>10}{precision:>8.3f}{recall:>8.3f}{f1:>8.3f}{predicted:>10}")
+    return "\n".join(lines)
+#==================================================================================================
+def parse_args():
+    parser = argparse.ArgumentParser(description="NER by typing candidate spans")
+    parser.add_argument("--model", default="mistralai/Mistral-7B-Instruct-v0.3", help="Hugging Face model name or local checkpoint")
+    parser.add_argument("--device", default="auto", help="auto, cuda, cuda:N or cpu")
+    parser.add_argument("--num-threads", type=int, default=None, help="torch threads of this process")
+    parser.add_argument("--candidates", default="bent,gazetteer", help=f"comma separated sources of candidate spans: {', '.join(SOURCES)}")
+    parser.add_argument("--threshold", type=float, default=0.5, help="probability of the best label needed to keep a span")
+    parser.add_argument("--score-batch-size", type=int, default=16, help="rows of every forward pass")
+    parser.add_argument("--dev", action="store_true", help="type the dev set and print precision/recall/F1 at several thresholds")
+    parser.add_argument("--adapter", default=None, help="LoRA adapter of the NER task (PEFT directory or hub id) on top of --model")
+    parser.add_argument("--no-worker", action="store_true", help="load the model in this process even when src/model_worker.py serves it")
+    parser.add_argument("--shard", default=None, help="k/N: only run the k-th of N blocks of PMIDs (see parallel_runner.py)")
+    return parser.parse_args()
+#==================================================================================================
+def main():
+    args=parse_args()
+    sources=[source.strip() for source in args.candidates.split(",") if source.strip()]
+    unknown=[source for source in sources if source not in SOURCES]
+    if unknown:
+        raise ValueError(f"Unknown candidate sources {unknown}, use {SOURCES}")
+    doc_path = "data/GutBrainIE_Full_Collection_2025/Test_Data/Test_Data/articles_test.json"
+    if args.dev:
+        doc_path = "data/GutBrainIE_Full_Collection_2025/Annotations/Dev/json_format/dev.json"
+    data=load_data(doc_path)
+    #the predictions replace the gold entities of the dev set
+    gold={annot:data[annot]['entities'] for annot in data} if args.dev else {}
+
+    bent=load_data(BENT_PATH) if "bent" in sources and not args.dev else {}
+    bent_note=""
+    if bent:
+        realigned,dropped=align_bent(bent)
+        bent_note=f"BENT: {sum(len(doc.get('entities',[])) for doc in bent.values())} annotations, {realigned} realigned, {dropped} could not be placed\n"
+        print(bent_note.strip())
+    gazetteer=load_gazetteer() if "gazetteer" in sources else None
+    nlp=None
+    if "noun_chunks" in sources:
+        import spacy
+        #the model pinned in gutbrain.yml, its parser gives the noun chunks
+        nlp=spacy.load("en_core_web_sm")
+
+    #---------------------------------------------------------------------
+    #LLM CONFIGS
+    configs={
+        "quantization":True,
+        "score_batch_size":args.score_batch_size,
+        "min_prefix_tokens":32,
+        "threshold":args.threshold,
+        "candidates":sources,
+        "device":args.device,
+        "num_threads":args.num_threads,
+        "adapters":{"ner":args.adapter} if args.adapter else None,
+        "adapter":"ner" if args.adapter else None,
+        "worker_socket":None if args.no_worker else "data/cache/model_worker.sock"
+        }
+    #---------------------------------------------------------------------
+    #Mistral
+    model_name = args.model
+    llm=llms_class.load_pipeline(llms_class.Mistral_Pipeline,model_name,configs)
+    system_prompt = system_prompts['typing_prompt1']
+    options=[llm.tokenizer(label,add_special_tokens=False)["input_ids"] for label in LEGAL_ENTITY_LABELS+["none"]]
+    #---------------------------------------------------------------------
+    split="dev" if args.dev else "it"
+    output_path=f"data/intermediate/{model_name.split("/")[-1]}-NER-typing-{split}-outputs.json"
+    output_logs=f"data/intermediate/{model_name.split("/")[-1]}-NER-typing-{split}-outputs.LOGS"
+    ner_output_path=None if args.dev else f"data/processed/lasigeBioTM_subtask6_1_NER_{model_name.split("/")[-1]}-typing.json"
+    if args.shard:
+        data,output_path,output_logs=select_shard(data,output_path,output_logs,args.shard)
+        ner_output_path=None
+
+    checkpoint=Checkpoint(output_path)
+    done=checkpoint.load()
+    metrics=Metrics_Log(output_path,resume=bool(done))
+
+    scored={}
+    with open(output_logs,'a' if done else 'w') as logfile, llm:
+        logfile.write(f"Input File {doc_path}\n{bent_note}LLM Config:\n{configs}\n\n")
+        if done:
+            logfile.write(f"Resumed from {checkpoint.path}: {len(done)} documents already done\n\n")
+        for annot in data:
+            if annot in done:
+                continue
+            jbase= data[annot]
+            meta= jbase.get('metadata',jbase)
+            texts={"title":meta['title'],"abstract":meta['abstract']}
+
+            candidates=candidate_spans(texts["title"],texts["abstract"],sources,
+                                       bent.get(annot,{}).get('entities'),gazetteer,nlp)
+            #a span gets one label, whatever its occurrence
+            spans=sorted({texts[location][start:end] for location,start,end in candidates})
+            prompts,continuations=[],[]
+            for span in spans:
+                prompt=llm.encode(messages_format(system_prompt,texts["title"],texts["abstract"],span))
+                prompts+=[prompt]*len(options)
+                continuations+=options
+            scores=llm.score_continuations(prompts,continuations) if prompts else []
+
+            labels={}
+            logfile.write(f"{annot}\n")
+            for k,span in enumerate(spans):
+                if None in scores[k*len(options):(k+1)*len(options)]:
+                    #a row did not fit in memory, the span gets no label
+                    logfile.write(f"{span}: OutOfMemoryError\n")
+                    continue
+                probabilities=softmax(scores[k*len(options):(k+1)*len(options)],[len(option) for option in options])
+                probability,label=max(zip(probabilities,LEGAL_ENTITY_LABELS+["none"]))
+                labels[span]=(label,probability)
+                logfile.write(f"{span}: {label} {probability:.2f}\n")
+            logfile.write("\n")
+            scored[annot]=(candidates,texts,labels)
+
+            jbase['entities']=typed_entities(candidates,texts,labels,configs["threshold"])
+            print(f"{annot}: {len(candidates)} candidates, {len(spans)} distinct spans, {len(jbase['entities'])} entities")
+            checkpoint.write(annot,{key:jbase[key] for key in PREDICTED_KEYS})
+            if prompts:
+                metrics.write(annot,llm.last_metrics[0])
+
+    print(llm.report())
+    checkpoint.close()
+    metrics.close()
+    for annot,record in done.items():
+        data[annot].update(record)
+
+    with open(output_path, "w") as f:
+        json.dump(data, f, indent=2)
+    checkpoint.remove()
+
+    if ner_output_path:
+        os.makedirs(os.path.dirname(ner_output_path), exist_ok=True)
+        with open(ner_output_path, "w") as f:
+            json.dump(data, f, indent=2)
+    gold={annot:entities for annot,entities in gold.items() if annot in scored}
+    if gold:
+        print(f"Entities on {len(gold)} documents (threshold {configs['threshold']} in the output):")
+        print(threshold_sweep(scored,gold))
+
+#==================================================================================================
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/12 16:40:09
+@author: SIRConceicao
+
+Generation speed benchmarks on the prompts of the BENTMistral RE system (main_baseline_labels.py)
+or of the NER baseline (NER/ner_llm_test_baseline.py).
+
+    assisted: plain generation vs assisted generation with a draft model
+        python src/benchmark_generation.py assisted --model mistralai/Mistral-7B-Instruct-v0.3 --draft <small model> --docs 8
+        python src/benchmark_generation.py assisted --model <tiny target> --draft <tiny draft> --device cpu --max-new-tokens 64
+    lookup: plain generation vs prompt-lookup decoding, per system
+        python src/benchmark_generation.py lookup --system re --prompt-lookup 10
+        python src/benchmark_generation.py lookup --system ner --prompt-lookup 10
+    continuous: static batching vs the continuous batching engine, same batch size
+        python src/benchmark_generation.py continuous --docs 64 --batch-size 8 --admit-every 8
+    compile: eager generation vs a static cache vs a static cache with a compiled forward
+        python src/benchmark_generation.py compile --docs 16 --batch-size 4
+        python src/benchmark_generation.py compile --model <tiny model> --device cpu --max-new-tokens 64
+    kv: full precision vs int8/int4 KV cache, the largest batch of copies of the longest prompt
+    that fits and its peak memory for every number of bits (0: full precision)
+        python src/benchmark_generation.py kv --bits 0 8 4 --max-batch-size 64
+        python src/benchmark_generation.py kv --model <tiny model> --device cpu --max-new-tokens 64 --max-batch-size 8
+    adapters: one base model serving the base weights and several LoRA adapters, switched per
+    batch, vs loading the model once per task
+        python src/benchmark_generation.py adapters --adapter re=<RE adapter> --adapter ner=<NER adapter>
+        python src/benchmark_generation.py adapters --model <tiny model> --random-adapters 2 --device cpu --max-new-tokens 32
+    joint: the two passes of the test flow (NER, then RE on the text tagged with the NER
+    answers of DOC_PATH) vs the joint NER + RE system (joint_ner_re.py), same documents
+        python src/benchmark_generation.py joint --docs 16 --max-new-tokens 4096
+'''
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import time
+import argparse
+import tempfile
+import torch
+import llms_class
+import main_baseline_labels as system
+from NER import ner_llm_test_baseline as ner_system
+import joint_ner_re as joint_system
+from prompts.qwen_prompts import system_prompts
+from misc.utils import defined_relations,format_defined_relations
+from call_metrics import summarize
+from devices import peak_memory_scope
+
+PIPELINES = {"mistral": llms_class.Mistral_Pipeline, "qwen": llms_class.Qwen_Pipeline, "llama": llms_class.Llama_Pipeline}
+DOC_PATH = "data/GutBrainIE_tagged/Annotations/Test/lasigeBioTM_subtask6_1_NER_Mistral-7B-Instruct-v0.3_fixed_tagged.json"
+NER_DOC_PATH = "data/GutBrainIE_Full_Collection_2025/Test_Data/Test_Data/articles_test.json"
+#==================================================================================================
+def load_prompts(n_docs, system_name="re"):
+    if system_name == "ner":
+        data=ner_system.load_data(NER_DOC_PATH)
+        return [ner_system.messages_format(data[annot]['title'], data[annot]['abstract']) for annot in list(data)[:n_docs]]
+
+    data=system.load_data(DOC_PATH)
+    formated_rel_dict=format_defined_relations(defined_relations())
+    return [system.messages_format(system_prompts['prompt1'],formated_rel_dict,
+                                   data[annot]['title_tagged'] + "\n " + data[annot]['abstract_tagged'])
+            for annot in list(data)[:n_docs]]
+
+def base_configs(args):
+    return {
+        "temperature":0.2,
+        "max_new_tokens":args.max_new_tokens,
+        "quantization":args.quantization,
+        "batch_size":args.batch_size,
+        "device":args.device,
+        "num_threads":args.num_threads,
+        }
+
+def timed_run(llm, prompts, batch_size):
+    """Returns (generated tokens, seconds) of one pass over the prompts."""
+    llm.generated_tokens=0
+    start=time.time()
+    llm.inference_batch(prompts, batch_size=batch_size)
+    return llm.generated_tokens, time.time()-start
+
+def print_row(name, tokens, seconds, extra=""):
+    print(f"{name:<12}{tokens:>8} tokens {seconds:>8.1f}s {tokens / seconds:>8.1f} tok/s  {extra}")
+
+#==================================================================================================
+def bench_assisted(args, prompts):
+    configs=base_configs(args)
+    llm=PIPELINES[args.pipeline](args.model,configs)
+    llm.inference(prompts[0])  #warm up
+
+    #assisted generation runs one sequence at a time, so does the plain baseline
+    tokens, seconds = timed_run(llm, prompts, 1)
+    print_row("plain", tokens, seconds)
+
+    configs["draft_model"]=args.draft
+    if args.num_assistant_tokens:
+        configs["num_assistant_tokens"]=args.num_assistant_tokens
+    llm.inference(prompts[0])
+    assisted_tokens, assisted_seconds = timed_run(llm, prompts, 1)
+    print_row("assisted", assisted_tokens, assisted_seconds, f"acceptance {llm.acceptance_rate():.1%}")
+    print(f"Speedup: {(assisted_tokens / assisted_seconds) / (tokens / seconds):.2f}x")
+
+def bench_lookup(args, prompts):
+    configs=base_configs(args)
+    llm=PIPELINES[args.pipeline](args.model,configs)
+    llm.inference(prompts[0])  #warm up
+
+    #prompt lookup runs one sequence at a time, so does the plain baseline
+    tokens, seconds = timed_run(llm, prompts, 1)
+    print_row("plain", tokens, seconds)
+
+    configs["prompt_lookup_num_tokens"]=args.prompt_lookup
+    if args.max_matching_ngram_size:
+        configs["max_matching_ngram_size"]=args.max_matching_ngram_size
+    llm.inference(prompts[0])
+    before=dict(llm.spec_stats)
+    lookup_tokens, lookup_seconds = timed_run(llm, prompts, 1)
+    calls, accepted, drafted = (llm.spec_stats[key] - before[key] for key in ("calls", "accepted", "drafted"))
+    print_row("lookup", lookup_tokens, lookup_seconds,
+              f"acceptance {accepted / max(drafted, 1):.1%}, {accepted / calls:.1f} draft tokens accepted per call")
+    print(f"Speedup ({args.system}): {(lookup_tokens / lookup_seconds) / (tokens / seconds):.2f}x")
+
+def bench_continuous(args, prompts):
+    configs=base_configs(args)
+    configs["admit_every"]=args.admit_every
+    llm=PIPELINES[args.pipeline](args.model,configs)
+    llm.inference(prompts[0])  #warm up
+
+    for engine in ("static", "continuous"):
+        configs["engine"]=engine
+        tokens, seconds = timed_run(llm, prompts, args.batch_size)
+        summary=summarize(llm.last_metrics)
+        print_row(engine, tokens, seconds,
+                  f"latency p50 {summary['latency_p50_s']}s p95 {summary['latency_p95_s']}s")
+        if engine == "static":
+            static_rate=tokens / seconds
+    print(f"Speedup: {(tokens / seconds) / static_rate:.2f}x")
+
+def bench_compile(args, prompts):
+    configs=base_configs(args)
+    llm=PIPELINES[args.pipeline](args.model,configs)
+    llm.inference(prompts[0])  #warm up
+
+    tokens, seconds = timed_run(llm, prompts, args.batch_size)
+    print_row("eager", tokens, seconds)
+    for name, keys in (("static", {"static_cache": True}), ("compiled", {"static_cache": True, "compile": True})):
+        configs.update(keys)
+        llm.static_caches=None
+        llm.inference_batch(prompts, batch_size=args.batch_size)  #allocation and compilation of every batch shape
+        run_tokens, run_seconds = timed_run(llm, prompts, args.batch_size)
+        print_row(name, run_tokens, run_seconds,
+                  f"speedup {(run_tokens / run_seconds) / (tokens / seconds):.2f}x, {llm.static_fallbacks} eager fallbacks")
+    print(f"Compilation warm-up: {llm.warm_up_seconds:.1f}s")
+
+def bench_kv(args, prompts):
+    configs=base_configs(args)
+    llm=PIPELINES[args.pipeline](args.model,configs)
+    llm.inference(prompts[0])  #warm up
+
+    #generate keeps the largest batch in memory with the longest prompt in every row
+    ids=max((llm.encode(prompt) for prompt in prompts), key=len)
+    for bits in args.bits:
+        configs["kv_cache_bits"]=bits or None
+        largest, peak, kv_mb = 0, None, None
+        batch_size=1
+        while batch_size <= args.max_batch_size:
+            try:
+                llm.run_generate([ids] * batch_size)
+            except torch.OutOfMemoryError:
+                break
+            record=llm.last_metrics[0]
+            largest, peak, kv_mb = batch_size, record["peak_memory_mb"], record.get("kv_cache_mb")
+            batch_size*=2
+        llm.empty_cache()
+        print(f"{f'int{bits}' if bits else 'full':<12}max batch size {largest:>4}"
+              f"{' (--max-batch-size)' if largest == args.max_batch_size else ''}, peak memory {peak} MB"
+              f"{' (process peak, it only grows)' if peak_memory_scope(llm.model.device) == 'process' else ''}"
+              + (f", KV cache {kv_mb} MB" if kv_mb is not None else ""))
+
+def random_adapters(model_name, n_adapters, directory):
+    """{name: path} of n_adapters LoRA adapters with random weights for model_name, saved in
+    directory (offline checks of the adapter switching, the answers are meaningless)."""
+    from peft import LoraConfig, get_peft_model
+    from transformers import AutoModelForCausalLM
+    model=AutoModelForCausalLM.from_pretrained(model_name)
+    paths={}
+    for k in range(n_adapters):
+        torch.manual_seed(k)
+        lora=get_peft_model(model, LoraConfig(r=8, lora_alpha=16, target_modules=["q_proj", "v_proj"],
+                                              init_lora_weights=False))
+        paths[f"random{k}"]=os.path.join(directory, f"random{k}")
+        lora.save_pretrained(paths[f"random{k}"])
+        model=lora.unload()
+    return paths
+
+def last_logits(task, ids):
+    task.switch_adapter(task.configs.get("adapter"))
+    with torch.no_grad():
+        return task.model(ids).logits[0, -1].float()
+
+def bench_adapters(args, prompts):
+    adapters=dict(adapter.split("=", 1) for adapter in args.adapter)
+    if args.random_adapters:
+        adapters.update(random_adapters(args.model, args.random_adapters, tempfile.mkdtemp()))
+    configs=base_configs(args)
+    configs["adapters"]=adapters
+
+    start=time.time()
+    llm=PIPELINES[args.pipeline](args.model,configs)
+    load_seconds=time.time()-start
+    tasks={name: llm.for_task(dict(configs, adapter=name)) for name in [None, *adapters]}
+    weights=llm.model.get_input_embeddings().weight.data_ptr()
+    llm.inference(prompts[0])  #warm up
+
+    #every adapter changes the answer, switching back restores the base weights
+    ids=torch.tensor([llm.encode(prompts[0])], device=llm.model.device)
+    base=last_logits(tasks[None], ids)
+    for name in adapters:
+        print(f"{name:<12}max logit change {(last_logits(tasks[name], ids) - base).abs().max():.4f}")
+    print(f"{'base':<12}max logit change {(last_logits(tasks[None], ids) - base).abs().max():.4f} after switching back")
+
+    #every batch goes through every task in turn, the worst case for switching
+    tokens=0
+    start=time.time()
+    for first in range(0, len(prompts), args.batch_size):
+        for task in tasks.values():
+            task_tokens, _ = timed_run(task, prompts[first:first + args.batch_size], args.batch_size)
+            tokens+=task_tokens
+    seconds=time.time()-start
+    state=llm.adapter_state
+    print_row("switching", tokens, seconds, f"{state['switches']} switches in {state['seconds']:.3f}s")
+    print(f"Base weights loaded once in {load_seconds:.1f}s (same tensors after the run: "
+          f"{llm.model.get_input_embeddings().weight.data_ptr() == weights}), "
+          f"one model per task would load them {len(tasks)} times")
+
+def bench_joint(args, prompts):
+    ner_data=ner_system.load_data(NER_DOC_PATH)
+    tagged=system.load_data(DOC_PATH)
+    pmids=[annot for annot in ner_data if annot in tagged][:args.docs]
+    formated_rel_dict=format_defined_relations(defined_relations())
+    flows={
+        "NER": ("entities", "sequence", [ner_system.messages_format(ner_data[annot]['title'], ner_data[annot]['abstract'])
+                                         for annot in pmids]),
+        "RE": ("relations", "object", [system.messages_format(system_prompts['prompt1'], formated_rel_dict,
+                                                              tagged[annot]['title_tagged'] + "\n " + tagged[annot]['abstract_tagged'])
+                                       for annot in pmids]),
+        "joint": ("joint", "object", [joint_system.messages_format(system_prompts['joint_prompt1'], formated_rel_dict,
+                                                                   ner_data[annot]['title'], ner_data[annot]['abstract'])
+                                      for annot in pmids]),
+        }
+    configs=base_configs(args)
+    configs["max_repeats"]=3
+    llm=PIPELINES[args.pipeline](args.model,configs)
+    llm.inference(prompts[0])  #warm up
+
+    totals={}
+    for name, (schema, stop, flow_prompts) in flows.items():
+        configs.update(constrained_schema=schema, stop_on_json=stop)
+        tokens, seconds = timed_run(llm, flow_prompts, args.batch_size)
+        summary=summarize(llm.last_metrics)
+        print_row(name, tokens, seconds, f"{summary['prompt_tokens']} prompt tokens")
+        totals[name]=(summary['prompt_tokens'] + tokens, seconds)
+    two_pass=[totals["NER"][k] + totals["RE"][k] for k in (0, 1)]
+    print(f"Joint vs two passes on {len(pmids)} documents: {totals['joint'][0]} vs {two_pass[0]} tokens "
+          f"({totals['joint'][0] / two_pass[0]:.2f}x), {totals['joint'][1]:.1f}s vs {two_pass[1]:.1f}s "
+          f"({totals['joint'][1] / two_pass[1]:.2f}x)")
+
+BENCHMARKS = {"assisted": bench_assisted, "lookup": bench_lookup, "continuous": bench_continuous, "compile": bench_compile,
+              "kv": bench_kv, "adapters": bench_adapters, "joint": bench_joint}
+#==================================================================================================
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generation speed benchmarks")
+    parser.add_argument("mode", choices=list(BENCHMARKS))
+    parser.add_argument("--model", default="mistralai/Mistral-7B-Instruct-v0.3")
+    parser.add_argument("--pipeline", default="mistral", choices=list(PIPELINES))
+    parser.add_argument("--draft", default=None, help="draft model sharing the tokenizer of --model (assisted)")
+    parser.add_argument("--num-assistant-tokens", type=int, default=None)
+    parser.add_argument("--system", default="re", choices=["re", "ner"], help="prompts of the RE or of the NER system")
+    parser.add_argument("--prompt-lookup", type=int, default=10, help="prompt_lookup_num_tokens (lookup)")
+    parser.add_argument("--max-matching-ngram-size", type=int, default=None)
+    parser.add_argument("--adapter", action="append", default=[], help="name=path of a LoRA adapter (adapters), repeatable")
+    parser.add_argument("--random-adapters", type=int, default=0, help="add N LoRA adapters with random weights (adapters)")
+    parser.add_argument("--bits", type=int, nargs="+", choices=[0, 4, 8], default=[0, 8, 4], help="KV cache bits to compare, 0: full precision (kv)")
+    parser.add_argument("--max-batch-size", type=int, default=64, help="largest batch size tried (kv)")
+    parser.add_argument("--admit-every", type=int, default=8, help="decode steps between admissions (continuous)")
+    parser.add_argument("--docs", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--quantization", action="store_true")
+    parser.add_argument("--device", default="auto")
+    parser.add_argument("--num-threads", type=int, default=None)
+    return parser.parse_args()
+
+def main():
+    args=parse_args()
+    prompts=load_prompts(args.docs, args.system)
+    print(f"{args.mode}: {len(prompts)} {args.system} prompts, {args.model} on {args.device}")
+    BENCHMARKS[args.mode](args, prompts)
+
+#==================================================================================================
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/19 09:42:31
+@author: SIRConceicao
+
+Per-document max_new_tokens of the LLM drivers (--adaptive-max-new-tokens, off by default).
+
+The drivers reserve configs["max_new_tokens"] for every document (4096 for RE), but
+an RE answer only lists relations between the <eN> entities of the tagged text, so
+its length follows the number of entities, the number of entity type pairs that
+defined_relations allows between them and the length of the abstract. A NER answer
+follows the length of the abstract, as does a joint answer (joint_ner_re.py).
+
+Budget_Estimator fits a linear model of the answer tokens on those features over the
+raw answers the model generated, read from the .LOGS files of earlier runs. Then, for
+every document:
+    max_new_tokens = prediction * margin, rounded up to 64 tokens
+and kept between min_new_tokens and configs["max_new_tokens"]. The margin is the
+smallest factor that covers `coverage` of the calibration answers. The driver's own
+.LOGS is used when it has enough answers, otherwise every .LOGS in data/intermediate.
+Either way a .LOGS only counts when it was run with the same prompts: the drivers write
+every answer under "<pmid> <prompt hash>" (log_block), and the hash must be the one of
+this run for every PMID they share. Older .LOGS that hold the decoded "[INST] ... [/INST]"
+prompt are hashed from it. Without calibration answers every document keeps
+configs["max_new_tokens"], with a warning.
+
+An answer longer than its budget is cut and not regenerated, the driver keeps it as
+unparsed llm_output. Hence the flag, and the high coverage.
+'''
+import os
+import re
+import json
+import glob
+import math
+import hashlib
+import warnings
+import numpy as np
+
+OUTPUTS_DIR = "data/intermediate"
+TAGGED_GLOB = "data/GutBrainIE_tagged/Annotations/*/*.json"
+#"<pmid> <prompt hash>\n<answer>\n\n" blocks of the driver .LOGS, older ones have no hash
+#and the decoded prompt before the answer
+LOG_BLOCK = re.compile(r"^(\d+)(?: ([0-9a-f]{12}))?\n(.*?)(?=^\d+(?: [0-9a-f]{12})?\n|\Z)", re.M | re.S)
+ENTITY_TAG = re.compile(r"<e(\d+)>@([^$<]+)\$")
+#tokens of an answer without a tokenizer (OpenAI_Pipeline), about Mistral's on the JSON answers
+CHARS_PER_TOKEN = 3.0
+#==================================================================================================
+def entity_types(doc):
+    """{entity id: lowercase type} of the <eN>@type$ tags of a tagged document."""
+    meta = doc.get("metadata", doc)
+    text = meta.get("title_tagged", "") + " " + meta.get("abstract_tagged", "")
+    return {entity: label.strip().lower() for entity, label in ENTITY_TAG.findall(text)}
+
+def is_tagged(doc):
+    return "title_tagged" in doc.get("metadata", doc)
+
+def unique_objects(items):
+    seen = {}
+    for item in items:
+        if isinstance(item, dict):
+            seen.setdefault(json.dumps(item, sort_keys=True), item)
+    return list(seen.values())
+
+def normalized(text):
+    """text without whitespace, the decoded prompts do not keep it exactly"""
+    return "".join(text.split())
+
+def prompt_text(messages):
+    return normalized("".join(message.get("content", "") for message in messages))
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+
+def prompt_hash(messages):
+    """Short hash of the prompt of a conversation, whitespace aside."""
+    return text_hash(prompt_text(messages))
+
+def log_block(pmid, messages, output):
+    """.LOGS block of one answer, with the hash of its prompt for calibrate()."""
+    return f"{pmid} {prompt_hash(messages)}\n{output}\n\n"
+
+def log_answers(path):
+    """{pmid: (prompt hash, raw answer)} of a driver .LOGS, the last answer of a PMID when a
+    resumed run logged it twice. The hash is None when the block has neither a hash nor the
+    decoded prompt."""
+    try:
+        with open(path, "r") as file:
+            text = file.read()
+    except OSError:
+        return {}
+    answers = {}
+    for pmid, digest, block in LOG_BLOCK.findall(text):
+        if "[/INST]" in block:
+            prompt, answer = block.rsplit("[/INST]", 1)
+            digest = digest or text_hash(normalized(prompt.split("[INST]", 1)[-1]))
+        else:
+            answer = block
+        answer = answer.strip()
+        if answer.endswith("</s>"):
+            answer = answer[:-len("</s>")]
+        if answer.strip():
+            answers[pmid] = (digest or None, answer.strip())
+    return answers
+
+#==================================================================================================
+class Budget_Estimator:
+    def __init__(self, max_new_tokens, tokenizer=None, legal_pairs=None, calibration=None,
+                 coverage=0.99, min_new_tokens=256, min_docs=20, step=64):
+        """legal_pairs: misc.utils.legal_label_pairs of the tagged documents, None when the
+        prompts are not tagged (length only).
+        calibration: output JSON of the driver, its .LOGS is preferred over the others.
+        calibrate() fits the model once the prompts of the run are known."""
+        self.calibration = calibration
+        self.max_new_tokens = max_new_tokens
+        self.tokenizer = tokenizer
+        self.legal_pairs = legal_pairs
+        self.coverage = coverage
+        self.min_new_tokens = min_new_tokens
+        self.min_docs = min_docs
+        self.step = step
+        self.coef = None
+        self.margin = None
+        self.correlation = None
+        self.sources = []
+        self.docs = 0
+        self.tagged = None
+
+    #---------------------------------------------------------------------------------------
+    def features(self, doc):
+        meta = doc.get("metadata", doc)
+        kchars = (len(meta.get("title", "")) + len(meta.get("abstract", ""))) / 1000
+        if self.legal_pairs is None:
+            return [1.0, kchars]
+        labels = set(entity_types(doc).values())
+        legal = sum((subject, obj) in self.legal_pairs for subject in labels for obj in labels)
+        return [1.0, len(entity_types(doc)), legal, kchars]
+
+    def tokens(self, text):
+        if self.tokenizer is None:
+            return math.ceil(len(text) / CHARS_PER_TOKEN)
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def document(self, pmid, docs):
+        """The input document of a PMID, its tagged version when the features need the tags
+        (the raw baseline inputs are not tagged)."""
+        doc = docs.get(pmid)
+        if doc is not None and (self.legal_pairs is None or is_tagged(doc)):
+            return doc
+        if self.tagged is None:
+            self.tagged = {}
+            for path in glob.glob(TAGGED_GLOB):
+                with open(path, "r") as file:
+                    self.tagged.update(json.load(file))
+        return self.tagged.get(pmid)
+
+    def samples(self, path, prompts, docs):
+        """(features, answer tokens) of the answers of a .LOGS, none when its prompts differ
+        from those of this run or it shares no PMID with it."""
+        answers = log_answers(path)
+        shared = [pmid for pmid in answers if pmid in prompts]
+        if not shared or any(answers[pmid][0] != prompts[pmid] for pmid in shared):
+            return [], []
+        X, y = [], []
+        for pmid, (_, answer) in answers.items():
+            doc = self.document(pmid, docs)
+            if doc is None:
+                continue
+            X.append(self.features(doc))
+            y.append(self.tokens(answer))
+        return X, y
+
+    def calibrate(self, prompts, docs):
+        """prompts: {pmid: messages} of this run, docs: {pmid: input document}."""
+        prompts = {pmid: prompt_hash(messages) for pmid, messages in prompts.items()}
+        own = os.path.splitext(self.calibration)[0] + ".LOGS" if self.calibration else None
+        X, y = self.samples(own, prompts, docs) if own and os.path.exists(own) else ([], [])
+        self.sources = [os.path.basename(own)] if len(y) >= self.min_docs else []
+        if not self.sources:
+            X, y = [], []
+            #parallel_runner.py merges the .shard-k-of-N.LOGS into the driver .LOGS
+            for path in sorted(path for path in glob.glob(os.path.join(OUTPUTS_DIR, "*.LOGS")) if ".shard-" not in path):
+                file_X, file_y = self.samples(path, prompts, docs)
+                if file_y:
+                    X += file_X
+                    y += file_y
+                    self.sources.append(os.path.basename(path))
+        self.docs = len(y)
+        if self.docs < self.min_docs:
+            warnings.warn(f"Adaptive max_new_tokens: {self.docs} answers in .LOGS of the same prompts, "
+                          f"{self.min_docs} needed, every document keeps max_new_tokens={self.max_new_tokens}")
+            self.sources = []
+            return
+
+        X, y = np.array(X), np.array(y, dtype=float)
+        #least squares, dropping the features that come out negative (the intercept stays)
+        columns = list(range(X.shape[1]))
+        while True:
+            coef = np.linalg.lstsq(X[:, columns], y, rcond=None)[0]
+            if len(columns) == 1 or (coef[1:] >= 0).all():
+                break
+            columns.pop(1 + int(np.argmin(coef[1:])))
+        self.coef = np.zeros(X.shape[1])
+        self.coef[columns] = coef
+        predicted = np.maximum(X @ self.coef, self.step)
+        #no correlation to report when the fit or the answers are constant
+        varying = len(columns) > 1 and np.ptp(predicted) > 0 and np.ptp(y) > 0
+        self.correlation = float(np.corrcoef(predicted, y)[0, 1]) if varying else 0.0
+        self.margin = float(np.quantile(y / predicted, self.coverage))
+
+    #---------------------------------------------------------------------------------------
+    def predict(self, doc):
+        """max_new_tokens of one input document."""
+        if self.coef is None or (self.legal_pairs is not None and not is_tagged(doc)):
+            return self.max_new_tokens
+        predicted = max(float(np.dot(self.features(doc), self.coef)), self.step) * self.margin
+        budget = math.ceil(predicted / self.step) * self.step
+        return int(min(max(budget, self.min_new_tokens), self.max_new_tokens))
+
+    def report(self, budgets):
+        if self.coef is None:
+            return f"Adaptive max_new_tokens: {self.docs} calibration answers, every document keeps {self.max_new_tokens}"
+        return (f"Adaptive max_new_tokens: fit on {self.docs} answers of {len(self.sources)} outputs "
+                f"(r={self.correlation:.2f}, margin x{self.margin:.2f} covers {self.coverage:.0%}), "
+                f"p50 {int(np.median(budgets))} max {max(budgets)} instead of {self.max_new_tokens}, "
+                f"{1 - sum(budgets) / (len(budgets) * self.max_new_tokens):.0%} fewer new tokens reserved")
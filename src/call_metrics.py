@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/14 09:12:48
+@author: SIRConceicao
+
+Per-call token, latency and throughput records of the LLM pipelines.
+
+Every prompt answered by a pipeline gets one record in pipeline.last_metrics:
+    prompt_tokens, cached_prefix_tokens, generated_tokens,
+    prefill_s   generate() start -> first logits (the prompt forward)
+    decode_s    first logits -> end of generate()
+    latency_s, tokens_per_s, stop_reason,
+    peak_memory_mb, peak_memory_scope ("call": GPU peak of the call, "process": on CPU the
+        peak resident memory of the process so far, which later calls only see grow),
+    batch_size, gpu_seconds (latency_s / batch_size: the share of the device time of the row),
+    response_cache (answered from the response cache, no generation)
+A prompt that does not fit in memory even alone gets OOM_OUTPUT as output and a record
+with stop_reason "oom", the drivers checkpoint it and go on with the next document.
+The rows of a batch share the prefill, decode and memory numbers of the batch.
+
+The drivers write one JSON line {"pmid": ..., **record} per document to
+<output>.metrics.jsonl and, at the end of the run, the summary of the whole file
+(p50/p95 latency, total GPU-seconds, ...) to <output>.metrics-summary.json.
+'''
+import os
+import json
+import time
+import numpy as np
+from collections import Counter
+from transformers import LogitsProcessor
+
+#output of a prompt that does not fit in memory even alone, as the baseline recorded it
+OOM_OUTPUT = "OutOfMemoryError"
+
+#==================================================================================================
+class First_Token_Timer(LogitsProcessor):
+    """Logits processor that leaves the scores untouched and records when the first logits
+    (the end of the prefill) arrive."""
+    def __init__(self):
+        self.first_logits = None
+
+    def __call__(self, input_ids, scores):
+        if self.first_logits is None:
+            self.first_logits = time.time()
+        return scores
+
+def call_record(prompt_tokens, generated_tokens, start, first_logits, end, stop_reason,
+                peak_memory_mb=None, batch_size=1, cached_prefix_tokens=0, peak_memory_scope=None):
+    first_logits = first_logits or end
+    latency = end - start
+    return dict(prompt_tokens=prompt_tokens,
+                cached_prefix_tokens=cached_prefix_tokens,
+                generated_tokens=generated_tokens,
+                prefill_s=round(first_logits - start, 4),
+                decode_s=round(end - first_logits, 4),
+                latency_s=round(latency, 4),
+                tokens_per_s=round(generated_tokens / latency, 2) if latency > 0 else None,
+                stop_reason=stop_reason,
+                peak_memory_mb=peak_memory_mb,
+                peak_memory_scope=peak_memory_scope,
+                batch_size=batch_size,
+                gpu_seconds=round(latency / batch_size, 4),
+                response_cache=False)
+
+def cached_record(prompt_tokens):
+    return dict(prompt_tokens=prompt_tokens, cached_prefix_tokens=0, generated_tokens=0,
+                prefill_s=0.0, decode_s=0.0, latency_s=0.0, tokens_per_s=None, stop_reason=None,
+                peak_memory_mb=None, peak_memory_scope=None, batch_size=0, gpu_seconds=0.0, response_cache=True)
+
+def oom_record(prompt_tokens):
+    """Record of a prompt that does not fit in memory even alone, its output is OOM_OUTPUT."""
+    return dict(prompt_tokens=prompt_tokens, cached_prefix_tokens=0, generated_tokens=0,
+                prefill_s=None, decode_s=None, latency_s=None, tokens_per_s=None, stop_reason="oom",
+                peak_memory_mb=None, peak_memory_scope=None, batch_size=1, gpu_seconds=None, response_cache=False)
+
+def http_record(prompt_tokens, generated_tokens, latency, stop_reason):
+    """Record of a request answered by an inference server: no prefill/decode split and the
+    device time is spent on the server."""
+    return dict(prompt_tokens=prompt_tokens, cached_prefix_tokens=0, generated_tokens=generated_tokens,
+                prefill_s=None, decode_s=None, latency_s=round(latency, 4),
+                tokens_per_s=round(generated_tokens / latency, 2) if latency > 0 else None,
+                stop_reason=stop_reason, peak_memory_mb=None, peak_memory_scope=None, batch_size=1, gpu_seconds=None,
+                response_cache=False)
+
+#==================================================================================================
+def percentile(values, q):
+    return round(float(np.percentile(values, q)), 4) if values else None
+
+def summarize(records):
+    """Run summary of a list of call records."""
+    generated = [r for r in records if not r.get("response_cache")]
+    latencies = [r["latency_s"] for r in generated if r["latency_s"] is not None]
+    tokens = sum(r["generated_tokens"] for r in generated)
+    gpu_seconds = sum(r["gpu_seconds"] or 0.0 for r in generated)
+    peaks = [r["peak_memory_mb"] for r in generated if r.get("peak_memory_mb") is not None]
+    scopes = {r.get("peak_memory_scope") for r in generated if r.get("peak_memory_mb") is not None}
+    return dict(calls=len(records),
+                response_cache_hits=len(records) - len(generated),
+                prompt_tokens=sum(r["prompt_tokens"] or 0 for r in generated),
+                generated_tokens=tokens,
+                latency_p50_s=percentile(latencies, 50),
+                latency_p95_s=percentile(latencies, 95),
+                prefill_p50_s=percentile([r["prefill_s"] for r in generated if r["prefill_s"] is not None], 50),
+                decode_p50_s=percentile([r["decode_s"] for r in generated if r["decode_s"] is not None], 50),
+                gpu_seconds=round(gpu_seconds, 2),
+                tokens_per_gpu_second=round(tokens / gpu_seconds, 2) if gpu_seconds else None,
+                peak_memory_mb=max(peaks) if peaks else None,
+                peak_memory_scope="process" if "process" in scopes else ("call" if scopes else None),
+                stop_reasons=dict(Counter(str(r["stop_reason"]) for r in generated).most_common()))
+
+#==================================================================================================
+class Metrics_Log:
+    """Per-PMID metrics file next to the output JSON, appended to on resume."""
+    def __init__(self, output_path, resume=False):
+        base = os.path.splitext(output_path)[0]
+        self.path = f"{base}.metrics.jsonl"
+        self.summary_path = f"{base}.metrics-summary.json"
+        self.file = None
+        if not resume and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def write(self, pmid, record):
+        if self.file is None:
+            self.file = open(self.path, "a")
+        self.file.write(json.dumps({"pmid": pmid, **record}) + "\n")
+        self.file.flush()
+
+    def load(self):
+        """{pmid: record}, the last record of a PMID wins when a resumed run generated it again."""
+        records = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  #torn last line of a crashed run
+                    records[record["pmid"]] = record
+        return records
+
+    def close(self):
+        """Close the records file and write the summary of every record in it."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        summary = summarize(list(self.load().values()))
+        with open(self.summary_path, "w") as f:
+            json.dump(summary, f, indent=2)
+        peak = ""
+        if summary["peak_memory_mb"] is not None:
+            peak = f", peak memory {summary['peak_memory_mb']} MB" + (" (process peak)" if summary["peak_memory_scope"] == "process" else "")
+        print(f"Metrics: {summary['calls']} calls, latency p50 {summary['latency_p50_s']}s "
+              f"p95 {summary['latency_p95_s']}s, {summary['gpu_seconds']} GPU-seconds{peak} -> {self.summary_path}")
+        return summary
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/25 11:02:39
+@author: SIRConceicao
+
+CASCADE: a cheap relation extractor first, the LLM only for the documents it is unsure of
+
+Prior_Extractor is fitted on the train gold annotations of the tagged texts. For every
+candidate pair of relation_scoring.candidate_pairs (subject type, object type, sentence
+distance), it counts how often the annotators related the pair and with which predicate.
+On a document it keeps the pairs related at least min_probability of the time (chosen
+for the best F1 on the train documents), with their most frequent predicate. Each
+decision has a certainty: the probability of the relation times the share of its
+predicate, or the probability of no relation. The confidence of the document is the mean
+certainty of its candidates.
+
+Documents under the confidence threshold go to the BENTMistral generation of
+main_baseline_labels.py (same prompt and configs, so its cached answers are reused). The
+others keep the extracted relations, as do the routed documents whose answer does not
+parse or was cut at max_new_tokens. These fallbacks are listed in the .LOGS and counted
+in the report.
+
+With --dev, the cascade runs on the tagged dev set with the LLM answer of every document,
+and misc/evaluate.py gives the 6.3/6.4 F1 and the LLM calls avoided at several thresholds,
+from "extractor only" to "LLM only".
+'''
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import json
+import tempfile
+import argparse
+from collections import Counter,defaultdict
+from prompts.qwen_prompts import system_prompts
+from misc.utils import defined_relations,format_defined_relations,legal_label_pairs,legal_predicates,normalize_label
+import llms_class
+from call_metrics import Metrics_Log
+from budget_estimator import Budget_Estimator,log_block
+from constrained_decoding import LEGAL_ENTITY_LABELS,LEGAL_RELATION_LABELS
+from main_baseline_labels import messages_format
+from relation_scoring import candidate_pairs
+from joint_ner_re import tag_relations,MENTION_KEYS
+
+PREDICTED_KEYS=('ternary_tag_based_relations_predicted','ternary_mention_based_relations_predicted')
+TRAIN_PATH="data/GutBrainIE_tagged/Annotations/Train/train_gold_tagged.json"
+#misc/evaluate.py opens ../Annotations/Dev/json_format/dev.json, from a folder next to Annotations
+EVALUATE_DIR="data/GutBrainIE_Full_Collection_2025/Articles"
+SWEEP=(0.0,0.8,0.85,0.88,0.9,0.92,0.95,1.01)
+#==================================================================================================
+def load_data(doc_path):
+    with open(doc_path, 'r') as file:
+        data = json.load(file)
+    return data
+
+def tagged_text(doc):
+    meta = doc.get('metadata', doc)
+    return meta['title_tagged'] + "\n " + meta['abstract_tagged']
+
+def pair_key(relation):
+    return (relation["subject_text_span"].lower(),normalize_label(relation["subject_label"]),
+            relation["object_text_span"].lower(),normalize_label(relation["object_label"]))
+#==================================================================================================
+class Prior_Extractor:
+    """Relations of the candidate pairs from how often the annotations relate their type pair
+    at the same sentence distance."""
+    def __init__(self, predicates, max_sentence_distance=1):
+        self.predicates = predicates
+        self.max_sentence_distance = max_sentence_distance
+        self.counts = defaultdict(lambda: [0, Counter()])  #feature -> [candidates, predicates of the related ones]
+        self.min_probability = 0.5
+
+    def feature(self, candidate, distance):
+        return (normalize_label(candidate["subject_label"]), normalize_label(candidate["object_label"]), distance)
+
+    def fit(self, docs):
+        """Count the candidates of the annotated documents, then pick min_probability."""
+        for doc in docs.values():
+            gold = defaultdict(Counter)
+            for relation in doc['relations']:
+                gold[pair_key(relation)][relation['predicate']] += 1
+            for candidate, _, distance in candidate_pairs(tagged_text(doc), self.predicates, self.max_sentence_distance):
+                counts = self.counts[self.feature(candidate, distance)]
+                counts[0] += 1
+                if pair_key(candidate) in gold:
+                    counts[1][gold[pair_key(candidate)].most_common(1)[0][0]] += 1
+
+        best = None
+        for min_probability in [k / 20 for k in range(1, 11)]:
+            self.min_probability = min_probability
+            f1 = micro_f1({pmid: self.extract(tagged_text(doc))[0] for pmid, doc in docs.items()}, docs)
+            if best is None or f1 > best[0]:
+                best = (f1, min_probability)
+        self.min_probability = best[1]
+        return best[0]
+
+    def probability(self, candidate, distance):
+        """(probability of a relation, predicate counts) of a candidate, with add-one smoothing."""
+        candidates, predicates = self.counts.get(self.feature(candidate, distance), (0, Counter()))
+        return (sum(predicates.values()) + 1) / (candidates + 2), predicates
+
+    def extract(self, text):
+        """(mention relations, confidence) of a tagged text."""
+        relations, certainties = [], []
+        for candidate, legal, distance in candidate_pairs(text, self.predicates, self.max_sentence_distance):
+            probability, predicates = self.probability(candidate, distance)
+            if predicates and probability >= self.min_probability:
+                predicate, count = predicates.most_common(1)[0]
+                relations.append({"subject_text_span": candidate["subject_text_span"], "subject_label": candidate["subject_label"],
+                                  "predicate": predicate,
+                                  "object_text_span": candidate["object_text_span"], "object_label": candidate["object_label"]})
+                certainties.append(probability * count / sum(predicates.values()))
+            else:
+                certainties.append(1 - probability)
+        return relations, sum(certainties) / len(certainties) if certainties else 1.0
+
+def micro_f1(predicted, docs):
+    """Micro F1 of the mention relations against the 'relations' of the annotated documents."""
+    tp = n_predicted = n_gold = 0
+    for pmid, relations in predicted.items():
+        keys = {pair_key(relation) + (relation["predicate"],) for relation in relations}
+        gold = {pair_key(relation) + (relation["predicate"],) for relation in docs[pmid]['relations']}
+        tp += len(keys & gold)
+        n_predicted += len(keys)
+        n_gold += len(gold)
+    precision = tp / n_predicted if n_predicted else 0.0
+    recall = tp / n_gold if n_gold else 0.0
+    return 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+#==================================================================================================
+def parse_answer(content):
+    """Mention relations of a BENTMistral answer, None when it does not parse."""
+    try:
+        answer = json.loads(content)
+        if isinstance(answer, list):
+            answer = answer[0]
+        relations = answer['ternary_mention_based_relations']
+    except (json.decoder.JSONDecodeError, KeyError, TypeError, IndexError):
+        return None
+    if not isinstance(relations, list):
+        return None
+    return [{key: relation[key] for key in MENTION_KEYS} for relation in relations
+            if isinstance(relation, dict) and all(isinstance(relation.get(key), str) for key in MENTION_KEYS)]
+
+def legal_relations(relations):
+    """The relations misc/evaluate.py accepts."""
+    return [relation for relation in relations
+            if relation["subject_label"] in LEGAL_ENTITY_LABELS and relation["object_label"] in LEGAL_ENTITY_LABELS
+            and relation["predicate"] in LEGAL_RELATION_LABELS]
+
+def route(confidences, threshold):
+    return {pmid for pmid, confidence in confidences.items() if confidence < threshold}
+
+def fallback_reason(relations, call):
+    """Why the LLM answer of a routed document is not used, None when it is."""
+    if call.get("stop_reason") == "max_new_tokens":
+        return "answer cut at max_new_tokens"
+    if call.get("stop_reason") == "oom":
+        return "prompt out of memory"
+    if relations is None:
+        return "answer did not parse"
+    return None
+
+def cascade_relations(extracted, llm_relations, routed):
+    """The LLM relations of the routed documents whose answer is used, the extracted ones otherwise."""
+    return {pmid: llm_relations[pmid] if pmid in routed and pmid in llm_relations else relations
+            for pmid, relations in extracted.items()}
+#==================================================================================================
+def load_evaluator():
+    """misc/evaluate.py, which reads the dev ground truth when it is imported."""
+    cwd = os.getcwd()
+    os.chdir(EVALUATE_DIR)
+    try:
+        from misc import evaluate
+    finally:
+        os.chdir(cwd)
+    return evaluate
+
+def evaluate_relations(evaluate, relations):
+    """(6.3 micro-F1, 6.4 micro-F1) of {pmid: mention relations}."""
+    submission = {pmid: {"ternary_tag_based_relations": tag_relations(legal_relations(doc_relations)),
+                         "ternary_mention_based_relations": legal_relations(doc_relations)}
+                  for pmid, doc_relations in relations.items()}
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as file:
+        json.dump(submission, file)
+    try:
+        tag_f1 = evaluate.eval_submission_6_3_ternary_tag_RE(file.name)[5]
+        mention_f1 = evaluate.eval_submission_6_4_ternary_mention_RE(file.name)[5]
+    finally:
+        os.remove(file.name)
+    return tag_f1, mention_f1
+
+def tradeoff_report(evaluate, extracted, llm_relations, confidences):
+    """F1 and LLM calls at the SWEEP thresholds. Fallbacks: routed documents whose answer was
+    not used."""
+    lines = [f"{'threshold':>10}{'LLM docs':>10}{'avoided':>9}{'fallbacks':>11}{'6.3 F1':>9}{'6.4 F1':>9}"]
+    for threshold in SWEEP:
+        routed = route(confidences, threshold)
+        tag_f1, mention_f1 = evaluate_relations(evaluate, cascade_relations(extracted, llm_relations, routed))
+        name = {SWEEP[0]: " (extractor only)", SWEEP[-1]: " (LLM only)"}.get(threshold, "")
+        lines.append(f"{threshold:>10}{len(routed):>10}{1 - len(routed) / len(confidences):>9.1%}"
+                     f"{len(routed - set(llm_relations)):>11}{tag_f1:>9.4f}{mention_f1:>9.4f}{name}")
+    return "\n".join(lines)
+#==================================================================================================
+def parse_args():
+    parser = argparse.ArgumentParser(description="Cascade: cheap relation extractor, LLM for the unsure documents")
+    parser.add_argument("--threshold", type=float, default=0.9, help="documents with a lower extractor confidence go to the LLM")
+    parser.add_argument("--max-sentence-distance", type=int, default=1, help="sentences between the two mentions of a candidate pair")
+    parser.add_argument("--dev", action="store_true", help="run the tagged dev set and report the F1 / LLM calls trade-off with misc/evaluate.py")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the LLM response cache")
+    parser.add_argument("--refresh", action="store_true", help="Regenerate every answer and overwrite the cached responses")
+    parser.add_argument("--model", default="mistralai/Mistral-7B-Instruct-v0.3", help="Hugging Face model name or local checkpoint")
+    parser.add_argument("--device", default="auto", help="auto, cuda, cuda:N or cpu")
+    parser.add_argument("--num-threads", type=int, default=None, help="torch threads of this process")
+    parser.add_argument("--engine", default="static", choices=["static", "continuous"], help="static batches or continuous batching (see continuous_batching.py)")
+    parser.add_argument("--compile", action="store_true", help="static KV cache and torch.compile'd decoding (static engine)")
+    parser.add_argument("--kv-cache-bits", type=int, choices=[0, 4, 8], default=None, help="int8/int4 KV cache, larger batches in the same memory (0: full precision)")
+    parser.add_argument("--adaptive-max-new-tokens", action="store_true", help="per-document max_new_tokens calibrated on the .LOGS of data/intermediate (longer answers are cut)")
+    parser.add_argument("--token-budget", type=int, default=None, help="group the prompts by length into batches of at most N prompt + max_new_tokens tokens (default: batches of batch_size in input order)")
+    parser.add_argument("--prefix-cache", action="store_true", help="prefill the block shared by every prompt once and reuse its KV cache in every batch")
+    parser.add_argument("--stop-on-json", action="store_true", help="stop a row as soon as its JSON answer is closed (see stopping_criteria.py)")
+    parser.add_argument("--max-repeats", type=int, default=None, help="stop a row once the same relation/entity object has been generated N times")
+    parser.add_argument("--constrained", action="store_true", help="mask the logits so the answer follows the JSON schema with the legal labels (see constrained_decoding.py)")
+    parser.add_argument("--adapter", default=None, help="LoRA adapter of the RE task (PEFT directory or hub id) on top of --model")
+    parser.add_argument("--no-worker", action="store_true", help="load the model in this process even when src/model_worker.py serves it")
+    parser.add_argument("--api-base", default=None, help="OpenAI-compatible server (e.g. http://localhost:8000/v1) serving --model, instead of loading it")
+    parser.add_argument("--prompt-lookup", type=int, default=None, help="draft N tokens by copying spans of the prompt (one sequence at a time)")
+    return parser.parse_args()
+#==================================================================================================
+def main():
+    args=parse_args()
+    doc_path = "data/GutBrainIE_tagged/Annotations/Test/lasigeBioTM_subtask6_1_NER_Mistral-7B-Instruct-v0.3_fixed_tagged.json"
+    if args.dev:
+        doc_path = "data/GutBrainIE_tagged/Annotations/Dev/dev_tagged.json"
+    data=load_data(doc_path)
+
+    #Subject->predicate->object rules
+    defined_relations_dict=defined_relations()
+    formated_rel_dict=format_defined_relations(defined_relations_dict)
+
+    #---------------------------------------------------------------------
+    #CHEAP EXTRACTOR
+    extractor=Prior_Extractor(legal_predicates(defined_relations_dict),args.max_sentence_distance)
+    train_f1=extractor.fit(load_data(TRAIN_PATH))
+    print(f"Prior extractor: {len(extractor.counts)} type pairs, min probability {extractor.min_probability}, train F1 {train_f1:.3f}")
+    extracted,confidences={},{}
+    for annot in data:
+        extracted[annot],confidences[annot]=extractor.extract(tagged_text(data[annot]))
+    #the sweep of --dev needs the LLM answer of every document
+    routed=set(data) if args.dev else route(confidences,args.threshold)
+    print(f"{len(data)-len(route(confidences,args.threshold))}/{len(data)} documents at confidence >= {args.threshold}")
+
+    #---------------------------------------------------------------------
+    #LLM CONFIGS, those of main_baseline_labels.py
+    configs={
+        "temperature":0.2,
+        "max_new_tokens":4096,
+        "quantization":True,
+        "batch_size":8,
+        "token_budget":args.token_budget,
+        "prefix_cache":args.prefix_cache,
+        "stop_on_json":"object" if args.stop_on_json else None,
+        "max_repeats":args.max_repeats,
+        "constrained_schema":"relations" if args.constrained else None,
+        "response_cache":None if args.no_cache else "data/cache/responses",
+        "refresh_cache":args.refresh,
+        "token_cache":"data/cache/tokens",
+        "device":args.device,
+        "num_threads":args.num_threads,
+        "prompt_lookup_num_tokens":args.prompt_lookup,
+        "api_base":args.api_base,
+        "engine":args.engine,
+        "compile":args.compile,
+        "kv_cache_bits":args.kv_cache_bits,
+        "adaptive_max_new_tokens":args.adaptive_max_new_tokens,
+        "adapters":{"re":args.adapter} if args.adapter else None,
+        "adapter":"re" if args.adapter else None,
+        "worker_socket":None if args.no_worker else "data/cache/model_worker.sock"
+        }
+    #---------------------------------------------------------------------
+    split="dev" if args.dev else "it"
+    output_path=f"data/intermediate/{args.model.split("/")[-1]}-cascade-{split}-outputs.json"
+    output_logs=f"data/intermediate/{args.model.split("/")[-1]}-cascade-{split}-outputs.LOGS"
+
+    llm_relations,fallbacks={},{}
+    with open(output_logs,'w') as logfile:
+        logfile.write(f"Input File {doc_path}\nThreshold {args.threshold}, min probability {extractor.min_probability}\nLLM Config:\n{configs}\n\n")
+        for annot in data:
+            logfile.write(f"{annot} confidence {confidences[annot]:.3f} {'LLM' if confidences[annot]<args.threshold else 'extractor'}\n")
+        logfile.write("\n")
+
+        records=[(annot,messages_format(system_prompts['prompt1'],formated_rel_dict,tagged_text(data[annot]))) for annot in data if annot in routed]
+        if records:
+            model_name = args.model
+            if args.api_base:
+                llm=llms_class.OpenAI_Pipeline(model_name,configs)
+            else:
+                llm=llms_class.load_pipeline(llms_class.Mistral_Pipeline,model_name,configs)
+            budgets=None
+            if configs["adaptive_max_new_tokens"]:
+                estimator=Budget_Estimator(configs["max_new_tokens"],tokenizer=getattr(llm,"tokenizer",None),
+                                         legal_pairs=legal_label_pairs(defined_relations_dict),
+                                         calibration=f"data/intermediate/{model_name.split("/")[-1]}-baseline-labels-it-outputs.json")
+                estimator.calibrate(dict(records),data)
+                budgets=[estimator.predict(data[annot]) for annot,_ in records]
+            metrics=Metrics_Log(output_path)
+            with llm:
+                for indices,outputs in llm.inference_scheduled([messages for _,messages in records],budgets=budgets):
+                    for i,output,call in zip(indices,outputs,llm.last_metrics):
+                        annot=records[i][0]
+                        content = output.split("[/INST]")[-1].strip("]</s>").strip()
+                        logfile.write(log_block(annot,records[i][1],output))
+                        relations=parse_answer(content)
+                        reason=fallback_reason(relations,call)
+                        if reason is None:
+                            llm_relations[annot]=relations
+                        else:
+                            fallbacks[annot]=reason
+                            print(f"{annot}: {reason}, keeping the extracted relations")
+                        metrics.write(annot,call)
+            metrics.close()
+        logfile.write(f"Fallbacks to the extractor: {len(fallbacks)}\n")
+        for annot,reason in fallbacks.items():
+            logfile.write(f"{annot} {reason}{'' if annot in route(confidences,args.threshold) else ' (--dev only, not routed)'}\n")
+
+    final=cascade_relations(extracted,llm_relations,route(confidences,args.threshold))
+    for annot,relations in final.items():
+        data[annot]['ternary_mention_based_relations_predicted']=relations
+        data[annot]['ternary_tag_based_relations_predicted']=tag_relations(relations)
+    with open(output_path, "w") as f:
+        json.dump(data, f, indent=2)
+
+    routed=route(confidences,args.threshold)
+    avoided=len(data)-len(routed)
+    fell_back=len(routed&set(fallbacks))
+    print(f"Cascade: {avoided}/{len(data)} documents answered by the extractor, {avoided/max(len(data),1):.1%} of the LLM calls avoided, "
+          f"{fell_back} of the {len(routed)} LLM answers not used (fell back to the extractor, see the LOGS)")
+    if args.dev:
+        print(tradeoff_report(load_evaluator(),extracted,llm_relations,confidences))
+
+#==================================================================================================
+
+if __name__ == "__main__":
+    main()
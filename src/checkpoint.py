@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/04 11:05:31
+@author: SIRConceicao
+
+Crash-safe checkpoint for the per-PMID driver loops.
+
+Every finished document is appended as one JSON line {"pmid": ..., "record": {...}}
+to a JSONL file next to the output JSON. On restart the drivers skip the PMIDs that
+are already in the file and merge the records into the final JSON. The file is
+removed once the final JSON has been written.
+'''
+import os
+import json
+import time
+#==================================================================================================
+class Checkpoint:
+    def __init__(self, output_path, fsync_every=8, fsync_seconds=30):
+        self.path = f"{os.path.splitext(output_path)[0]}.ckpt.jsonl"
+        self.fsync_every = fsync_every
+        self.fsync_seconds = fsync_seconds
+        self.file = None
+        self.pending = 0
+        self.last_sync = time.time()
+
+    def load(self):
+        """Returns {pmid: record} of finished documents, ignoring a torn last line."""
+        done = {}
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path, "r") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    continue
+                done[entry["pmid"]] = entry["record"]
+        return done
+
+    def truncate_torn_tail(self):
+        """Cut a last line without its newline (a crash mid-write), the next record would be appended to it."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as file:
+            data = file.read()
+            if data and not data.endswith(b"\n"):
+                file.truncate(data.rfind(b"\n") + 1)
+
+    def write(self, pmid, record):
+        if self.file is None:
+            self.truncate_torn_tail()
+            self.file = open(self.path, "a")
+        self.file.write(json.dumps({"pmid": pmid, "record": record}) + "\n")
+        self.file.flush()
+
+        self.pending += 1
+        if self.pending >= self.fsync_every or time.time() - self.last_sync > self.fsync_seconds:
+            self.sync()
+
+    def sync(self):
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+        self.pending = 0
+        self.last_sync = time.time()
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
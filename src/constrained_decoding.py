@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/06 09:48:12
+@author: SIRConceicao
+
+Schema-constrained decoding for the RE and NER answers.
+
+A schema is compiled into a small character-level automaton (literals, optional
+whitespace, enums of legal labels, free JSON strings, integers and arrays of
+objects). At every generation step Schema_Processor masks the logits of the tokens
+whose text the automaton of that row would reject, so the answer is always valid
+JSON with legal labels and predicates.
+
+The token texts are stored in a trie built once per tokenizer, and the mask of every
+automaton state is computed once (walking the trie) and memoized, so a step costs a
+few dictionary lookups per row.
+'''
+import torch
+from transformers import LogitsProcessor
+from stopping_criteria import token_strings
+
+# Legal labels (same as final_format_validation.py)
+LEGAL_ENTITY_LABELS = [
+    "anatomical location", "animal", "bacteria", "biomedical technique",
+    "chemical", "DDF", "dietary supplement", "drug", "food", "gene",
+    "human", "microbiome", "statistical technique"
+]
+
+LEGAL_RELATION_LABELS = [
+    "administered", "affect", "change abundance", "change effect",
+    "change expression", "compared to", "impact", "influence", "interact",
+    "is a", "is linked to", "located in", "part of", "produced by",
+    "strike", "target", "used by"
+]
+
+LIT, WS, ENUM, STR, INT, BRANCH, JUMP, END = range(8)
+MAX_WS = 16
+MAX_DIGITS = 6
+
+#==================================================================================================
+class Grammar:
+    """Character automaton, a state is (pc, sub) where sub is the progress inside instruction pc."""
+    def __init__(self):
+        self.program = []
+        self.memo = {}
+
+    #---------------------------------------------------------------------------------------------
+    # Builders
+    #---------------------------------------------------------------------------------------------
+    def emit(self, op, arg=None):
+        self.program.append([op, arg])
+        return len(self.program) - 1
+
+    def lit(self, text):
+        self.emit(LIT, text)
+
+    def ws(self):
+        self.emit(WS)
+
+    def enum(self, options):
+        self.emit(ENUM, tuple(f'"{option}"' for option in options))
+
+    def string(self):
+        self.emit(STR)
+
+    def integer(self):
+        self.emit(INT)
+
+    def obj(self, fields):
+        """fields: list of (key, builder) in output order."""
+        self.lit("{")
+        for i, (key, build) in enumerate(fields):
+            self.ws()
+            self.lit(f'"{key}"')
+            self.ws()
+            self.lit(":")
+            self.ws()
+            build()
+            self.ws()
+            if i < len(fields) - 1:
+                self.lit(",")
+        self.lit("}")
+
+    def array(self, build):
+        """[ element, element, ... ] where every element starts with "{"."""
+        self.lit("[")
+        self.ws()
+        first = self.emit(BRANCH)
+        start = len(self.program)
+        build()
+        self.ws()
+        after = self.emit(BRANCH)
+        self.lit(",")
+        self.ws()
+        self.emit(JUMP, start)
+        close = len(self.program)
+        self.lit("]")
+        self.program[first][1] = {"{": start, "]": close}
+        self.program[after][1] = {",": after + 1, "]": close}
+
+    def sequence(self, build):
+        """element, element, ... without brackets (the NER answers)."""
+        start = len(self.program)
+        build()
+        self.ws()
+        after = self.emit(BRANCH)
+        self.lit(",")
+        self.ws()
+        self.emit(JUMP, start)
+        end = self.emit(END)
+        self.program[after][1] = {",": after + 1}
+        self.program[after].append(end)
+
+    def end(self):
+        self.ws()
+        self.emit(END)
+
+    #---------------------------------------------------------------------------------------------
+    # Automaton
+    #---------------------------------------------------------------------------------------------
+    def advance(self, state, ch):
+        key = (state, ch)
+        if key not in self.memo:
+            self.memo[key] = self._advance(state, ch)
+        return self.memo[key]
+
+    def _advance(self, state, ch):
+        pc, sub = state
+        while True:
+            op, arg = self.program[pc][:2]
+            if op == LIT:
+                if ch != arg[sub]:
+                    return None
+                return (pc + 1, 0) if sub + 1 == len(arg) else (pc, sub + 1)
+
+            elif op == WS:
+                if ch in " \n\t\r":
+                    return (pc, sub + 1) if sub < MAX_WS else None
+                pc, sub = pc + 1, 0
+
+            elif op == ENUM:
+                prefix = (sub or "") + ch
+                if prefix in arg:
+                    return (pc + 1, 0)
+                return (pc, prefix) if any(option.startswith(prefix) for option in arg) else None
+
+            elif op == STR:
+                #0 before the opening quote, 1 inside, 2 after a backslash
+                if sub == 0:
+                    return (pc, 1) if ch == '"' else None
+                if sub == 2:
+                    return (pc, 1) if ch in '"\\/bfnrtu' else None
+                if ch == '"':
+                    return (pc + 1, 0)
+                if ch == "\\":
+                    return (pc, 2)
+                return (pc, 1) if ch >= " " else None
+
+            elif op == INT:
+                if ch in "0123456789":
+                    return (pc, sub + 1) if sub < MAX_DIGITS else None
+                if sub == 0:
+                    return None
+                pc, sub = pc + 1, 0
+
+            elif op == BRANCH:
+                if ch not in arg:
+                    return None
+                pc, sub = arg[ch], 0
+
+            elif op == JUMP:
+                pc, sub = arg, 0
+
+            else:
+                return None
+
+    def finished(self, state):
+        """True if the answer may end here (only whitespace or END left)."""
+        pc, sub = state
+        while True:
+            op, arg = self.program[pc][:2]
+            if op == WS:
+                pc = pc + 1
+            elif op == JUMP:
+                pc = arg
+            elif op == BRANCH and len(self.program[pc]) > 2:
+                #sequence: the answer may end instead of taking a ","
+                pc = self.program[pc][2]
+            else:
+                return op == END
+
+#==================================================================================================
+def relations_grammar(outter_labels=True):
+    """{"ternary_tag_based_relations": [...], "ternary_mention_based_relations": [...]}"""
+    grammar = Grammar()
+    entity = lambda: grammar.enum(LEGAL_ENTITY_LABELS)
+    predicate = lambda: grammar.enum(LEGAL_RELATION_LABELS)
+
+    tag_fields = [("subject_label", entity), ("predicate", predicate), ("object_label", entity)]
+    mention_fields = [("subject_text_span", grammar.string)]
+    if outter_labels:
+        mention_fields.append(("subject_outter_label", grammar.string))
+    mention_fields += [("subject_label", entity), ("predicate", predicate), ("object_text_span", grammar.string)]
+    if outter_labels:
+        mention_fields.append(("object_outter_label", grammar.string))
+    mention_fields.append(("object_label", entity))
+
+    grammar.ws()
+    grammar.obj([("ternary_tag_based_relations", lambda: grammar.array(lambda: grammar.obj(tag_fields))),
+                 ("ternary_mention_based_relations", lambda: grammar.array(lambda: grammar.obj(mention_fields)))])
+    grammar.end()
+    return grammar
+
+def entities_grammar():
+    """{"start_idx": .., "end_idx": .., "location": .., "text_span": .., "label": ..}, {...}"""
+    grammar = Grammar()
+    fields = [("start_idx", grammar.integer),
+              ("end_idx", grammar.integer),
+              ("location", lambda: grammar.enum(["title", "abstract"])),
+              ("text_span", grammar.string),
+              ("label", lambda: grammar.enum(LEGAL_ENTITY_LABELS))]
+    grammar.ws()
+    grammar.sequence(lambda: grammar.obj(fields))
+    return grammar
+
+def joint_grammar():
+    """{"entities": [{"text_span": .., "label": ..}], "ternary_mention_based_relations": [...]}"""
+    grammar = Grammar()
+    entity = lambda: grammar.enum(LEGAL_ENTITY_LABELS)
+    entity_fields = [("text_span", grammar.string), ("label", entity)]
+    mention_fields = [("subject_text_span", grammar.string), ("subject_label", entity),
+                      ("predicate", lambda: grammar.enum(LEGAL_RELATION_LABELS)),
+                      ("object_text_span", grammar.string), ("object_label", entity)]
+    grammar.ws()
+    grammar.obj([("entities", lambda: grammar.array(lambda: grammar.obj(entity_fields))),
+                 ("ternary_mention_based_relations", lambda: grammar.array(lambda: grammar.obj(mention_fields)))])
+    grammar.end()
+    return grammar
+
+SCHEMAS = {
+    "relations": lambda: relations_grammar(outter_labels=True),      # prompts/qwen_prompts.py
+    "relations_llama": lambda: relations_grammar(outter_labels=False),  # prompts/llama_prompts.py
+    "entities": entities_grammar,                                     # NER drivers
+    "joint": joint_grammar,                                           # joint_ner_re.py
+}
+
+#==================================================================================================
+_TRIES = {}
+_COMPILED = {}
+
+def token_trie(tokenizer):
+    """Trie of token texts, node = {char: child, None: [token ids ending here]}."""
+    key = (tokenizer.name_or_path, len(tokenizer))
+    if key not in _TRIES:
+        root = {}
+        for token_id, text in enumerate(token_strings(tokenizer)):
+            if not text:
+                continue
+            node = root
+            for ch in text:
+                node = node.setdefault(ch, {})
+            node.setdefault(None, []).append(token_id)
+        _TRIES[key] = root
+    return _TRIES[key]
+
+class Compiled_Schema:
+    """Grammar + token trie of one tokenizer, with the allowed token mask of every visited state."""
+    def __init__(self, grammar, trie, vocab_size, eos_ids):
+        self.grammar = grammar
+        self.trie = trie
+        self.vocab_size = vocab_size
+        self.eos_ids = list(eos_ids)
+        self.masks = {}
+
+    def allowed_ids(self, state):
+        ids = []
+        stack = [(child, self.grammar.advance(state, ch)) for ch, child in self.trie.items() if ch is not None]
+        while stack:
+            node, next_state = stack.pop()
+            if next_state is None:
+                continue
+            ids.extend(node.get(None, ()))
+            stack.extend((child, self.grammar.advance(next_state, ch)) for ch, child in node.items() if ch is not None)
+        if self.grammar.finished(state):
+            ids.extend(self.eos_ids)
+        return ids
+
+    def mask(self, state, device):
+        if state not in self.masks:
+            mask = torch.zeros(self.vocab_size, dtype=torch.bool)
+            mask[torch.tensor([i for i in self.allowed_ids(state) if i < self.vocab_size], dtype=torch.long)] = True
+            self.masks[state] = mask.to(device)
+        return self.masks[state]
+
+    def feed(self, state, text):
+        for ch in text:
+            if state is None:
+                break
+            state = self.grammar.advance(state, ch)
+        return state
+
+def compile_schema(tokenizer, schema, vocab_size, eos_ids):
+    """Compiled once per (tokenizer, schema) and shared by every batch of the run."""
+    key = (tokenizer.name_or_path, len(tokenizer), schema, vocab_size)
+    if key not in _COMPILED:
+        _COMPILED[key] = Compiled_Schema(SCHEMAS[schema](), token_trie(tokenizer), vocab_size, eos_ids)
+    return _COMPILED[key]
+
+#==================================================================================================
+class Schema_Processor(LogitsProcessor):
+    """Masks, row by row, the tokens that would leave the schema."""
+    def __init__(self, compiled, strings, prompt_len, batch_size):
+        self.compiled = compiled
+        self.strings = strings
+        self.prompt_len = prompt_len
+        self.eos_ids = set(compiled.eos_ids)
+        #per row: generated tokens seen so far and the automaton state after each of them
+        self.tokens = [[] for _ in range(batch_size)]
+        self.states = [[(0, 0)] for _ in range(batch_size)]
+
+    def sync(self, i, row):
+        """Bring row i to the generated tokens in row. Assisted decoding scores candidate
+        tokens that can be rejected, so the sequence does not only grow."""
+        tokens, states = self.tokens[i], self.states[i]
+        common = min(len(tokens), len(row))
+        if tokens[:common] != row[:common]:
+            common = next(k for k in range(common) if tokens[k] != row[k])
+        del tokens[common:]
+        del states[common + 1:]
+
+        for token in row[common:]:
+            state = states[-1]
+            if state is not None:
+                #finished row (eos then padding) or a token that left the schema: stop constraining
+                state = None if token in self.eos_ids else self.compiled.feed(state, self.strings[token])
+            tokens.append(token)
+            states.append(state)
+        return states[-1]
+
+    def __call__(self, input_ids, scores):
+        masks = []
+        for i, row in enumerate(input_ids[:, self.prompt_len:].tolist()):
+            state = self.sync(i, row)
+            if state is None:
+                masks.append(torch.ones(scores.shape[-1], dtype=torch.bool, device=scores.device))
+            else:
+                masks.append(self.compiled.mask(state, scores.device))
+        return scores.masked_fill(~torch.stack(masks), -float("inf"))
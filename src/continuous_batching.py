@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/16 14:05:22
+@author: SIRConceicao
+
+Continuous batching engine of the LLM pipelines (configs["engine"] = "continuous").
+
+With static batching a batch lasts as long as its longest answer, so the rows that
+stop after a few relations sit idle behind one that runs into max_new_tokens. Here
+the decode loop is run by hand on up to configs["batch_size"] rows sharing one
+DynamicCache. Every configs["admit_every"] decode steps (or as soon as every row has
+finished) the finished rows are evicted from the cache and the next prompts of the
+queue are prefilled together and merged into the freed slots.
+
+All the rows are left padded in the cache: the shorter of the running cache and the
+prefilled one is padded on the left before both are concatenated along the batch,
+and each row keeps its own position ids. The columns that are padding in every row
+are dropped after an eviction.
+
+Same decoding as Base_Pipeline.run_generate: the sampling parameters of
+generation_kwargs, the JSON stopping criteria and the constrained schema, row by row.
+Prefix cache, speculative decoding and OOM recovery are only used by the static engine.
+'''
+import time
+import torch
+import torch.nn.functional as F
+from collections import deque
+from transformers import DynamicCache, TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+from transformers.cache_utils import DynamicSlidingWindowLayer
+from stopping_criteria import Json_Stop, token_strings
+from constrained_decoding import Schema_Processor, compile_schema
+from call_metrics import call_record
+from devices import reset_peak_memory, peak_memory_mb, peak_memory_scope
+
+#==================================================================================================
+def left_pad(tensor, length, dim, value=0):
+    """Pad dimension dim of tensor on the left up to length."""
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    pad = [0, 0] * (tensor.dim() - 1 - dim % tensor.dim()) + [missing, 0]
+    return F.pad(tensor, pad, value=value)
+
+def merge_caches(cache, mask, new_cache, new_mask):
+    """Rows of new_cache appended to cache, both left padded to the longest of the two."""
+    length = max(mask.shape[1], new_mask.shape[1])
+    for layer, new_layer in zip(cache.layers, new_cache.layers):
+        layer.keys = torch.cat([left_pad(layer.keys, length, 2), left_pad(new_layer.keys, length, 2)])
+        layer.values = torch.cat([left_pad(layer.values, length, 2), left_pad(new_layer.values, length, 2)])
+    return torch.cat([left_pad(mask, length, 1), left_pad(new_mask, length, 1)])
+
+def drop_padding_columns(cache, mask):
+    """Remove the leading columns that are padding in every row."""
+    first = int(mask.any(dim=0).nonzero()[0])
+    if first:
+        for layer in cache.layers:
+            layer.keys = layer.keys[:, :, first:]
+            layer.values = layer.values[:, :, first:]
+    return mask[:, first:]
+
+#==================================================================================================
+class Row:
+    """One prompt in the engine: its generated tokens, stopping and schema state and timings."""
+    def __init__(self, index, prompt_len, max_new_tokens, json_stop, schema):
+        self.index = index
+        self.prompt_len = prompt_len
+        self.max_new_tokens = max_new_tokens
+        self.json_stop = json_stop
+        self.schema = schema
+        self.tokens = []
+        self.reason = None
+        self.start = time.time()
+        self.first_logits = None
+        self.end = None
+        self.gpu_seconds = 0.0
+
+#==================================================================================================
+class Continuous_Batcher:
+    def __init__(self, pipeline, slots, admit_every=8):
+        self.pipeline = pipeline
+        self.model = pipeline.model
+        self.slots = slots
+        self.admit_every = admit_every
+        self.configs = pipeline.configs
+
+        kwargs = pipeline.generation_kwargs()
+        generation_config = self.model.generation_config
+        self.max_new_tokens = kwargs.get("max_new_tokens", self.configs["max_new_tokens"])
+        self.eos = pipeline.eos_ids(kwargs)
+        self.pad_id = kwargs.get("pad_token_id", pipeline.tokenizer.pad_token_id)
+        self.do_sample = kwargs.get("do_sample", generation_config.do_sample)
+        self.warpers = []
+        if self.do_sample:
+            temperature = kwargs.get("temperature", generation_config.temperature)
+            top_k = kwargs.get("top_k", generation_config.top_k)
+            top_p = kwargs.get("top_p", generation_config.top_p)
+            if temperature is not None and temperature != 1.0:
+                self.warpers.append(TemperatureLogitsWarper(temperature))
+            if top_k:
+                self.warpers.append(TopKLogitsWarper(top_k))
+            if top_p is not None and top_p < 1.0:
+                self.warpers.append(TopPLogitsWarper(top_p))
+
+        self.strings = token_strings(pipeline.tokenizer)
+        self.compiled = None
+        if self.configs.get("constrained_schema"):
+            self.compiled = compile_schema(pipeline.tokenizer, self.configs["constrained_schema"],
+                                           self.model.config.vocab_size, self.eos)
+        self.steps = 0
+        self.admissions = 0
+
+    def new_row(self, index, prompt_len, max_new_tokens):
+        json_stop = None
+        if self.configs.get("stop_on_json") or self.configs.get("max_repeats"):
+            json_stop = Json_Stop(self.strings, 0, 1, mode=self.configs.get("stop_on_json"),
+                                  max_repeats=self.configs.get("max_repeats"))
+        schema = Schema_Processor(self.compiled, self.strings, 0, 1) if self.compiled is not None else None
+        return Row(index, prompt_len, min(max_new_tokens, self.max_new_tokens), json_stop, schema)
+
+    #---------------------------------------------------------------------------------------
+    def next_tokens(self, rows, logits):
+        """Constrain, warp and sample the next token of every row from the last logits."""
+        scores = logits.float()
+        for i, row in enumerate(rows):
+            if row.schema is not None and row.reason is None:
+                scores[i:i + 1] = row.schema(torch.tensor([row.tokens], dtype=torch.long), scores[i:i + 1])
+        for warper in self.warpers:
+            scores = warper(None, scores)
+        if self.do_sample:
+            return torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+        return scores.argmax(dim=-1)
+
+    def append(self, rows, tokens):
+        now = time.time()
+        for row, token in zip(rows, tokens.tolist()):
+            if row.reason is not None:
+                continue
+            row.tokens.append(token)
+            if row.first_logits is None:
+                row.first_logits = now
+            if token in self.eos:
+                row.reason = "eos"
+            elif row.json_stop is not None and bool(row.json_stop(torch.tensor([row.tokens]), None)[0]):
+                row.reason = row.json_stop.rows[0].reason
+            elif len(row.tokens) >= row.max_new_tokens:
+                row.reason = "max_new_tokens"
+            if row.reason is not None:
+                row.end = now
+
+    def share_time(self, rows, seconds):
+        """Split the device time of a forward among the rows still generating."""
+        active = [row for row in rows if row.reason is None] or rows
+        for row in active:
+            row.gpu_seconds += seconds / len(active)
+
+    #---------------------------------------------------------------------------------------
+    @torch.no_grad()
+    def prefill(self, prompts):
+        """Left padded forward of new prompts, returns (cache, mask, positions, last logits)."""
+        inputs = self.pipeline.tokenizer.pad({"input_ids": prompts}, padding=True, return_tensors="pt").to(self.model.device)
+        mask = inputs["attention_mask"]
+        position_ids = (mask.cumsum(-1) - 1).clamp(min=0)
+        cache = DynamicCache(config=self.model.config)
+        outputs = self.model(input_ids=inputs["input_ids"], attention_mask=mask, position_ids=position_ids,
+                             past_key_values=cache, use_cache=True, logits_to_keep=1)
+        if any(isinstance(layer, DynamicSlidingWindowLayer) for layer in outputs.past_key_values.layers):
+            raise ValueError("The continuous batching engine needs a model without sliding window attention")
+        return outputs.past_key_values, mask, position_ids[:, -1] + 1, outputs.logits[:, -1, :]
+
+    @torch.no_grad()
+    def decode_step(self, cache, mask, positions, last_tokens):
+        mask = torch.cat([mask, torch.ones_like(mask[:, :1])], dim=1)
+        outputs = self.model(input_ids=last_tokens[:, None], attention_mask=mask, position_ids=positions[:, None],
+                             past_key_values=cache, use_cache=True)
+        return outputs.past_key_values, mask, positions + 1, outputs.logits[:, -1, :]
+
+    #---------------------------------------------------------------------------------------
+    def finish(self, row, peak):
+        """Output of a finished row, updates the pipeline counters and returns (output, metrics)."""
+        pipeline = self.pipeline
+        generated = next((k + 1 for k, token in enumerate(row.tokens) if token in self.eos), len(row.tokens))
+        tokens = row.tokens
+        if row.json_stop is not None and row.json_stop.rows[0].reason is not None:
+            tokens = tokens[:row.json_stop.rows[0].keep]
+        pipeline.generated_tokens += generated
+        pipeline.stop_reasons[row.reason] += 1
+        record = call_record(row.prompt_len, generated, row.start, row.first_logits, row.end, row.reason,
+                             peak_memory_mb=peak, batch_size=self.slots, peak_memory_scope=peak_memory_scope(self.model.device))
+        record["gpu_seconds"] = round(row.gpu_seconds, 4)
+        return pipeline.decode(tokens), record
+
+    def run(self, prompts, budgets=None):
+        """Yield (indices, outputs) as the rows finish, indices point into prompts. The metrics
+        of the outputs are in pipeline.last_metrics. budgets: max_new_tokens of every prompt."""
+        device = self.model.device
+        queue = deque(range(len(prompts)))
+        rows, cache, mask, positions, last_tokens = [], None, None, None, None
+        reset_peak_memory(device)
+
+        while queue or rows:
+            #another pipeline on the same model can switch the adapter between two steps
+            self.pipeline.switch_adapter(self.configs.get("adapter"))
+            if rows and (self.steps % self.admit_every == 0 or all(row.reason is not None for row in rows)):
+                #evict the finished rows
+                finished = [row for row in rows if row.reason is not None]
+                if finished:
+                    keep = [i for i, row in enumerate(rows) if row.reason is None]
+                    peak = peak_memory_mb(device)
+                    results = [self.finish(row, peak) for row in finished]
+                    self.pipeline.last_stop_reasons = [row.reason for row in finished]
+                    self.pipeline.last_metrics = [record for _, record in results]
+                    yield [row.index for row in finished], [output for output, _ in results]
+
+                    rows = [rows[i] for i in keep]
+                    if rows:
+                        index = torch.tensor(keep, device=device)
+                        cache.batch_select_indices(index)
+                        mask, positions, last_tokens = mask[index], positions[index], last_tokens[index]
+                        mask = drop_padding_columns(cache, mask)
+                    else:
+                        cache = mask = positions = last_tokens = None
+
+            if queue and len(rows) < self.slots and (not rows or self.steps % self.admit_every == 0):
+                #admit the next prompts into the free slots
+                new_rows = [self.new_row(queue[k], len(prompts[queue[k]]), budgets[queue[k]] if budgets else self.max_new_tokens)
+                            for k in range(min(self.slots - len(rows), len(queue)))]
+                for _ in new_rows:
+                    queue.popleft()
+                start = time.time()
+                new_cache, new_mask, new_positions, logits = self.prefill([prompts[row.index] for row in new_rows])
+                new_tokens = self.next_tokens(new_rows, logits)
+                self.share_time(new_rows, time.time() - start)
+                self.append(new_rows, new_tokens)
+                self.admissions += 1
+
+                if rows:
+                    mask = merge_caches(cache, mask, new_cache, new_mask)
+                    positions = torch.cat([positions, new_positions])
+                    last_tokens = torch.cat([last_tokens, new_tokens])
+                else:
+                    cache, mask, positions, last_tokens = new_cache, new_mask, new_positions, new_tokens
+                rows += new_rows
+
+            if all(row.reason is not None for row in rows):
+                continue
+            start = time.time()
+            cache, mask, positions, logits = self.decode_step(cache, mask, positions, last_tokens)
+            last_tokens = self.next_tokens(rows, logits)
+            #finished rows keep decoding padding until the next eviction
+            last_tokens = torch.where(torch.tensor([row.reason is None for row in rows], device=device),
+                                      last_tokens, torch.full_like(last_tokens, self.pad_id))
+            self.share_time(rows, time.time() - start)
+            self.append(rows, last_tokens)
+            self.steps += 1
+
+    def report(self):
+        return f"Continuous batching: {self.slots} slots, {self.steps} decode steps, {self.admissions} admissions"
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/09 10:31:26
+@author: SIRConceicao
+
+Device and dtype selection for the LLM pipelines.
+
+configs["device"]: "auto" (cuda when available, else cpu), "cuda", "cuda:1", "cpu", ...
+configs["dtype"]: "auto" (checkpoint dtype on GPU, float32 on CPU), "bfloat16", "float16", "float32"
+configs["num_threads"]: torch intra-op threads of this process (CPU runs)
+'''
+import resource
+import torch
+
+DTYPES = {"bfloat16": torch.bfloat16, "float16": torch.float16, "float32": torch.float32}
+#==================================================================================================
+def resolve_device(device="auto"):
+    if device in (None, "auto"):
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    if device.startswith("cuda") and not torch.cuda.is_available():
+        print(f"Device {device} requested but CUDA is not available, using cpu")
+        return "cpu"
+    return device
+
+def resolve_dtype(dtype, device):
+    if dtype in (None, "auto"):
+        #half precision matmuls are slow or unsupported on most CPUs
+        return "auto" if device.startswith("cuda") else torch.float32
+    return DTYPES[dtype]
+
+def set_threads(num_threads):
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+def empty_cache(device):
+    """Release cached GPU memory, nothing to do on CPU."""
+    if str(device).startswith("cuda"):
+        torch.cuda.empty_cache()
+
+def reset_peak_memory(device):
+    if str(device).startswith("cuda"):
+        torch.cuda.reset_peak_memory_stats(device)
+
+def peak_memory_mb(device):
+    """Peak GPU memory allocated since reset_peak_memory. On CPU the peak resident memory of
+    the process since it started (ru_maxrss cannot be reset), see peak_memory_scope."""
+    if str(device).startswith("cuda"):
+        return round(torch.cuda.max_memory_allocated(device) / 1024**2, 1)
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def peak_memory_scope(device):
+    """What peak_memory_mb measures: "call" on GPU, "process" (lifetime peak) on CPU."""
+    return "call" if str(device).startswith("cuda") else "process"
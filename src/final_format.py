@@ -187,6 +187,9 @@ LEGAL_RELATION_LABELS = [
 doc_path ="data/intermediate/Mistral-7B-Instruct-v0.3-constparsing-it-outputs.json"
 output_path = "data/processed/Mistral-7B-Instruct-v0.3-constparsing-it-outputs.json"
 
+# doc_path ="data/intermediate/Mistral-7B-Instruct-v0.3-joint-ner-re-it-outputs.json"
+# output_path = "data/processed/Mistral-7B-Instruct-v0.3-joint-ner-re-it-outputs.json"
+
 data=load_data(doc_path)
 
 for annot in data:
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/21 09:31:47
+@author: SIRConceicao
+
+JOINT NER + RE in one generation
+
+The test flow is two LLM passes over every abstract: NER/ner_llm_test_baseline.py, then
+main_baseline_labels.py on the text tagged by dataset_parser.tag_test_json. Here one prompt
+(joint_prompt1) asks for the entities (text span and label, once per distinct span) and the
+mention-based relations between them, in one JSON answer (constrained schema "joint").
+
+    - subtask 6.1: every occurrence of the predicted spans in the title and abstract, with
+      the annotations' offsets (end_idx inclusive), the longest span where they overlap
+      -> data/processed/lasigeBioTM_subtask6_1_NER_<model>-joint.json
+    - subtasks 6.3/6.4: the mention relations between located entities and their distinct
+      label triples, under the *_predicted keys of final_format.py
+      -> data/intermediate/<model>-joint-ner-re-it-outputs.json
+
+At the end the tokens and GPU-seconds are compared with the metrics summaries of the two
+passes on the same model.
+'''
+import os
+import re
+import sys
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import json
+import argparse
+from prompts.qwen_prompts import system_prompts
+from misc.utils import defined_relations,format_defined_relations
+import llms_class
+from checkpoint import Checkpoint
+from parallel_runner import select_shard
+from call_metrics import Metrics_Log
+from budget_estimator import Budget_Estimator,unique_objects,log_block
+
+PREDICTED_KEYS=('entities_predicted','ternary_tag_based_relations_predicted','ternary_mention_based_relations_predicted',
+                'entities','joint_llm_output')
+MENTION_KEYS=('subject_text_span','subject_label','predicate','object_text_span','object_label')
+#==================================================================================================
+def load_data(doc_path):
+    with open(doc_path, 'r') as file:
+        data = json.load(file)
+    return data
+#==================================================================================================
+def messages_format(system_prompt,defined_relations,title,abstract):
+    """mistral and qwen format"""
+    prompt = system_prompt.format(defined_relations=defined_relations,title=title,abstract=abstract)
+
+    messages = [
+        {"role": "user", "content": prompt}
+    ]
+
+    return messages
+#==================================================================================================
+def locate_entities(title, abstract, entities):
+    """Subtask 6.1 entities: every occurrence of the predicted spans, longest span first where
+    they overlap."""
+    candidates=[]
+    for entity in unique_objects(entities):
+        span=str(entity.get("text_span","")).strip()
+        if not span:
+            continue
+        for location,text in (("title",title),("abstract",abstract)):
+            for match in re.finditer(rf"(?<!\w){re.escape(span)}(?!\w)", text, re.IGNORECASE):
+                candidates.append((location,match.start(),match.end(),match.group(0),entity["label"]))
+
+    located=[]
+    taken={"title":[],"abstract":[]}
+    for location,start,end,span,label in sorted(candidates,key=lambda c:(c[1]-c[2],c[0],c[1])):
+        if any(start<other_end and other_start<end for other_start,other_end in taken[location]):
+            continue
+        taken[location].append((start,end))
+        located.append({"start_idx":start,"end_idx":end-1,"location":location,"text_span":span,"label":label})
+    return sorted(located,key=lambda entity:(entity["location"]!="title",entity["start_idx"]))
+
+def ground_relations(relations, located):
+    """Mention relations between located entities (span and label)."""
+    known={(entity["text_span"].lower(),entity["label"]) for entity in located}
+    grounded=[]
+    for relation in unique_objects(relations):
+        if not all(isinstance(relation.get(key),str) for key in MENTION_KEYS):
+            continue
+        if (relation["subject_text_span"].lower(),relation["subject_label"]) not in known \
+                or (relation["object_text_span"].lower(),relation["object_label"]) not in known:
+            continue
+        grounded.append({key:relation[key] for key in MENTION_KEYS})
+    return grounded
+
+def tag_relations(mention_relations):
+    """Subtask 6.3 triples: the distinct labels and predicates of the mention relations."""
+    return unique_objects([{"subject_label":relation["subject_label"],"predicate":relation["predicate"],
+                            "object_label":relation["object_label"]} for relation in mention_relations])
+#==================================================================================================
+def flow_line(name, summary):
+    docs=max(summary["calls"]-summary["response_cache_hits"],1)
+    return (f"{name:<10}{summary['prompt_tokens']:>10} prompt + {summary['generated_tokens']:>8} generated tokens, "
+            f"{summary['gpu_seconds']:>8} GPU-seconds | per document {summary['prompt_tokens']/docs:.0f} + "
+            f"{summary['generated_tokens']/docs:.0f} tokens, {summary['gpu_seconds']/docs:.2f}s")
+
+def flow_report(summary, wall_seconds, model_short):
+    """Tokens and GPU-seconds of the joint run against the NER and RE passes of the same model."""
+    lines=[flow_line("joint",summary)+f" ({wall_seconds:.0f}s wall, model loading included)"]
+    passes={"NER":f"data/intermediate/{model_short}-NER-it-outputs-baseline.metrics-summary.json",
+            "RE":f"data/intermediate/{model_short}-baseline-labels-it-outputs.metrics-summary.json"}
+    summaries={}
+    for name,path in passes.items():
+        if os.path.exists(path):
+            summaries[name]=load_data(path)
+            lines.append(flow_line(name,summaries[name]))
+        else:
+            lines.append(f"{name:<10}no metrics summary {path}")
+    if len(summaries)==2:
+        docs=lambda s:max(s["calls"]-s["response_cache_hits"],1)
+        two_pass=sum(s["gpu_seconds"]/docs(s) for s in summaries.values())
+        tokens=sum((s["prompt_tokens"]+s["generated_tokens"])/docs(s) for s in summaries.values())
+        joint_docs=docs(summary)
+        lines.append(f"Joint vs two passes per document: {(summary['prompt_tokens']+summary['generated_tokens'])/joint_docs/tokens:.2f}x tokens, "
+                     f"{summary['gpu_seconds']/joint_docs/max(two_pass,1e-9):.2f}x GPU-seconds")
+    return "\n".join(lines)
+#==================================================================================================
+def parse_args():
+    parser = argparse.ArgumentParser(description="Joint NER + RE system")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the LLM response cache")
+    parser.add_argument("--refresh", action="store_true", help="Regenerate every answer and overwrite the cached responses")
+    parser.add_argument("--model", default="mistralai/Mistral-7B-Instruct-v0.3", help="Hugging Face model name or local checkpoint")
+    parser.add_argument("--device", default="auto", help="auto, cuda, cuda:N or cpu")
+    parser.add_argument("--num-threads", type=int, default=None, help="torch threads of this process")
+    parser.add_argument("--engine", default="static", choices=["static", "continuous"], help="static batches or continuous batching (see continuous_batching.py)")
+    parser.add_argument("--compile", action="store_true", help="static KV cache and torch.compile'd decoding (static engine)")
+    parser.add_argument("--kv-cache-bits", type=int, choices=[0, 4, 8], default=None, help="int8/int4 KV cache, larger batches in the same memory (0: full precision)")
+    parser.add_argument("--adaptive-max-new-tokens", action="store_true", help="per-document max_new_tokens calibrated on the .LOGS of data/intermediate (longer answers are cut)")
+    parser.add_argument("--token-budget", type=int, default=None, help="group the prompts by length into batches of at most N prompt + max_new_tokens tokens (default: batches of batch_size in input order)")
+    parser.add_argument("--prefix-cache", action="store_true", help="prefill the block shared by every prompt once and reuse its KV cache in every batch")
+    parser.add_argument("--stop-on-json", action="store_true", help="stop a row as soon as its JSON answer is closed (see stopping_criteria.py)")
+    parser.add_argument("--max-repeats", type=int, default=None, help="stop a row once the same relation/entity object has been generated N times")
+    parser.add_argument("--constrained", action="store_true", help="mask the logits so the answer follows the JSON schema with the legal labels (see constrained_decoding.py)")
+    parser.add_argument("--adapter", default=None, help="LoRA adapter of the joint task (PEFT directory or hub id) on top of --model")
+    parser.add_argument("--no-worker", action="store_true", help="load the model in this process even when src/model_worker.py serves it")
+    parser.add_argument("--api-base", default=None, help="OpenAI-compatible server (e.g. http://localhost:8000/v1) serving --model, instead of loading it")
+    parser.add_argument("--prompt-lookup", type=int, default=None, help="draft N tokens by copying spans of the prompt (one sequence at a time)")
+    parser.add_argument("--shard", default=None, help="k/N: only run the k-th of N blocks of PMIDs (see parallel_runner.py)")
+    return parser.parse_args()
+#==================================================================================================
+def main():
+    args=parse_args()
+    start=time.time()
+    doc_path = "data/GutBrainIE_Full_Collection_2025/Test_Data/Test_Data/articles_test.json"
+    data=load_data(doc_path)
+
+    #Subject->predicate->object rules
+    defined_relations_dict=defined_relations()
+    formated_rel_dict=format_defined_relations(defined_relations_dict)
+
+    #---------------------------------------------------------------------
+    #LLM CONFIGS
+    configs={
+        "temperature":0.2,
+        "max_new_tokens":4096,
+        "quantization":True,
+        "batch_size":8,
+        "token_budget":args.token_budget,
+        "prefix_cache":args.prefix_cache,
+        "stop_on_json":"object" if args.stop_on_json else None,
+        "max_repeats":args.max_repeats,
+        "constrained_schema":"joint" if args.constrained else None,
+        "response_cache":None if args.no_cache else "data/cache/responses",
+        "refresh_cache":args.refresh,
+        "token_cache":"data/cache/tokens",
+        "device":args.device,
+        "num_threads":args.num_threads,
+        "prompt_lookup_num_tokens":args.prompt_lookup,
+        "api_base":args.api_base,
+        "engine":args.engine,
+        "compile":args.compile,
+        "kv_cache_bits":args.kv_cache_bits,
+        "adaptive_max_new_tokens":args.adaptive_max_new_tokens,
+        "adapters":{"joint":args.adapter} if args.adapter else None,
+        "adapter":"joint" if args.adapter else None,
+        "worker_socket":None if args.no_worker else "data/cache/model_worker.sock"
+        }
+    #---------------------------------------------------------------------
+    #Mistral
+    model_name = args.model
+    if args.api_base:
+        llm=llms_class.OpenAI_Pipeline(model_name,configs)
+    else:
+        llm=llms_class.load_pipeline(llms_class.Mistral_Pipeline,model_name,configs)
+    system_prompt = system_prompts['joint_prompt1']
+    #---------------------------------------------------------------------
+    output_path=f"data/intermediate/{model_name.split("/")[-1]}-joint-ner-re-it-outputs.json"
+    output_logs=f"data/intermediate/{model_name.split("/")[-1]}-joint-ner-re-it-outputs.LOGS"
+    ner_output_path=f"data/processed/lasigeBioTM_subtask6_1_NER_{model_name.split("/")[-1]}-joint.json"
+    estimator=None
+    if configs["adaptive_max_new_tokens"]:
+        estimator=Budget_Estimator(configs["max_new_tokens"],tokenizer=getattr(llm,"tokenizer",None),
+                                 calibration=output_path)
+    if args.shard:
+        data,output_path,output_logs=select_shard(data,output_path,output_logs,args.shard)
+        ner_output_path=None  #an unsharded run after the merge writes it, from the response cache
+
+    checkpoint=Checkpoint(output_path)
+    done=checkpoint.load()
+    metrics=Metrics_Log(output_path,resume=bool(done))
+
+    records=[]
+    for annot in data:
+        if annot in done:
+            continue
+        jbase= data[annot]
+        records.append((annot,messages_format(system_prompt,formated_rel_dict,jbase['title'],jbase['abstract'])))
+
+    budgets=None
+    if estimator is not None and records:
+        estimator.calibrate(dict(records),data)
+        budgets=[estimator.predict(data[annot]) for annot,_ in records]
+        print(estimator.report(budgets))
+
+    with open(output_logs,'a' if done else 'w') as logfile, llm:
+        logfile.write(f"Input File {doc_path}\nLLM Config:\n{configs}\n\n")
+        if done:
+            logfile.write(f"Resumed from {checkpoint.path}: {len(done)} documents already done\n\n")
+        for indices,outputs in llm.inference_scheduled([messages for _,messages in records],budgets=budgets):
+
+            for i,output,call in zip(indices,outputs,llm.last_metrics):
+                annot=records[i][0]
+                jbase= data[annot]
+                content = output.split("[/INST]")[-1].strip("]</s>").strip()
+
+                print(content)
+                logfile.write(log_block(annot,records[i][1],output))
+
+                try:
+                    answer = json.loads(content)
+                    entities = [entity for entity in answer['entities'] if isinstance(entity,dict) and "label" in entity]
+                    relations = answer['ternary_mention_based_relations']
+                except (json.decoder.JSONDecodeError, KeyError, TypeError):
+                    print(f"eeeeerrrorr\n")
+                    jbase['joint_llm_output']=content
+                    entities, relations = [], []
+
+                jbase['entities_predicted']=entities
+                jbase['entities']=locate_entities(jbase['title'],jbase['abstract'],entities)
+                jbase['ternary_mention_based_relations_predicted']=ground_relations(relations,jbase['entities'])
+                jbase['ternary_tag_based_relations_predicted']=tag_relations(jbase['ternary_mention_based_relations_predicted'])
+
+                checkpoint.write(annot,{key:jbase[key] for key in PREDICTED_KEYS if key in jbase})
+                metrics.write(annot,call)
+
+    checkpoint.close()
+    summary=metrics.close()
+    for annot,record in done.items():
+        data[annot].update(record)
+
+    with open(output_path, "w") as f:
+        json.dump(data, f, indent=2)
+    checkpoint.remove()
+
+    if ner_output_path:
+        #subtask 6.1 format, as NER/nerout2json.py writes it
+        os.makedirs(os.path.dirname(ner_output_path), exist_ok=True)
+        ner_data={annot:{key:value for key,value in jbase.items() if key not in PREDICTED_KEYS or key=='entities'}
+                  for annot,jbase in data.items()}
+        with open(ner_output_path, "w") as f:
+            json.dump(ner_data, f, indent=2)
+    print(flow_report(summary,time.time()-start,model_name.split("/")[-1]))
+
+#==================================================================================================
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/18 10:37:15
+@author: SIRConceicao
+
+Quantized KV cache of the LLM pipelines (configs["kv_cache_bits"] = 8 or 4).
+
+With 4-bit weights and 4096 new tokens on long prompts, the keys and values of the
+cache take more memory than the model. The cache here keeps the last
+configs["kv_residual_length"] tokens of every layer in the model dtype and stores the
+older ones as int8/int4 codes, with a min and a scale per group of
+configs["kv_group_size"] values of a head vector (asymmetric round to nearest). It is
+transformers' QuantizedCache (KIVI) scheme, in plain torch: no quanto/HQQ dependency,
+CPU and GPU.
+
+Per value, int8 takes 8 bits plus the min and scale of its group
+(2 * 16 / 64 = 0.5 bit) instead of 16 bits, int4 4.5 bits: ~1.9x and ~3.6x less
+cache, so the pipelines scale the scheduler's token budget by that ratio and fit
+larger batches in the same memory.
+'''
+import torch
+from transformers.cache_utils import Cache, QuantizedLayer
+
+#==================================================================================================
+class Int_Quantized_Layer(QuantizedLayer):
+    def __init__(self, nbits=8, q_group_size=64, residual_length=128):
+        if nbits not in (4, 8):
+            raise ValueError(f"kv_cache_bits must be 8 or 4, got {nbits}")
+        super().__init__(nbits=nbits, q_group_size=q_group_size, residual_length=residual_length)
+
+    def _quantize(self, tensor, axis):
+        shape, dtype = tensor.shape, tensor.dtype
+        group = self.q_group_size if shape[-1] % self.q_group_size == 0 else shape[-1]
+        groups = tensor.float().reshape(-1, group)
+        low = groups.amin(dim=1, keepdim=True)
+        scale = (groups.amax(dim=1, keepdim=True) - low).clamp(min=1e-8) / (2**self.nbits - 1)
+        codes = ((groups - low) / scale).round_().clamp_(0, 2**self.nbits - 1).to(torch.uint8)
+        if self.nbits == 4:
+            #two codes per byte
+            codes = codes[:, 0::2] | (codes[:, 1::2] << 4)
+        scale_dtype = torch.float32 if dtype == torch.float32 else torch.float16
+        return codes, scale.to(scale_dtype), low.to(scale_dtype), shape, dtype
+
+    def _dequantize(self, q_tensor):
+        codes, scale, low, shape, dtype = q_tensor
+        if self.nbits == 4:
+            codes = torch.stack([codes & 15, codes >> 4], dim=-1).reshape(codes.shape[0], -1)
+        return (codes.float() * scale.float() + low.float()).reshape(shape).to(dtype)
+
+    def nbytes(self):
+        """(bytes stored, bytes of the same keys and values in the model dtype)"""
+        if not self.is_initialized:
+            return 0, 0
+        stored = sum(t.numel() * t.element_size() for t in (self.keys, self.values))
+        full = stored
+        for q_tensor in (self._quantized_keys, self._quantized_values):
+            if q_tensor is not None:
+                codes, scale, low, shape, dtype = q_tensor
+                stored += codes.numel() + (scale.numel() + low.numel()) * scale.element_size()
+                full += shape.numel() * dtype.itemsize
+        return stored, full
+
+class Int_Quantized_Cache(Cache):
+    def __init__(self, config, nbits=8, q_group_size=64, residual_length=128):
+        config = config.get_text_config(decoder=True)
+        super().__init__(layers=[Int_Quantized_Layer(nbits, q_group_size, residual_length)
+                                 for _ in range(config.num_hidden_layers)])
+
+    def nbytes(self):
+        sizes = [layer.nbytes() for layer in self.layers]
+        return sum(stored for stored, _ in sizes), sum(full for _, full in sizes)
+
+#==================================================================================================
+def head_dim(config):
+    config = config.get_text_config(decoder=True)
+    return getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+
+def budget_scale(config, nbits, q_group_size, dtype):
+    """How many more tokens fit in the same cache memory than in the model dtype."""
+    group = q_group_size if head_dim(config) % q_group_size == 0 else head_dim(config)
+    scale_bits = 2 * (32 if dtype == torch.float32 else 16) / group
+    return dtype.itemsize * 8 / (nbits + scale_bits)
@@ -5,45 +5,918 @@ Created on 2025/05/01 15:23:02
 @author: SIRConceicao
 '''
 import os
+import copy
+import time
+import asyncio
 import torch
+from collections import Counter
 from dotenv import load_dotenv
 from huggingface_hub import login
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, StoppingCriteriaList, LogitsProcessorList
+from transformers import StaticCache, CompileConfig
+from scheduler import Length_Scheduler
+from response_cache import Response_Cache
+from stopping_criteria import Json_Stop, Budget_Stop, token_strings
+from constrained_decoding import Schema_Processor, compile_schema
+from devices import resolve_device, resolve_dtype, set_threads, empty_cache, reset_peak_memory, peak_memory_mb, peak_memory_scope
+from token_cache import Token_Cache, tokenizer_namespace
+from openai_client import Chat_Client, FINISH_REASONS
+from call_metrics import First_Token_Timer, call_record, cached_record, http_record, oom_record, OOM_OUTPUT
+from continuous_batching import Continuous_Batcher
+from kv_quantization import Int_Quantized_Cache, budget_scale
+from model_worker import Worker_Client, worker_configs
+
+#===========================================================================================
+# ** BASE **
+#===========================================================================================
+class Base_Pipeline:
+    """Batched generation shared by all pipelines.
+
+    Subclasses define how a conversation is turned into input ids (encode),
+    the arguments passed to model.generate (generation_kwargs) and how the
+    newly generated ids are turned into the pipeline output (decode).
+    """
+    prefix_cache = None
+    prefill_tokens_saved = 0
+    response_cache = None
+    token_cache = None
+    batcher = None
+    static_caches = None
+    compile_config = None
+    compile_failed = False
+    static_calls = 0
+    static_fallbacks = 0
+    warm_up_seconds = 0.0
+    kv_stats = None
+    adapter_state = None
+    score_stats = None
+    safe_batch_size = None
+    generated_tokens = 0
+    draft_model = None
+    spec_stats = None
+    oom_retries = 0
+    oom_reduced_rows = 0
+
+    def __init__(self):
+        #lists the calls replace or extend, per pipeline (class-level lists would be shared)
+        self.prefix_ids = []
+        self.last_stop_reasons = []
+        self.last_generated_tokens = []
+        self.last_metrics = []
+        self.last_accepted_tokens = []
+
+    def setup_pipeline(self, model_name):
+        """Tokenizer and run state shared by all pipelines, called once the tokenizer is loaded."""
+        self.setup_padding()
+        self.setup_response_cache(model_name)
+        if self.configs.get("token_cache"):
+            self.token_cache = Token_Cache(self.configs["token_cache"], tokenizer_namespace(self.tokenizer))
+        self.stop_reasons = Counter()
+
+    def setup_padding(self):
+        #Decoder-only models must be left padded so every row ends at the prompt
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+    def setup_response_cache(self, model_name):
+        """On-disk cache of answers in front of generation (configs["response_cache"] = directory)."""
+        self.model_name = model_name
+        if self.configs.get("response_cache"):
+            self.response_cache = Response_Cache(self.configs["response_cache"],
+                                                 max_bytes=self.configs.get("cache_max_bytes", 2 * 1024**3),
+                                                 refresh=self.configs.get("refresh_cache", False))
+
+    def load_model(self, model_name, device_map="auto", **kwargs):
+        """Load the model on configs["device"] with configs["dtype"] (see devices.py).
+
+        4 bit quantization (configs["quantization"]) needs bitsandbytes and a CUDA device,
+        on CPU the model is loaded unquantized.
+        """
+        self.device = resolve_device(self.configs.get("device", "auto"))
+        set_threads(self.configs.get("num_threads"))
+        dtype = resolve_dtype(self.configs.get("dtype", "auto"), self.device)
+
+        if self.device.startswith("cuda"):
+            #a given GPU ("cuda:1") keeps the whole model, "cuda" uses the pipeline default
+            device_map = {"": self.device} if ":" in self.device else device_map
+            if self.configs.get("quantization"):
+                print('Quantized Model')
+                bnb_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_use_double_quant=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.bfloat16
+                )
+                return AutoModelForCausalLM.from_pretrained(model_name,
+                                                            device_map=device_map,
+                                                            quantization_config=bnb_config,
+                                                            **kwargs)
+            return AutoModelForCausalLM.from_pretrained(model_name,
+                                                        torch_dtype=dtype,
+                                                        device_map=device_map,
+                                                        **kwargs)
+
+        if self.configs.get("quantization"):
+            print(f'Quantization needs a CUDA device, loading {model_name} unquantized on {self.device}')
+            #cached answers and logs must not claim a quantized model
+            self.configs["quantization"] = False
+        model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=dtype, **kwargs)
+        return model.to(self.device)
+
+    def empty_cache(self):
+        empty_cache(self.model.device)
+
+    def encode(self, messages):
+        raise NotImplementedError
+
+    def generation_kwargs(self):
+        raise NotImplementedError
+
+    def decode(self, output_ids):
+        raise NotImplementedError
+
+    def inference(self, messages):
+        return self.inference_batch([messages], batch_size=1)[0]
+
+    def inference_batch(self, list_of_messages, batch_size=8, budgets=None):
+        """Generate for several conversations, returns outputs in input order (metrics in last_metrics)."""
+        outputs = [None] * len(list_of_messages)
+        metrics = [None] * len(list_of_messages)
+        for indices, batch_outputs in self.inference_scheduled(list_of_messages, batch_size=batch_size, budgets=budgets):
+            for i, output, record in zip(indices, batch_outputs, self.last_metrics):
+                outputs[i] = output
+                metrics[i] = record
+        self.last_metrics = metrics
+        return outputs
+
+    def encode_cached(self, messages):
+        """encode, read from the pre-tokenized prompt cache when configs["token_cache"] is set."""
+        if self.token_cache is None:
+            return self.encode(messages)
+        key = Token_Cache.key(type(self).__name__, messages)
+        input_ids = self.token_cache.get(key)
+        if input_ids is None:
+            input_ids = self.encode(messages)
+            self.token_cache.put(key, input_ids)
+        return input_ids
+
+    def inference_scheduled(self, list_of_messages, batch_size=None, budgets=None):
+        """Yield (indices, outputs) batch by batch, indices point into list_of_messages and
+        last_metrics holds the call metrics of the outputs (see call_metrics.py).
+        budgets: max_new_tokens of every conversation (budget_estimator.py), configs["max_new_tokens"]
+        for all when None."""
+        input_ids = [self.encode_cached(messages) for messages in list_of_messages]
+        if self.token_cache is not None:
+            self.token_cache.save()
+        if self.configs.get("engine") == "continuous":
+            yield from self.generate_continuous(input_ids, batch_size, budgets)
+        else:
+            batches = self.schedule(input_ids, batch_size=batch_size, budgets=budgets)
+            self.prepare_static(input_ids, batches)
+            for indices in batches:
+                yield indices, self.generate_ids([input_ids[i] for i in indices],
+                                                 [budgets[i] for i in indices] if budgets else None)
+        if len(input_ids) > 1:
+            print(self.report())
+
+    def generate_continuous(self, input_ids, batch_size=None, budgets=None):
+        """Yield (indices, outputs) as the rows of the continuous batching engine finish
+        (see continuous_batching.py), answered from the response cache when possible."""
+        missing = list(range(len(input_ids)))
+        if self.response_cache is not None:
+            keys = [Response_Cache.key(self.model_name, self.configs, self.row_decoding(budgets, i), ids) for i, ids in enumerate(input_ids)]
+            outputs = [self.response_cache.get(key) for key in keys]
+            missing = [i for i, output in enumerate(outputs) if output is None]
+            cached = [i for i, output in enumerate(outputs) if output is not None]
+            if cached:
+                self.last_metrics = [cached_record(len(input_ids[i])) for i in cached]
+                yield cached, [outputs[i] for i in cached]
+
+        self.batcher = Continuous_Batcher(self, slots=batch_size or self.configs.get("batch_size", 8),
+                                          admit_every=self.configs.get("admit_every", 8))
+        for finished, outputs in self.batcher.run([input_ids[i] for i in missing],
+                                                  [budgets[i] for i in missing] if budgets else None):
+            indices = [missing[k] for k in finished]
+            if self.response_cache is not None:
+                for i, output in zip(indices, outputs):
+                    self.response_cache.put(keys[i], output)
+            yield indices, outputs
+
+    def schedule(self, input_ids, batch_size=None, budgets=None):
+        """Split pre-tokenized prompts into batches of indices.
+
+        With configs["token_budget"] set, prompts are grouped by length and max_new_tokens
+        (see scheduler.Length_Scheduler), otherwise they are taken in input order in
+        chunks of batch_size.
+        """
+        batch_size = batch_size or self.configs.get("batch_size", 1)
+        self.prepare_prefix(input_ids)
+
+        if not self.configs.get("token_budget"):
+            return [list(range(start, min(start + batch_size, len(input_ids))))
+                    for start in range(0, len(input_ids), batch_size)]
+
+        scheduler = Length_Scheduler(self.token_budget(),
+                                     self.configs["max_new_tokens"],
+                                     bucket_size=self.configs.get("bucket_size", 128),
+                                     max_batch_size=batch_size)
+        lengths = [len(ids) for ids in input_ids]
+        batches = scheduler.schedule(lengths, budgets)
+        if len(lengths) > 1:
+            print(f"Scheduled {len(lengths)} prompts in {len(batches)} batches "
+                  f"(padding {scheduler.padding_ratio(lengths, batches):.1%})")
+        return batches
+
+    def token_budget(self):
+        """configs["token_budget"], scaled by the compression of a quantized KV cache."""
+        full_precision = ("draft_model", "prompt_lookup_num_tokens", "static_cache", "compile")
+        if self.configs.get("kv_cache_bits") and not any(self.configs.get(key) for key in full_precision):
+            return int(self.configs["token_budget"] * self.kv_budget_scale())
+        return self.configs["token_budget"]
+
+    #-------------------------------------------------------------------------------------------
+    # Prefix caching: the prompt templates share a long constant block (instructions, JSON
+    # example, defined relations) before the document. With configs["prefix_cache"] (off by
+    # default, --prefix-cache in the drivers) it is prefilled once per run and its
+    # past_key_values are expanded to every batch.
+    #-------------------------------------------------------------------------------------------
+    def prepare_prefix(self, input_ids):
+        """Prefill the longest token prefix shared by all prompts (configs["prefix_cache"])."""
+        if not self.configs.get("prefix_cache"):
+            self.prefix_ids = []
+            return
+        if len(input_ids) < 2:
+            #single prompt: keep the previous prefix, generate_ids checks that it still matches
+            return
+
+        prefix = []
+        for tokens in zip(*input_ids):
+            if any(token != tokens[0] for token in tokens):
+                break
+            prefix.append(tokens[0])
+        #keep at least one token of every prompt out of the cache
+        prefix = prefix[:min(len(ids) for ids in input_ids) - 1]
+
+        if len(prefix) < self.configs.get("min_prefix_tokens", 32):
+            self.prefix_ids = []
+            return
+        if prefix != self.prefix_ids:
+            self.prefix_ids = prefix
+            self.prefix_cache = None
+
+    def prefill_prefix(self):
+        """Run the shared prefix through the model once, on the first batch that needs it."""
+        with torch.no_grad():
+            outputs = self.model(input_ids=torch.tensor([self.prefix_ids], device=self.model.device),
+                                 use_cache=True)
+        self.prefix_cache = outputs.past_key_values
+        self.prefill_tokens_saved -= len(self.prefix_ids)
+
+    def report(self):
+        """Summary of the caches used during the run."""
+        lines = []
+        if self.token_cache is not None:
+            lines.append(self.token_cache.report())
+        if self.prefix_ids:
+            lines.append(f"Prefix cache: {len(self.prefix_ids)} shared prompt tokens, "
+                         f"{max(self.prefill_tokens_saved, 0)} prefill tokens saved")
+        if self.response_cache is not None:
+            lines.append(self.response_cache.report())
+        if self.batcher is not None:
+            lines.append(self.batcher.report())
+        if self.static_caches:
+            shapes = ", ".join(f"{rows}x{max_cache_len}" for rows, (max_cache_len, _) in sorted(self.static_caches.items()))
+            compiled = ""
+            if self.configs.get("compile"):
+                compiled = " (compile failed, eager)" if self.compile_failed else f", compiled in a {self.warm_up_seconds:.1f}s warm-up"
+            lines.append(f"Static cache: {self.static_calls} calls on {shapes}{compiled}, {self.static_fallbacks} eager fallbacks")
+        if self.stop_reasons:
+            lines.append("Stop reasons: " + ", ".join(f"{reason} {count}" for reason, count in self.stop_reasons.most_common()))
+        if self.spec_stats and self.spec_stats["calls"]:
+            stats = self.spec_stats
+            mode = "draft model" if self.configs.get("draft_model") else "prompt lookup"
+            lines.append(f"Speculative decoding ({mode}): {stats['accepted']}/{stats['drafted']} draft tokens accepted "
+                         f"({self.acceptance_rate():.1%}), {stats['accepted'] / stats['calls']:.1f} per call, "
+                         f"{stats['generated'] / max(stats['forwards'], 1):.2f} tokens per target forward")
+        if self.kv_stats and self.kv_stats["calls"]:
+            lines.append(self.kv_report())
+        if self.score_stats and self.score_stats["calls"]:
+            lines.append(self.score_report())
+        if self.adapter_state and self.adapter_state["loaded"]:
+            state = self.adapter_state
+            lines.append(f"Adapters: {', '.join(state['loaded'])} on one base model, "
+                         f"{state['switches']} switches in {state['seconds']:.2f}s")
+        if self.oom_retries:
+            lines.append(f"Out of memory: {self.oom_retries} retries, safe batch size {self.safe_batch_size}, "
+                         f"{self.oom_reduced_rows} rows with lowered max_new_tokens")
+        return "\n".join(lines)
+
+    #the drivers run their generation loop in `with pipeline:`, the HTTP client (OpenAI_Pipeline)
+    #and the model worker connection (Worker_Pipeline) are closed when it ends, crash or not
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def row_decoding(self, budgets, i):
+        """Decoding arguments of the i-th prompt in the response cache key."""
+        decoding = self.generation_kwargs()
+        if budgets:
+            decoding["max_tokens" if "max_tokens" in decoding else "max_new_tokens"] = budgets[i]
+        return decoding
+
+    def generate_ids(self, batch_ids, budgets=None):
+        """Outputs for a list of input ids, answered from the response cache when possible."""
+        if self.response_cache is None:
+            return self.generate_adaptive(batch_ids, budgets=budgets)[0]
+
+        keys = [Response_Cache.key(self.model_name, self.configs, self.row_decoding(budgets, i), ids) for i, ids in enumerate(batch_ids)]
+        outputs = [self.response_cache.get(key) for key in keys]
+        metrics = [cached_record(len(ids)) for ids in batch_ids]
+
+        missing = [i for i, output in enumerate(outputs) if output is None]
+        if missing:
+            generated, reduced = self.generate_adaptive([batch_ids[i] for i in missing],
+                                                        budgets=[budgets[i] for i in missing] if budgets else None)
+            for i, output, was_reduced, record in zip(missing, generated, reduced, self.last_metrics):
+                outputs[i] = output
+                metrics[i] = record
+                #answers cut by a lowered max_new_tokens are not what the configs ask for
+                if not was_reduced:
+                    self.response_cache.put(keys[i], output)
+        self.last_metrics = metrics
+        return outputs
+
+    #-------------------------------------------------------------------------------------------
+    # Memory: a batch that runs out of GPU memory is split in halves and retried, and the
+    # largest batch size that failed caps the following batches. A single prompt that still
+    # does not fit is retried with half the max_new_tokens, down to
+    # configs["oom_min_new_tokens"], and then answered OOM_OUTPUT with stop_reason "oom" so
+    # the run goes on. Cached memory is released only after an OOM.
+    #-------------------------------------------------------------------------------------------
+    def generate_adaptive(self, batch_ids, max_new_tokens=None, budgets=None):
+        """run_generate with OOM recovery, returns (outputs, reduced) where reduced flags the
+        rows generated with a lowered max_new_tokens."""
+        if self.safe_batch_size and len(batch_ids) > self.safe_batch_size:
+            #a chunk can lower safe_batch_size again, the next chunks are split by their own call
+            size = self.safe_batch_size
+            outputs, reduced, metrics = [], [], []
+            for start in range(0, len(batch_ids), size):
+                chunk_outputs, chunk_reduced = self.generate_adaptive(batch_ids[start:start + size], max_new_tokens,
+                                                                      budgets[start:start + size] if budgets else None)
+                outputs += chunk_outputs
+                reduced += chunk_reduced
+                metrics += self.last_metrics
+            self.last_metrics = metrics
+            return outputs, reduced
+
+        try:
+            return self.run_generate(batch_ids, max_new_tokens, budgets), [max_new_tokens is not None] * len(batch_ids)
+        except torch.OutOfMemoryError:
+            pass
+        #retry outside the except block so the failed batch tensors can be freed
+        self.oom_retries += 1
+        self.empty_cache()
+
+        if len(batch_ids) > 1:
+            self.safe_batch_size = len(batch_ids) // 2
+            print(f"Out of memory with {len(batch_ids)} prompts, batch size lowered to {self.safe_batch_size}")
+            return self.generate_adaptive(batch_ids, max_new_tokens, budgets)
+
+        if max_new_tokens is None:
+            max_new_tokens = budgets[0] if budgets else self.configs["max_new_tokens"]
+            self.oom_reduced_rows += 1
+        max_new_tokens //= 2
+        if max_new_tokens < self.configs.get("oom_min_new_tokens", 256):
+            #given up: the row gets the marker output and is never cached, the run goes on
+            print(f"A single prompt of {len(batch_ids[0])} tokens does not fit in memory, answered {OOM_OUTPUT}")
+            self.stop_reasons["oom"] += 1
+            self.last_metrics = [oom_record(len(batch_ids[0]))]
+            return [OOM_OUTPUT], [True]
+        print(f"Out of memory with a single prompt of {len(batch_ids[0])} tokens, retrying with max_new_tokens={max_new_tokens}")
+        return self.generate_adaptive(batch_ids, max_new_tokens)
+
+    def run_generate(self, batch_ids, max_new_tokens=None, budgets=None):
+        """Left pad a list of input ids, generate and decode only the new tokens of each row.
+        budgets: max_new_tokens of every row, capped by max_new_tokens."""
+        self.switch_adapter(self.configs.get("adapter"))
+        speculative = self.speculative_kwargs()
+        if speculative and len(batch_ids) > 1:
+            #speculative decoding runs one sequence at a time
+            outputs, reasons, accepted, metrics = [], [], [], []
+            for k, ids in enumerate(batch_ids):
+                outputs += self.run_generate([ids], max_new_tokens, [budgets[k]] if budgets else None)
+                reasons += self.last_stop_reasons
+                accepted += self.last_accepted_tokens
+                metrics += self.last_metrics
+            self.last_stop_reasons = reasons
+            self.last_accepted_tokens = accepted
+            self.last_metrics = metrics
+            return outputs
+
+        if budgets:
+            budgets = [min(budget, max_new_tokens or self.configs["max_new_tokens"]) for budget in budgets]
+            max_new_tokens = max(budgets)
+
+        static = quantized = None
+        if not speculative:
+            static = self.static_cache(len(batch_ids), max(len(ids) for ids in batch_ids) + (max_new_tokens or self.configs["max_new_tokens"]))
+        if not speculative and static is None:
+            quantized = self.kv_cache()
+
+        prefix_len = len(self.prefix_ids)
+        if speculative or static is not None or quantized is not None or (prefix_len and any(ids[:prefix_len] != self.prefix_ids for ids in batch_ids)):
+            #the draft model and the n-gram lookup have to see the whole prompt, static and quantized caches start empty
+            prefix_len = 0
+
+        model_inputs = self.tokenizer.pad({"input_ids": [ids[prefix_len:] for ids in batch_ids]},
+                                          padding=True,
+                                          return_tensors="pt")
+        kwargs = self.generation_kwargs()
+        if max_new_tokens is not None:
+            kwargs["max_new_tokens"] = max_new_tokens
+
+        if prefix_len:
+            if self.prefix_cache is None:
+                self.prefill_prefix()
+            #prefix + left padded suffix, the padding in between is masked out
+            prefix = torch.tensor([self.prefix_ids] * len(batch_ids))
+            model_inputs["input_ids"] = torch.cat([prefix, model_inputs["input_ids"]], dim=1)
+            model_inputs["attention_mask"] = torch.cat([torch.ones_like(prefix), model_inputs["attention_mask"]], dim=1)
+
+            past_key_values = copy.deepcopy(self.prefix_cache)
+            past_key_values.batch_repeat_interleave(len(batch_ids))
+            kwargs["past_key_values"] = past_key_values
+            self.prefill_tokens_saved += prefix_len * len(batch_ids)
+
+        prompt_len = model_inputs["input_ids"].shape[1]
+        json_stop = self.stopping_criteria(prompt_len, len(batch_ids))
+        budget_stop = Budget_Stop(prompt_len, budgets) if budgets and min(budgets) < max_new_tokens else None
+        criteria = [criterion for criterion in (json_stop, budget_stop) if criterion is not None]
+        if criteria:
+            kwargs["stopping_criteria"] = StoppingCriteriaList(criteria)
+        schema_processor = self.schema_processor(prompt_len, len(batch_ids), kwargs)
+        timer = First_Token_Timer()
+        kwargs["logits_processor"] = LogitsProcessorList([schema_processor, timer] if schema_processor is not None else [timer])
+
+        if speculative:
+            kwargs.update(speculative)
+            forwards = (self.spec_stats["target_forwards"], self.spec_stats["target_tokens"])
+        if static is not None:
+            kwargs["past_key_values"] = static
+            if self.configs.get("compile"):
+                kwargs["compile_config"] = self.compile_config
+            else:
+                kwargs["disable_compile"] = True
+        if quantized is not None:
+            kwargs["past_key_values"] = quantized
+
+        model_inputs = model_inputs.to(self.model.device)
+        reset_peak_memory(self.model.device)
+        start = time.time()
+        try:
+            generated_ids = self.model.generate(**model_inputs, **kwargs)
+        except torch.OutOfMemoryError:
+            raise
+        except Exception as e:
+            if "compile_config" not in kwargs:
+                raise
+            print(f"Compiled generation failed ({type(e).__name__}: {e}), falling back to eager")
+            self.compile_failed = True
+            return self.run_generate(batch_ids, max_new_tokens, budgets)
+        end = time.time()
+
+        new_ids = generated_ids[:, prompt_len:].tolist()
+        if speculative:
+            self.count_accepted(len(new_ids[0]), prompt_len, *forwards)
+        new_ids = self.trim_stopped(new_ids, json_stop, kwargs, budgets)
+
+        peak = peak_memory_mb(self.model.device)
+        self.last_metrics = [call_record(len(ids), generated, start, timer.first_logits, end, reason,
+                                         peak_memory_mb=peak, batch_size=len(batch_ids), cached_prefix_tokens=prefix_len,
+                                         peak_memory_scope=peak_memory_scope(self.model.device))
+                             for ids, generated, reason in zip(batch_ids, self.last_generated_tokens, self.last_stop_reasons)]
+        if speculative:
+            self.last_metrics[0]["accepted_draft_tokens"] = self.last_accepted_tokens[0]
+        for record, budget in zip(self.last_metrics, budgets or []):
+            record["max_new_tokens"] = budget
+        if quantized is not None:
+            kv_mb = self.count_kv_bytes(quantized)
+            for record in self.last_metrics:
+                record["kv_cache_mb"] = kv_mb
+        return [self.decode(row) for row in new_ids]
+
+    #-------------------------------------------------------------------------------------------
+    # Quantized KV cache (configs["kv_cache_bits"] = 8 or 4, see kv_quantization.py). Each
+    # eager call gets a fresh cache holding the keys and values older than
+    # configs["kv_residual_length"] tokens as int8/int4 groups of configs["kv_group_size"]
+    # values, and the scheduler's token budget grows by the compression ratio so the same
+    # memory holds larger batches. Static caches, speculative decoding, the prefix cache and
+    # the continuous engine keep their full precision caches.
+    #-------------------------------------------------------------------------------------------
+    def kv_cache(self):
+        """An empty quantized cache, None without configs["kv_cache_bits"]."""
+        if not self.configs.get("kv_cache_bits"):
+            return None
+        if self.kv_stats is None:
+            self.kv_stats = dict(calls=0, peak_bytes=0, peak_full_bytes=0, bytes=0, full_bytes=0)
+        return Int_Quantized_Cache(self.model.config, nbits=self.configs["kv_cache_bits"],
+                                   q_group_size=self.configs.get("kv_group_size", 64),
+                                   residual_length=self.configs.get("kv_residual_length", 128))
+
+    def kv_budget_scale(self):
+        return budget_scale(self.model.config, self.configs["kv_cache_bits"], self.configs.get("kv_group_size", 64), self.model.dtype)
+
+    def count_kv_bytes(self, cache):
+        """Record the size of the cache of a finished call, returns it in MB."""
+        stored, full = cache.nbytes()
+        stats = self.kv_stats
+        stats["calls"] += 1
+        stats["bytes"] += stored
+        stats["full_bytes"] += full
+        if stored > stats["peak_bytes"]:
+            stats["peak_bytes"], stats["peak_full_bytes"] = stored, full
+        return round(stored / 2**20, 2)
+
+    def kv_report(self):
+        stats = self.kv_stats
+        budget = ""
+        if self.configs.get("token_budget"):
+            budget = f", token budget {self.configs['token_budget']} -> {self.token_budget()}"
+        return (f"Quantized KV cache (int{self.configs['kv_cache_bits']}): {stats['calls']} calls, largest "
+                f"{stats['peak_bytes'] / 2**20:.1f} MB instead of {stats['peak_full_bytes'] / 2**20:.1f} MB in {str(self.model.dtype).split('.')[-1]} "
+                f"({stats['full_bytes'] / max(stats['bytes'], 1):.2f}x smaller){budget}")
+
+    #-------------------------------------------------------------------------------------------
+    # Static cache and compiled decoding (configs["static_cache"], configs["compile"]). The
+    # batches of a run are known before generating, so for the configs["compile_max_shapes"]
+    # most frequent batch sizes one StaticCache is allocated up front and reset between calls.
+    # It holds the longest prompt of those batches plus max_new_tokens, rounded up to
+    # configs["static_cache_bucket"], so the scheduler's token budget also bounds it. With
+    # compile, generate decodes with a torch.compile'd forward, compiled for every shape
+    # during a warm-up (on CPU too). Batches of another shape (OOM splits, prefix cache
+    # mismatches...) and compilation errors fall back to the eager path with a dynamic cache.
+    #-------------------------------------------------------------------------------------------
+    def prepare_static(self, input_ids, batches):
+        if not (self.configs.get("static_cache") or self.configs.get("compile")) or not batches:
+            return
+        if self.static_caches is None:
+            self.static_caches = {}
+        if self.configs.get("compile") and self.compile_config is None:
+            mode = self.configs.get("compile_mode") or ("reduce-overhead" if self.model.device.type == "cuda" else "default")
+            self.compile_config = CompileConfig(fullgraph=False, dynamic=False, mode=mode)
+            self.compile_config._compile_all_devices = True
+
+        longest = {}
+        for batch in batches:
+            longest[len(batch)] = max(longest.get(len(batch), 0), *(len(input_ids[i]) for i in batch))
+        bucket = self.configs.get("static_cache_bucket", 256)
+        for rows, _ in Counter(len(batch) for batch in batches).most_common(self.configs.get("compile_max_shapes", 4)):
+            max_cache_len = -(-(longest[rows] + self.configs["max_new_tokens"]) // bucket) * bucket
+            if rows in self.static_caches and self.static_caches[rows][0] >= max_cache_len:
+                continue
+            self.static_caches[rows] = (max_cache_len, StaticCache(config=self.model.config, max_cache_len=max_cache_len))
+            if self.configs.get("compile") and not self.compile_failed:
+                self.warm_up(rows)
+
+    def warm_up(self, rows, new_tokens=4):
+        """Compile the decoding step of a batch size on a dummy prompt."""
+        self.switch_adapter(self.configs.get("adapter"))
+        start = time.time()
+        cache = self.static_caches[rows][1]
+        input_ids = torch.full((rows, 8), self.tokenizer.eos_token_id, device=self.model.device)
+        try:
+            self.model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), past_key_values=cache,
+                                compile_config=self.compile_config, max_new_tokens=new_tokens, min_new_tokens=new_tokens,
+                                do_sample=False, pad_token_id=self.tokenizer.pad_token_id)
+        except torch.OutOfMemoryError:
+            raise
+        except Exception as e:
+            print(f"Compilation failed ({type(e).__name__}: {e}), generating eagerly")
+            self.compile_failed = True
+        cache.reset()
+        self.warm_up_seconds += time.time() - start
+        print(f"Warm-up of {rows}x{self.static_caches[rows][0]} static cache: {time.time() - start:.1f}s")
+
+    def static_cache(self, rows, length):
+        """The reset static cache of a batch of rows prompts up to length tokens, None for the eager path."""
+        if not self.static_caches or (self.configs.get("compile") and self.compile_failed):
+            return None
+        max_cache_len, cache = self.static_caches.get(rows, (0, None))
+        if max_cache_len < length:
+            self.static_fallbacks += 1
+            return None
+        cache.reset()
+        self.static_calls += 1
+        return cache
+
+    #-------------------------------------------------------------------------------------------
+    # LoRA adapters: configs["adapters"] = {name: local path or hub id of a PEFT adapter} are
+    # loaded once on top of the base model (PEFT integration of transformers) and
+    # configs["adapter"] names the one of the pipeline's task, None for the base weights. The
+    # active adapter is switched before every batch, so the pipelines of several tasks made
+    # with for_task share one copy of the base weights and of the adapters.
+    #-------------------------------------------------------------------------------------------
+    def setup_adapters(self):
+        """Load the adapters of configs["adapters"] that are not on the model yet."""
+        if self.adapter_state is None:
+            self.adapter_state = dict(loaded=[], active=None, switches=0, seconds=0.0)
+        state = self.adapter_state
+        for name, path in (self.configs.get("adapters") or {}).items():
+            if name in state["loaded"]:
+                continue
+            start = time.time()
+            self.model.load_adapter(path, adapter_name=name)
+            state["loaded"].append(name)
+            #loading can activate the new adapter, go back to the base weights
+            self.model.disable_adapters()
+            state["active"] = None
+            print(f"Adapter {name} loaded from {path} in {time.time() - start:.1f}s")
+        if self.configs.get("adapter") and self.configs["adapter"] not in state["loaded"]:
+            raise ValueError(f"Adapter {self.configs['adapter']} is not in configs['adapters'] {list(state['loaded'])}")
+
+    def switch_adapter(self, name):
+        """Make adapter name (None: the base weights) the active one of the shared model."""
+        state = self.adapter_state
+        if not state or not state["loaded"]:
+            if name:
+                raise ValueError(f"Adapter {name} is not loaded")
+            return
+        if name == state["active"]:
+            return
+        start = time.time()
+        if name is None:
+            self.model.disable_adapters()
+        else:
+            self.model.enable_adapters()
+            self.model.set_adapter(name)
+        state["active"] = name
+        state["switches"] += 1
+        state["seconds"] += time.time() - start
+
+    def for_task(self, configs):
+        """Pipeline of another task (its configs, caches, adapter) on the model of this one.
+        The model settings of configs (device, dtype, quantization) are not used."""
+        pipeline = object.__new__(type(self))
+        Base_Pipeline.__init__(pipeline)
+        pipeline.configs = configs
+        pipeline.tokenizer = self.tokenizer
+        pipeline.model = self.model
+        pipeline.device = self.device
+        pipeline.draft_model = self.draft_model
+        pipeline.spec_stats = self.spec_stats
+        pipeline.adapter_state = self.adapter_state
+        pipeline.setup_pipeline(self.model_name)
+        pipeline.setup_adapters()
+        return pipeline
+
+    #-------------------------------------------------------------------------------------------
+    # Continuation scoring: the log-likelihood of a short answer (a predicate, "none", ...)
+    # after its prompt, read from the logits of one forward pass, with no decoding. The rows
+    # of a call usually share a long prefix (instructions and document) that is run once,
+    # its cache expanded to every batch of configs["score_batch_size"] rows; the suffixes
+    # are left padded so the answers end every row and only their logits are computed.
+    #-------------------------------------------------------------------------------------------
+    def score_continuations(self, prompts, continuations):
+        """Sum of the log-probabilities of every continuation after its prompt (token ids),
+        in input order, None for a row that does not fit in memory even alone. last_metrics
+        holds one record of the whole call."""
+        self.switch_adapter(self.configs.get("adapter"))
+        if self.score_stats is None:
+            self.score_stats = dict(calls=0, rows=0, forwards=0, tokens=0, prefix_tokens=0, seconds=0.0, oom_rows=0)
+        start = time.time()
+        prefix = []
+        for tokens in zip(*prompts):
+            if any(token != tokens[0] for token in tokens):
+                break
+            prefix.append(tokens[0])
+        #the last prompt token stays in every row, its logits score the first answer token
+        prefix = prefix[:min(len(ids) for ids in prompts) - 1]
+        if len(prefix) < self.configs.get("min_prefix_tokens", 32):
+            prefix = []
+
+        with torch.no_grad():
+            prefix_cache = None
+            if prefix:
+                prefix_cache = self.model(input_ids=torch.tensor([prefix], device=self.model.device), use_cache=True).past_key_values
+            rows = [list(ids[len(prefix):]) + list(answer) for ids, answer in zip(prompts, continuations)]
+            #rows of similar length together, less padding
+            order = sorted(range(len(rows)), key=lambda i: len(rows[i]))
+            scores = [None] * len(rows)
+            size = self.configs.get("score_batch_size", 16)
+            k = 0
+            while k < len(order):
+                batch = order[k:k + size]
+                try:
+                    batch_scores = self.score_batch([rows[i] for i in batch], [len(continuations[i]) for i in batch],
+                                                    prefix, prefix_cache)
+                except torch.OutOfMemoryError:
+                    batch_scores = None
+                if batch_scores is None:
+                    self.empty_cache()
+                    if size == 1:
+                        #the row keeps the score None, the drivers skip the candidates it belongs to
+                        print(f"A single scoring row of {len(prefix) + len(rows[batch[0]])} tokens does not fit in memory, left unscored")
+                        self.score_stats["oom_rows"] += 1
+                        k += 1
+                        continue
+                    size //= 2
+                    print(f"Out of memory while scoring, score batch size lowered to {size}")
+                    continue
+                for i, score in zip(batch, batch_scores):
+                    scores[i] = score
+                k += len(batch)
+        end = time.time()
+
+        stats = self.score_stats
+        stats["calls"] += 1
+        stats["rows"] += len(rows)
+        stats["tokens"] += len(prefix) + sum(len(row) for row in rows)
+        stats["prefix_tokens"] += len(prefix) * (len(rows) - 1)
+        stats["seconds"] += end - start
+        stop_reason = "oom" if None in scores else "scored"
+        self.last_metrics = [call_record(len(prefix) + sum(len(row) for row in rows), 0, start, end, end, stop_reason,
+                                         peak_memory_mb=peak_memory_mb(self.model.device), cached_prefix_tokens=len(prefix),
+                                         peak_memory_scope=peak_memory_scope(self.model.device))]
+        return scores
+
+    def score_batch(self, rows, answer_lengths, prefix, prefix_cache):
+        """Log-likelihood of the last answer_lengths tokens of every row, after the prefix."""
+        self.score_stats["forwards"] += 1
+        model_inputs = self.tokenizer.pad({"input_ids": rows}, padding=True, return_tensors="pt")
+        attention_mask = model_inputs["attention_mask"]
+        kwargs = {}
+        if prefix:
+            attention_mask = torch.cat([torch.ones(len(rows), len(prefix), dtype=attention_mask.dtype), attention_mask], dim=1)
+            past_key_values = copy.deepcopy(prefix_cache)
+            past_key_values.batch_repeat_interleave(len(rows))
+            kwargs["past_key_values"] = past_key_values
+        #left padding: the positions of every row start after its own padding
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)[:, len(prefix):]
+        longest = max(answer_lengths)
+        logits = self.model(input_ids=model_inputs["input_ids"].to(self.model.device),
+                            attention_mask=attention_mask.to(self.model.device),
+                            position_ids=position_ids.to(self.model.device),
+                            logits_to_keep=longest + 1, use_cache=bool(prefix), **kwargs).logits
+        #the logits of position t score the token t + 1
+        log_probs = torch.log_softmax(logits[:, :-1].float(), dim=-1)
+        targets = model_inputs["input_ids"][:, -longest:].to(self.model.device)
+        token_scores = log_probs.gather(-1, targets.unsqueeze(-1)).squeeze(-1)
+        return [float(token_scores[i, longest - length:].sum()) for i, length in enumerate(answer_lengths)]
+
+    def score_report(self):
+        stats = self.score_stats
+        return (f"Continuation scoring: {stats['rows']} rows in {stats['forwards']} forwards over {stats['calls']} calls, "
+                f"{stats['tokens']} tokens ({stats['prefix_tokens']} prefix tokens not recomputed), {stats['seconds']:.1f}s"
+                + (f", {stats['oom_rows']} rows out of memory" if stats.get("oom_rows") else ""))
+
+    #-------------------------------------------------------------------------------------------
+    # Speculative decoding: candidate tokens are drafted either by a small model with the same
+    # tokenizer (configs["draft_model"], configs["num_assistant_tokens"]) or by copying the
+    # continuation of the last n-gram found in the prompt (configs["prompt_lookup_num_tokens"],
+    # configs["max_matching_ngram_size"]), e.g. the text spans of the abstract and the labels.
+    # The target model checks all the candidates in a single forward and adds one token of its
+    # own, so the draft tokens accepted are the generated tokens minus the target forwards.
+    #-------------------------------------------------------------------------------------------
+    def speculative_kwargs(self):
+        """model.generate arguments of the speculative decoding mode, {} for plain decoding."""
+        if self.configs.get("draft_model"):
+            kwargs = {"assistant_model": self.assistant_model()}
+        elif self.configs.get("prompt_lookup_num_tokens"):
+            kwargs = {"prompt_lookup_num_tokens": self.configs["prompt_lookup_num_tokens"]}
+            if self.configs.get("max_matching_ngram_size"):
+                kwargs["max_matching_ngram_size"] = self.configs["max_matching_ngram_size"]
+        else:
+            return {}
+
+        if self.spec_stats is None:
+            self.spec_stats = dict(target_forwards=0, target_tokens=0, calls=0, generated=0, forwards=0, accepted=0, drafted=0)
+            self.model.register_forward_hook(self.count_forward, with_kwargs=True)
+        return kwargs
+
+    def count_forward(self, module, args, kwargs, output):
+        input_ids = kwargs.get("input_ids", args[0] if args else None)
+        self.spec_stats["target_forwards"] += 1
+        self.spec_stats["target_tokens"] += 0 if input_ids is None else input_ids.shape[1]
+
+    def assistant_model(self):
+        """The draft model, loaded on the target device on first use."""
+        if self.draft_model is None:
+            self.draft_model = AutoModelForCausalLM.from_pretrained(self.configs["draft_model"],
+                                                                    torch_dtype=self.model.dtype).to(self.model.device)
+            if self.draft_model.config.vocab_size != self.model.config.vocab_size:
+                raise ValueError(f"Draft model {self.configs['draft_model']} does not share the tokenizer of {self.model_name}")
+            if self.configs.get("num_assistant_tokens"):
+                self.draft_model.generation_config.num_assistant_tokens = self.configs["num_assistant_tokens"]
+        return self.draft_model
+
+    def count_accepted(self, generated, prompt_len, target_forwards, target_tokens):
+        """Update the counters after one call: the first forward reads the prompt, every
+        forward reads one token of the target plus the candidates drafted."""
+        stats = self.spec_stats
+        forwards = stats["target_forwards"] - target_forwards
+        accepted = max(generated - forwards, 0)
+        stats["calls"] += 1
+        stats["generated"] += generated
+        stats["forwards"] += forwards
+        stats["accepted"] += accepted
+        drafted = max(stats["target_tokens"] - target_tokens - (prompt_len - 1) - forwards, 0)
+        stats["drafted"] += drafted
+        self.last_accepted_tokens = [accepted]
+        print(f"Speculative decoding: {accepted}/{drafted} draft tokens accepted, {generated} tokens in {forwards} target forwards")
+
+    def acceptance_rate(self):
+        if not self.spec_stats or not self.spec_stats["drafted"]:
+            return 0.0
+        return self.spec_stats["accepted"] / self.spec_stats["drafted"]
+
+    #-------------------------------------------------------------------------------------------
+    # Stopping and constraints: the answers are JSON, generation ends once the JSON is closed
+    # (configs["stop_on_json"] = "object" for the RE answer, "sequence" for the comma
+    # separated NER entities) or once the model loops over the same object
+    # (configs["max_repeats"]). See stopping_criteria.Json_Stop.
+    #-------------------------------------------------------------------------------------------
+    def stopping_criteria(self, prompt_len, batch_size):
+        if not self.configs.get("stop_on_json") and not self.configs.get("max_repeats"):
+            return None
+        return Json_Stop(token_strings(self.tokenizer), prompt_len, batch_size,
+                         mode=self.configs.get("stop_on_json"),
+                         max_repeats=self.configs.get("max_repeats"))
+
+    def schema_processor(self, prompt_len, batch_size, kwargs):
+        """Constrain the answer to a JSON schema with legal labels (configs["constrained_schema"],
+        see constrained_decoding.SCHEMAS)."""
+        if not self.configs.get("constrained_schema"):
+            return None
+        compiled = compile_schema(self.tokenizer, self.configs["constrained_schema"],
+                                  self.model.config.vocab_size, self.eos_ids(kwargs))
+        return Schema_Processor(compiled, token_strings(self.tokenizer), prompt_len, batch_size)
+
+    def eos_ids(self, kwargs):
+        eos = kwargs.get("eos_token_id", self.model.generation_config.eos_token_id)
+        if eos is None:
+            eos = self.tokenizer.eos_token_id
+        return set(eos) if isinstance(eos, (list, tuple)) else {eos}
+
+    def trim_stopped(self, new_ids, json_stop, kwargs, budgets=None):
+        """Cut the rows stopped by json_stop at their last complete value and record why every row stopped."""
+        eos = self.eos_ids(kwargs)
+        for i, budget in enumerate(budgets or []):
+            #a row stopped by its budget is padded up to the end of the batch
+            if next((k for k, token in enumerate(new_ids[i]) if token in eos), len(new_ids[i])) >= budget:
+                new_ids[i] = new_ids[i][:budget]
+        self.last_stop_reasons = []
+        self.last_generated_tokens = [next((k + 1 for k, token in enumerate(row) if token in eos), len(row)) for row in new_ids]
+        self.generated_tokens += sum(self.last_generated_tokens)
+        for i, row in enumerate(new_ids):
+            if json_stop is not None and json_stop.rows[i].reason is not None:
+                new_ids[i] = row[:json_stop.rows[i].keep]
+                reason = json_stop.rows[i].reason
+            elif any(token in eos for token in row):
+                reason = "eos"
+            else:
+                reason = "max_new_tokens"
+            self.last_stop_reasons.append(reason)
+        self.stop_reasons.update(self.last_stop_reasons)
+        return new_ids
 
 #===========================================================================================
 # ** QWEN **
 #===========================================================================================
-class Qwen_Pipeline:
+class Qwen_Pipeline(Base_Pipeline):
     def __init__(self, model_name,configs):
+        super().__init__()
         self.configs= configs
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            torch_dtype="auto",
-            device_map="auto"
-        )
+        self.setup_pipeline(model_name)
+        self.model = self.load_model(model_name)
+        self.setup_adapters()
 
-    def inference(self, messages):
+    def encode(self, messages):
         text = self.tokenizer.apply_chat_template(
         messages,
         tokenize=False,
         add_generation_prompt=True,
         enable_thinking=False # Switches between thinking and non-thinking modes. Default is True.
         )
-        model_inputs = self.tokenizer([text], return_tensors="pt").to(self.model.device)
+        return self.tokenizer(text)["input_ids"]
 
-        # conduct text completion
-        generated_ids = self.model.generate(
-            **model_inputs,
+    def generation_kwargs(self):
+        return dict(
             max_new_tokens=self.configs["max_new_tokens"],
             temperature=self.configs['temperature'],
+            pad_token_id=self.tokenizer.pad_token_id,
             # TopP=0.95,
             # TopK=20,
             # MinP=0
         )
 
-        output_ids = generated_ids[0][len(model_inputs.input_ids[0]):].tolist() 
-
+    def decode(self, output_ids):
         # parsing thinking content
         try:
             # rindex finding 151668 (</think>)
@@ -58,58 +931,41 @@ class Qwen_Pipeline:
 #===========================================================================================
 # ** Mistral **
 #===========================================================================================
-class Mistral_Pipeline:
+class Mistral_Pipeline(Base_Pipeline):
     def __init__(self, model_name,configs):
+        super().__init__()
         load_dotenv()
         HUGGINGFACE_TOKEN=os.getenv('HUGGINGFACE_TOKEN')
-        login(token=HUGGINGFACE_TOKEN)
+        if HUGGINGFACE_TOKEN:
+            login(token=HUGGINGFACE_TOKEN)
 
         self.configs= configs
 
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        
-        if self.configs["quantization"]:
-            print('Quantized Model')
-            bnb_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_use_double_quant=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.bfloat16
-            )
+        self.setup_pipeline(model_name)
+        self.model = self.load_model(model_name)
+        self.setup_adapters()
 
-            self.model = AutoModelForCausalLM.from_pretrained(model_name,
-                                                            device_map="auto",
-                                                            quantization_config=bnb_config)
-        else:
-            
-            self.model = AutoModelForCausalLM.from_pretrained(
-                model_name,
-                torch_dtype="auto",
-                device_map="auto"
-            )
-        
-    def inference(self, message):
+    def encode(self, message):
         input_text = self.tokenizer.apply_chat_template(message, tokenize=False)
-        model_inputs = self.tokenizer(input_text, return_tensors="pt").to("cuda")
+        return self.tokenizer(input_text)["input_ids"]
 
-        attention_mask = model_inputs["attention_mask"]
-        generated_ids = self.model.generate(model_inputs["input_ids"],
-                                    max_new_tokens=self.configs["max_new_tokens"],
-                                    do_sample=True,
-                                    temperature=self.configs['temperature'],
-                                    attention_mask=attention_mask,
-                                    pad_token_id=self.tokenizer.eos_token_id
-                                    )
-        
-        output=self.tokenizer.batch_decode(generated_ids)[0]
-
-        return output
+    def generation_kwargs(self):
+        return dict(max_new_tokens=self.configs["max_new_tokens"],
+                    do_sample=True,
+                    temperature=self.configs['temperature'],
+                    pad_token_id=self.tokenizer.eos_token_id
+                    )
+
+    def decode(self, output_ids):
+        return self.tokenizer.decode(output_ids, skip_special_tokens=True)
     
 #===========================================================================================
 # ** LLAMA **
 #===========================================================================================
-class Llama_Pipeline:
+class Llama_Pipeline(Base_Pipeline):
     def __init__(self, model_name,configs):
+        super().__init__()
         load_dotenv()
         HUGGINGFACE_TOKEN=os.getenv('HUGGINGFACE_TOKEN')
         #login(token=HUGGINGFACE_TOKEN)
@@ -117,58 +973,176 @@ class Llama_Pipeline:
         self.configs= configs
 
         self.tokenizer = AutoTokenizer.from_pretrained(model_name,token=HUGGINGFACE_TOKEN)
-        
-        if self.configs["quantization"]:
-            print('Quantized Model')
-            bnb_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_use_double_quant=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.bfloat16
-            )
-
-            self.model = AutoModelForCausalLM.from_pretrained(model_name,
-                                                            device_map="cuda",
-                                                            quantization_config=bnb_config,
-                                                            token=HUGGINGFACE_TOKEN)
-
-        else:
-            
-            self.model = AutoModelForCausalLM.from_pretrained(
-                model_name,
-                torch_dtype="auto",
-                device_map="cuda",
-            )
+        self.setup_pipeline(model_name)
+        self.model = self.load_model(model_name, device_map="cuda", token=HUGGINGFACE_TOKEN)
+        self.setup_adapters()
         print(next(self.model.parameters()).device)
 
-    def inference(self,message):
-        terminators = [self.tokenizer.eos_token_id,
-                    self.tokenizer.convert_tokens_to_ids("<|eot_id|>")]
-
-        input_ids = self.tokenizer.apply_chat_template(
+    def encode(self, message):
+        return self.tokenizer.apply_chat_template(
                 conversation=message, 
                 tokenize=True,
                 add_generation_prompt=True,
-                return_tensors="pt"
-                ).to(self.model.device)
-        
-        attention_mask = torch.ones_like(input_ids)
-
-        outputs = self.model.generate(
-            input_ids,
-            attention_mask=attention_mask,
+                return_dict=False
+                )
+
+    def generation_kwargs(self):
+        terminators = [self.tokenizer.eos_token_id,
+                    self.tokenizer.convert_tokens_to_ids("<|eot_id|>")]
+
+        return dict(
             max_new_tokens=self.configs["max_new_tokens"],
             eos_token_id=terminators,
+            pad_token_id=self.tokenizer.pad_token_id,
             do_sample=True,
             temperature=self.configs['temperature'],
             top_p=0.9,
             )
-        
-        generated_output = outputs[0][input_ids.shape[-1]:]
-        output=self.tokenizer.decode(generated_output, skip_special_tokens=True)
 
-        return output
+    def decode(self, output_ids):
+        return self.tokenizer.decode(output_ids, skip_special_tokens=True)
 
 #===========================================================================================
 # ** OTHER **
-#===========================================================================================
\ No newline at end of file
+#===========================================================================================
+class OpenAI_Pipeline(Base_Pipeline):
+    """Generation on a shared inference server through its OpenAI-compatible chat endpoint
+    (configs["api_base"], e.g. http://localhost:8000/v1, serving model_name). The messages
+    are sent as they are and the server applies the chat template."""
+    def __init__(self, model_name,configs):
+        super().__init__()
+        load_dotenv()
+        self.configs= configs
+
+        self.client = Chat_Client(configs.get("api_base") or "http://localhost:8000/v1",
+                                  api_key=configs.get("api_key") or os.getenv('OPENAI_API_KEY'),
+                                  max_concurrency=configs.get("max_concurrency", 8),
+                                  max_retries=configs.get("max_retries", 4),
+                                  request_timeout=configs.get("request_timeout", 300.0))
+        self.loop = asyncio.new_event_loop()
+        self.setup_response_cache(model_name)
+        self.stop_reasons = Counter()
+
+    def generation_kwargs(self):
+        return dict(max_tokens=self.configs["max_new_tokens"],
+                    temperature=self.configs['temperature'])
+
+    async def request(self, messages, max_tokens=None):
+        """(answer, metrics record) of one conversation."""
+        decoding = self.generation_kwargs()
+        if max_tokens:
+            decoding["max_tokens"] = max_tokens
+        #a server with LoRA adapters (vLLM --lora-modules re=PATH) serves them as models of their name
+        model = self.configs.get("adapter") or self.model_name
+        answer, latency = await self.client.chat(dict(model=model, messages=messages, **decoding))
+        choice = answer["choices"][0]
+        usage = answer.get("usage") or {}
+        reason = FINISH_REASONS.get(choice.get("finish_reason"), choice.get("finish_reason"))
+        self.generated_tokens += usage.get("completion_tokens", 0)
+        self.stop_reasons[reason] += 1
+        return choice["message"]["content"], http_record(usage.get("prompt_tokens"), usage.get("completion_tokens", 0), latency, reason)
+
+    def inference_scheduled(self, list_of_messages, batch_size=None, budgets=None):
+        """Yield (indices, outputs) as the answers arrive. All the prompts are sent at once and
+        configs["max_concurrency"] caps the requests in flight, batch_size is not used."""
+        missing = list(range(len(list_of_messages)))
+        if self.response_cache is not None:
+            keys = [Response_Cache.key(self.model_name, self.configs, self.row_decoding(budgets, i), messages)
+                    for i, messages in enumerate(list_of_messages)]
+            outputs = [self.response_cache.get(key) for key in keys]
+            missing = [i for i, output in enumerate(outputs) if output is None]
+            cached = [i for i, output in enumerate(outputs) if output is not None]
+            if cached:
+                self.last_metrics = [cached_record(None) for _ in cached]
+                yield cached, [outputs[i] for i in cached]
+
+        tasks = {self.loop.create_task(self.request(list_of_messages[i], budgets[i] if budgets else None)): i for i in missing}
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = self.loop.run_until_complete(asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))
+                finished = sorted((tasks[task], *task.result()) for task in done)
+                if self.response_cache is not None:
+                    for i, output, _ in finished:
+                        self.response_cache.put(keys[i], output)
+                self.last_metrics = [record for _, _, record in finished]
+                yield [i for i, _, _ in finished], [output for _, output, _ in finished]
+        finally:
+            #a failed request or a stopped driver cancels the requests still in flight
+            for task in pending:
+                task.cancel()
+            if pending:
+                self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        if len(list_of_messages) > 1:
+            print(self.report())
+
+    def report(self):
+        return "\n".join(line for line in (self.client.report(), super().report()) if line)
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+        self.loop.run_until_complete(self.client.close())
+        self.loop.close()
+
+#===========================================================================================
+# ** MODEL WORKER **
+#===========================================================================================
+class Worker_Pipeline(Base_Pipeline):
+    """Generation in the model worker (model_worker.py) that keeps the model loaded across
+    driver runs. The worker encodes, schedules and caches as the pipeline would in process;
+    load_pipeline makes it a subclass of the pipeline it stands for, so the drivers'
+    isinstance checks still hold."""
+    def __init__(self, client, model_name, configs):
+        #super() would be the __init__ of the pipeline class this one stands for
+        Base_Pipeline.__init__(self)
+        self.client = client
+        self.configs = configs
+        self.model_name = model_name
+        #local tokenizer for the drivers (budget_estimator.py), the worker has its own
+        load_dotenv()
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, token=os.getenv('HUGGINGFACE_TOKEN'))
+        self.device = client.info.get("device")
+        self.stop_reasons = Counter()
+        self.worker_report = ""
+
+    def inference_scheduled(self, list_of_messages, batch_size=None, budgets=None):
+        """Yield (indices, outputs) as the worker answers the batches."""
+        for answer in self.client.generate(worker_configs(self.configs), list_of_messages, batch_size, budgets):
+            if answer.get("done"):
+                self.generated_tokens += answer["generated_tokens"]
+                self.worker_report = answer["report"]
+                break
+            self.last_metrics = answer["metrics"]
+            self.stop_reasons.update(record["stop_reason"] for record in self.last_metrics if record["stop_reason"])
+            yield answer["indices"], answer["outputs"]
+        if len(list_of_messages) > 1:
+            print(self.report())
+
+    def score_continuations(self, prompts, continuations):
+        """Scored by the worker, see Base_Pipeline.score_continuations."""
+        answer = self.client.score(worker_configs(self.configs), [list(ids) for ids in prompts],
+                                   [list(ids) for ids in continuations])
+        self.last_metrics = answer["metrics"]
+        self.worker_report = answer["report"]
+        return answer["scores"]
+
+    def report(self):
+        return "\n".join(line for line in (f"Model worker {self.client.path} (pid {self.client.info.get('pid')})",
+                                            self.worker_report) if line)
+
+    def close(self):
+        self.client.close()
+
+def load_pipeline(pipeline_class, model_name, configs):
+    """pipeline_class(model_name, configs), served by the model worker on configs["worker_socket"]
+    when it has model_name loaded, loaded in this process otherwise."""
+    if configs.get("worker_socket"):
+        client = Worker_Client(configs["worker_socket"])
+        reason = client.connect(pipeline_class.__name__, model_name, worker_configs(configs))
+        if reason is None:
+            print(f"{model_name} served by the model worker on {configs['worker_socket']}")
+            worker_class = type(f"Worker_{pipeline_class.__name__}", (Worker_Pipeline, pipeline_class), {})
+            return worker_class(client, model_name, configs)
+        print(f"Loading {model_name} in process: {reason}")
+    return pipeline_class(model_name, configs)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/20 10:14:52
+@author: SIRConceicao
+
+Long-lived model worker: loads a pipeline once and serves the drivers over a Unix socket.
+
+Every driver run starts by loading a 7B model, minutes before the first token, and a
+prompt tweak means paying it again. The worker keeps Mistral_Pipeline/Qwen_Pipeline/
+Llama_Pipeline loaded; llms_class.load_pipeline connects the drivers to it when it serves
+the same model (configs["worker_socket"]) and loads the model in process otherwise.
+
+The rendered conversations and the configs go with every request, so edited prompts and
+configs apply on the next driver run without reloading the model. The worker makes the
+pipeline of each configs with for_task (its caches, schema, adapter, ...) on the shared
+model, and runs the requests one at a time. Only the configs that decide how the weights
+are loaded (MODEL_KEYS) have to match the worker's.
+
+Protocol: one JSON object per line each way.
+    {"op": "hello", "pipeline", "model_name", "configs"} -> {"ok", "reason" | "device", "pid"}
+    {"op": "generate", "configs", "messages", "batch_size", "budgets"}
+        -> {"indices", "outputs", "metrics"} per batch, then {"done", "report", "generated_tokens"}
+    {"op": "score", "configs", "prompts", "continuations"} -> {"scores", "metrics", "report"}
+    {"op": "status"} -> {"model_name", "pipeline", "device", "tasks", "requests"}
+A failed request is answered {"error": message}.
+
+Usage (from the repository root):
+    python src/model_worker.py --model mistralai/Mistral-7B-Instruct-v0.3 &
+    python src/main_baseline_labels.py                  #served by the worker
+    python src/main_baseline_labels.py --no-worker      #loads the model in process
+'''
+import os
+import json
+import time
+import socket
+import argparse
+import threading
+import traceback
+import socketserver
+
+WORKER_SOCKET = "data/cache/model_worker.sock"
+#configs that decide how the weights are loaded, the worker only serves its own
+MODEL_KEYS = ("quantization", "dtype")
+#paths of the configs, sent absolute since the worker may run in another directory
+PATH_KEYS = ("response_cache", "token_cache")
+#task pipelines kept with their static caches and compiled shapes
+MAX_TASKS = 4
+#==================================================================================================
+# Driver side
+#==================================================================================================
+def worker_configs(configs):
+    return {key: os.path.abspath(value) if key in PATH_KEYS and value else value for key, value in configs.items()}
+
+class Worker_Client:
+    def __init__(self, path):
+        self.path = path
+        self.socket = None
+        self.file = None
+        self.info = {}
+
+    def connect(self, pipeline, model_name, configs):
+        """Connect and ask for pipeline on model_name, returns None when the worker serves it,
+        otherwise why not."""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError as error:
+            sock.close()
+            return f"no model worker on {self.path} ({error.strerror or error})"
+        self.socket = sock
+        self.file = sock.makefile("rwb")
+        answer = self.call(dict(op="hello", pipeline=pipeline, model_name=model_name, configs=configs))
+        if not answer.get("ok"):
+            self.close()
+            return f"the model worker on {self.path} {answer.get('reason')}"
+        self.info = answer
+        return None
+
+    def send(self, request):
+        self.file.write((json.dumps(request) + "\n").encode("utf-8"))
+        self.file.flush()
+
+    def receive(self):
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError(f"the model worker on {self.path} closed the connection")
+        answer = json.loads(line)
+        if "error" in answer:
+            raise RuntimeError(f"model worker: {answer['error']}")
+        return answer
+
+    def call(self, request):
+        self.send(request)
+        return self.receive()
+
+    def generate(self, configs, list_of_messages, batch_size=None, budgets=None):
+        """Yield the answers of the worker to one generate request, batch by batch, the last
+        one with done set."""
+        self.send(dict(op="generate", configs=configs, messages=list_of_messages,
+                       batch_size=batch_size, budgets=budgets))
+        while True:
+            answer = self.receive()
+            yield answer
+            if answer.get("done"):
+                return
+
+    def score(self, configs, prompts, continuations):
+        return self.call(dict(op="score", configs=configs, prompts=prompts, continuations=continuations))
+
+    def close(self):
+        if self.socket is not None:
+            self.file.close()
+            self.socket.close()
+            self.socket = None
+
+#==================================================================================================
+# Worker side
+#==================================================================================================
+class Model_Worker:
+    def __init__(self, pipeline, model_name, configs):
+        self.pipeline = pipeline
+        self.model_name = model_name
+        self.configs = configs
+        self.tasks = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def hello(self, request):
+        if request["model_name"] != self.model_name:
+            return dict(ok=False, reason=f"serves {self.model_name}, not {request['model_name']}")
+        if request["pipeline"] != type(self.pipeline).__name__:
+            return dict(ok=False, reason=f"runs {type(self.pipeline).__name__}, not {request['pipeline']}")
+        for key in MODEL_KEYS:
+            if request["configs"].get(key) != self.configs.get(key):
+                return dict(ok=False, reason=f"loaded the model with {key}={self.configs.get(key)}, "
+                                             f"not {request['configs'].get(key)}")
+        #a driver pinned to another device loads its own model. The device string cannot tell apart
+        #drivers under another CUDA_VISIBLE_DEVICES, parallel_runner.py shards pass --no-worker instead
+        device = request["configs"].get("device", "auto")
+        if device not in (None, "auto") and device != self.pipeline.device:
+            return dict(ok=False, reason=f"runs on {self.pipeline.device}, not {device}")
+        return dict(ok=True, device=self.pipeline.device, pid=os.getpid())
+
+    def status(self):
+        return dict(model_name=self.model_name, pipeline=type(self.pipeline).__name__,
+                    device=self.pipeline.device, tasks=len(self.tasks), requests=self.requests)
+
+    def task(self, configs):
+        """Pipeline of a request's configs, kept while they do not change."""
+        #the model settings as loaded, the response cache keys are those of an in-process run
+        configs = dict(configs, **{key: self.pipeline.configs[key] for key in MODEL_KEYS if key in self.pipeline.configs})
+        key = json.dumps(configs, sort_keys=True)
+        if key not in self.tasks:
+            if len(self.tasks) >= MAX_TASKS:
+                del self.tasks[next(iter(self.tasks))]
+                self.pipeline.empty_cache()
+            self.tasks[key] = self.pipeline.for_task(configs)
+        task = self.tasks.pop(key)
+        self.tasks[key] = task  #most recently used last
+        return task
+
+    def generate(self, request):
+        with self.lock:
+            task = self.task(request["configs"])
+            task.stop_reasons.clear()  #the stop reasons of the summary are the driver run's
+            generated_tokens = task.generated_tokens
+            start = time.time()
+            for indices, outputs in task.inference_scheduled(request["messages"], batch_size=request.get("batch_size"),
+                                                             budgets=request.get("budgets")):
+                yield dict(indices=list(indices), outputs=outputs, metrics=task.last_metrics)
+            self.requests += 1
+            print(f"Request {self.requests}: {len(request['messages'])} conversations in {time.time() - start:.1f}s")
+            yield dict(done=True, report=task.report(), generated_tokens=task.generated_tokens - generated_tokens)
+
+    def score(self, request):
+        with self.lock:
+            task = self.task(request["configs"])
+            scores = task.score_continuations(request["prompts"], request["continuations"])
+            self.requests += 1
+            return dict(scores=scores, metrics=task.last_metrics, report=task.score_report())
+
+class Worker_Handler(socketserver.StreamRequestHandler):
+    worker = None
+
+    def write(self, answer):
+        self.wfile.write((json.dumps(answer, default=str) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def handle(self):
+        for line in self.rfile:
+            request = json.loads(line)
+            answers = iter(())
+            try:
+                if request["op"] == "hello":
+                    answers = iter([self.worker.hello(request)])
+                elif request["op"] == "status":
+                    answers = iter([self.worker.status()])
+                elif request["op"] == "generate":
+                    answers = self.worker.generate(request)
+                elif request["op"] == "score":
+                    answers = iter([self.worker.score(request)])
+                else:
+                    raise ValueError(f"unknown op {request['op']}")
+                for answer in answers:
+                    self.write(answer)
+            except (BrokenPipeError, ConnectionResetError):
+                #the driver stopped, the rest of its request is dropped
+                print("Driver disconnected")
+                return
+            except Exception as error:
+                traceback.print_exc()
+                self.write({"error": f"{type(error).__name__}: {error}"})
+            finally:
+                if hasattr(answers, "close"):
+                    answers.close()
+
+class Worker_Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+#==================================================================================================
+def parse_args():
+    parser = argparse.ArgumentParser(description="Model worker serving the drivers over a Unix socket")
+    parser.add_argument("--model", default="mistralai/Mistral-7B-Instruct-v0.3", help="Hugging Face model name or local checkpoint")
+    parser.add_argument("--pipeline", default="mistral", choices=["mistral", "qwen", "llama"])
+    parser.add_argument("--socket", default=WORKER_SOCKET)
+    parser.add_argument("--no-quantization", action="store_true", help="load the model unquantized (the drivers ask for 4 bit)")
+    parser.add_argument("--dtype", default=None)
+    parser.add_argument("--device", default="auto", help="auto, cuda, cuda:N or cpu")
+    parser.add_argument("--num-threads", type=int, default=None, help="torch threads of the worker")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    import llms_class
+    pipelines = {"mistral": llms_class.Mistral_Pipeline, "qwen": llms_class.Qwen_Pipeline, "llama": llms_class.Llama_Pipeline}
+    configs = {"quantization": not args.no_quantization, "device": args.device, "num_threads": args.num_threads}
+    if args.dtype:
+        configs["dtype"] = args.dtype
+    start = time.time()
+    #load_model turns the quantization off on CPU, the drivers are matched on the settings asked for
+    pipeline = pipelines[args.pipeline](args.model, dict(configs))
+    print(f"{args.model} loaded in {time.time() - start:.1f}s")
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.socket)), exist_ok=True)
+    if os.path.exists(args.socket):
+        os.remove(args.socket)  #left by a worker that was killed
+    Worker_Handler.worker = Model_Worker(pipeline, args.model, configs)
+    server = Worker_Server(args.socket, Worker_Handler)
+    print(f"Model worker on {args.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+#==================================================================================================
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/13 10:21:37
+@author: SIRConceicao
+
+Asynchronous client of an OpenAI-compatible chat completions endpoint
+(vLLM, TGI, llama.cpp server, openai_stub_server.py, ...).
+
+One httpx.AsyncClient keeps a pool of keep-alive connections to the server and a
+semaphore caps the requests in flight. A request that times out, cannot connect or
+is answered 429/5xx is retried with exponential backoff and jitter (Retry-After is
+honoured); other HTTP errors are raised at once.
+'''
+import time
+import random
+import asyncio
+import httpx
+
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+#finish_reason of the server -> stop reason of the local pipelines
+FINISH_REASONS = {"stop": "eos", "length": "max_new_tokens"}
+#==================================================================================================
+class Chat_Client:
+    def __init__(self, api_base, api_key=None, max_concurrency=8, max_retries=4,
+                 request_timeout=300.0, connect_timeout=10.0, backoff=1.0, max_backoff=30.0):
+        self.url = api_base.rstrip("/") + "/chat/completions"
+        self.headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.timeout = httpx.Timeout(request_timeout, connect=connect_timeout)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.client = None
+        self.semaphore = None
+        self.requests = 0
+        self.retries = 0
+
+    def open(self):
+        """Create the pool and the semaphore, inside the event loop that will use them."""
+        if self.client is None:
+            limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+            self.client = httpx.AsyncClient(headers=self.headers, timeout=self.timeout, limits=limits)
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def retry_delay(self, attempt, response=None):
+        if response is not None and response.headers.get("retry-after", "").isdigit():
+            return float(response.headers["retry-after"])
+        return min(self.backoff * 2**attempt, self.max_backoff) * (0.5 + random.random())
+
+    async def chat(self, payload):
+        """POST one chat completion request, returns the decoded JSON answer and the seconds
+        spent on it once it got a slot (retries included)."""
+        self.open()
+        async with self.semaphore:
+            start = time.time()
+            for attempt in range(self.max_retries + 1):
+                response = None
+                try:
+                    response = await self.client.post(self.url, json=payload)
+                    if response.status_code not in RETRY_STATUS:
+                        response.raise_for_status()
+                        self.requests += 1
+                        return response.json(), time.time() - start
+                    error = httpx.HTTPStatusError(f"{response.status_code} from {self.url}",
+                                                  request=response.request, response=response)
+                except (httpx.TimeoutException, httpx.TransportError) as e:
+                    error = e
+                if attempt == self.max_retries:
+                    raise error
+                self.retries += 1
+                delay = self.retry_delay(attempt, response)
+                print(f"Request failed ({error!r}), retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    def report(self):
+        return f"HTTP backend: {self.requests} requests, {self.retries} retries, {self.url}"
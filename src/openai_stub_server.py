@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/13 11:48:02
+@author: SIRConceicao
+
+Minimal OpenAI-compatible chat completions server (standard library only) to run
+OpenAI_Pipeline and the drivers offline. Every request is answered with --response,
+cut to max_tokens words, after --delay seconds; --fail-rate answers a fraction of the
+requests with 503 to exercise the client retries.
+
+Usage (from the repository root):
+    python src/openai_stub_server.py --port 8000
+    python src/main_baseline_labels.py --api-base http://localhost:8000/v1 --no-cache
+'''
+import json
+import time
+import random
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EMPTY_RELATIONS = '{"ternary_tag_based_relations": [], "ternary_mention_based_relations": []}'
+#==================================================================================================
+class Stub_Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  #keep-alive, the client reuses its connections
+    args = None
+    requests_served = 0
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self.send_json(200, {"object": "list", "data": [{"id": self.args.model, "object": "model"}]})
+        else:
+            self.send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+            return
+        time.sleep(self.args.delay)
+        if random.random() < self.args.fail_rate:
+            self.send_json(503, {"error": {"message": "stub server overloaded"}})
+            return
+
+        words = self.args.response.split(" ")
+        max_tokens = request.get("max_tokens") or len(words)
+        content = " ".join(words[:max_tokens])
+        prompt_tokens = sum(len(str(message.get("content", "")).split()) for message in request.get("messages", []))
+        Stub_Handler.requests_served += 1
+        self.send_json(200, {
+            "id": f"chatcmpl-stub-{Stub_Handler.requests_served}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", self.args.model),
+            "choices": [{"index": 0,
+                         "message": {"role": "assistant", "content": content},
+                         "finish_reason": "stop" if len(words) <= max_tokens else "length"}],
+            "usage": {"prompt_tokens": prompt_tokens,
+                      "completion_tokens": min(len(words), max_tokens),
+                      "total_tokens": prompt_tokens + min(len(words), max_tokens)},
+            })
+
+    def log_message(self, format, *args):
+        if not self.args.quiet:
+            super().log_message(format, *args)
+
+#==================================================================================================
+def parse_args():
+    parser = argparse.ArgumentParser(description="OpenAI-compatible stub server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--model", default="stub")
+    parser.add_argument("--response", default=EMPTY_RELATIONS, help="text of every answer")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds before answering")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of requests answered 503")
+    parser.add_argument("--quiet", action="store_true")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    Stub_Handler.args = args
+    server = ThreadingHTTPServer((args.host, args.port), Stub_Handler)
+    print(f"Stub server on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+#==================================================================================================
+
+if __name__ == "__main__":
+    main()
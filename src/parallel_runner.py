@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/10 15:02:44
+@author: SIRConceicao
+
+Data-parallel runner: one driver process per shard of PMIDs.
+
+The PMIDs of the driver input file are split into N contiguous shards. Shard k runs
+    python <driver> --shard k/N ...
+with its own pipeline, pinned to one GPU (CUDA_VISIBLE_DEVICES) or to a set of CPU
+cores (sched_setaffinity + --num-threads), and writes
+    data/intermediate/<output>.shard-k-of-N.json / .LOGS / .metrics.jsonl
+Once every shard has finished, the shard files are merged into the usual
+<output>.json / .LOGS / .metrics.jsonl in shard order, which is the PMID order of
+the input file, and the metrics summary is computed over all the shards.
+
+Usage (from the repository root):
+    python src/parallel_runner.py src/main_baseline_labels.py --shards 4 --devices cuda:0,cuda:1,cuda:2,cuda:3
+    python src/parallel_runner.py src/NER/ner_llm_test_baseline.py --shards 8 --devices cpu -- --no-cache
+'''
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import subprocess
+from call_metrics import Metrics_Log
+
+#==================================================================================================
+# Driver side
+#==================================================================================================
+def shard_path(path, k, n):
+    base, ext = os.path.splitext(path)
+    return f"{base}.shard-{k}-of-{n}{ext}"
+
+def select_shard(data, output_path, output_logs, shard):
+    """Keep the k-th of N contiguous blocks of PMIDs (shard = "k/N") and the shard output paths."""
+    k, n = (int(x) for x in shard.split("/"))
+    pmids = list(data)
+    start, end = k * len(pmids) // n, (k + 1) * len(pmids) // n
+    data = {pmid: data[pmid] for pmid in pmids[start:end]}
+    print(f"Shard {k}/{n}: {len(data)} documents")
+    return data, shard_path(output_path, k, n), shard_path(output_logs, k, n)
+
+#==================================================================================================
+# Runner side
+#==================================================================================================
+def cpu_core_sets(n):
+    """n disjoint blocks of the usable cores, shards share cores when there are fewer cores than shards."""
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) < n:
+        return [[cores[k % len(cores)]] for k in range(n)]
+    return [cores[k * len(cores) // n:(k + 1) * len(cores) // n] for k in range(n)]
+
+def launch_shard(script, k, n, device, cores, driver_args):
+    env = dict(os.environ)
+    #every shard loads its own model, a running model_worker.py would serve them one at a time
+    command = [sys.executable, script, "--shard", f"{k}/{n}", "--no-worker"]
+    preexec_fn = None
+
+    if device == "cpu":
+        env["OMP_NUM_THREADS"] = str(len(cores))
+        command += ["--device", "cpu", "--num-threads", str(len(cores))]
+        preexec_fn = lambda: os.sched_setaffinity(0, cores)
+    else:
+        #one visible GPU per shard, the pipeline sees it as "cuda"
+        env["CUDA_VISIBLE_DEVICES"] = device.split(":")[-1] if ":" in device else "0"
+        command += ["--device", "cuda"]
+
+    print(f"Shard {k}/{n} on {device}{f' cores {cores[0]}-{cores[-1]}' if device == 'cpu' else ''}")
+    return subprocess.Popen(command + driver_args, env=env, preexec_fn=preexec_fn)
+
+def merge_shards(output_dir, n, since):
+    """Merge every <output>.shard-k-of-N.json/.LOGS/.metrics.jsonl written after `since` into <output>.*"""
+    merged = []
+    for first in sorted(glob.glob(os.path.join(output_dir, f"*.shard-0-of-{n}.json"))):
+        if os.path.getmtime(first) < since:
+            continue
+        output_path = first.replace(f".shard-0-of-{n}.json", ".json")
+        output_logs = first.replace(f".shard-0-of-{n}.json", ".LOGS")
+
+        data = {}
+        for k in range(n):
+            with open(shard_path(output_path, k, n), "r") as file:
+                data.update(json.load(file))
+        with open(output_path, "w") as f:
+            json.dump(data, f, indent=2)
+
+        with open(output_logs, "w") as logfile:
+            for k in range(n):
+                if os.path.exists(shard_path(output_logs, k, n)):
+                    with open(shard_path(output_logs, k, n), "r") as shard_log:
+                        logfile.write(shard_log.read())
+
+        metrics = Metrics_Log(output_path)
+        shard_metrics = [Metrics_Log(shard_path(output_path, k, n), resume=True) for k in range(n)]
+        with open(metrics.path, "w") as metrics_file:
+            for shard in shard_metrics:
+                if os.path.exists(shard.path):
+                    with open(shard.path, "r") as shard_file:
+                        metrics_file.write(shard_file.read())
+        metrics.close()
+
+        for k in range(n):
+            for path in (shard_path(output_path, k, n), shard_path(output_logs, k, n),
+                         shard_metrics[k].path, shard_metrics[k].summary_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        print(f"Merged {n} shards into {output_path} ({len(data)} documents)")
+        merged.append(output_path)
+    return merged
+
+#==================================================================================================
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run a driver on N shards of PMIDs in parallel")
+    parser.add_argument("script", help="driver script, e.g. src/main_baseline_labels.py")
+    parser.add_argument("--shards", type=int, required=True)
+    parser.add_argument("--devices", default="cpu",
+                        help="comma separated devices assigned round robin to the shards (cuda:0,cuda:1 or cpu)")
+    parser.add_argument("--output-dir", default="data/intermediate")
+    #arguments after -- are passed to the driver
+    argv = sys.argv[1:]
+    split = argv.index("--") if "--" in argv else len(argv)
+    args = parser.parse_args(argv[:split])
+    args.driver_args = argv[split + 1:]
+    return args
+
+def main():
+    args = parse_args()
+    n = args.shards
+    devices = args.devices.split(",")
+    core_sets = cpu_core_sets(sum(1 for k in range(n) if devices[k % len(devices)] == "cpu") or 1)
+
+    start = time.time()
+    processes = []
+    cpu_shards = 0
+    for k in range(n):
+        device = devices[k % len(devices)]
+        cores = None
+        if device == "cpu":
+            cores = core_sets[cpu_shards]
+            cpu_shards += 1
+        processes.append(launch_shard(args.script, k, n, device, cores, args.driver_args))
+
+    failed = [k for k, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        #finished PMIDs are checkpointed per shard, re-running the same command resumes them
+        print(f"Shards {failed} failed, outputs not merged")
+        sys.exit(1)
+
+    merge_shards(args.output_dir, n, start)
+    print(f"{n} shards done in {time.time() - start:.0f}s")
+
+#==================================================================================================
+
+if __name__ == "__main__":
+    main()
@@ -15,12 +15,19 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import re
 import json
+import argparse
 import torch
 from prompts.qwen_prompts import system_prompts
 from prompts.llama_prompts import system_prompts as llama_sysprompt
 from misc.utils import defined_relations,format_defined_relations
 import llms_class
+from checkpoint import Checkpoint
+from parallel_runner import select_shard
+from call_metrics import Metrics_Log
+from budget_estimator import Budget_Estimator,log_block
 
+
+PREDICTED_KEYS=('ternary_tag_based_relations_predicted','ternary_mention_based_relations_predicted','llm_output')
 #==================================================================================================
 def load_data(doc_path):
     """Load JSON data from the specified file path."""
@@ -50,7 +57,31 @@ def messages_format_llama(system_prompt,defined_relations,text):
 
     return messages
 #==================================================================================================
+def parse_args():
+    parser = argparse.ArgumentParser(description="Baseline system")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the LLM response cache")
+    parser.add_argument("--refresh", action="store_true", help="Regenerate every answer and overwrite the cached responses")
+    parser.add_argument("--model", default="mistralai/Mistral-7B-Instruct-v0.3", help="Hugging Face model name or local checkpoint")
+    parser.add_argument("--device", default="auto", help="auto, cuda, cuda:N or cpu")
+    parser.add_argument("--num-threads", type=int, default=None, help="torch threads of this process")
+    parser.add_argument("--engine", default="static", choices=["static", "continuous"], help="static batches or continuous batching (see continuous_batching.py)")
+    parser.add_argument("--compile", action="store_true", help="static KV cache and torch.compile'd decoding (static engine)")
+    parser.add_argument("--kv-cache-bits", type=int, choices=[0, 4, 8], default=None, help="int8/int4 KV cache, larger batches in the same memory (0: full precision)")
+    parser.add_argument("--adaptive-max-new-tokens", action="store_true", help="per-document max_new_tokens calibrated on the .LOGS of data/intermediate (longer answers are cut)")
+    parser.add_argument("--token-budget", type=int, default=None, help="group the prompts by length into batches of at most N prompt + max_new_tokens tokens (default: batches of batch_size in input order)")
+    parser.add_argument("--prefix-cache", action="store_true", help="prefill the block shared by every prompt once and reuse its KV cache in every batch")
+    parser.add_argument("--stop-on-json", action="store_true", help="stop a row as soon as its JSON answer is closed (see stopping_criteria.py)")
+    parser.add_argument("--max-repeats", type=int, default=None, help="stop a row once the same relation/entity object has been generated N times")
+    parser.add_argument("--constrained", action="store_true", help="mask the logits so the answer follows the JSON schema with the legal labels (see constrained_decoding.py)")
+    parser.add_argument("--adapter", default=None, help="LoRA adapter of the RE task (PEFT directory or hub id) on top of --model")
+    parser.add_argument("--no-worker", action="store_true", help="load the model in this process even when src/model_worker.py serves it")
+    parser.add_argument("--api-base", default=None, help="OpenAI-compatible server (e.g. http://localhost:8000/v1) serving --model, instead of loading it")
+    parser.add_argument("--prompt-lookup", type=int, default=None, help="draft N tokens by copying spans of the prompt (one sequence at a time)")
+    parser.add_argument("--shard", default=None, help="k/N: only run the k-th of N blocks of PMIDs (see parallel_runner.py)")
+    return parser.parse_args()
+#==================================================================================================
 def main():
+    args=parse_args()
     #doc_path = "data/GutBrainIE_Full_Collection_2025/Test_Data/Test_Data/articles_test.json"
     doc_path = "data/GutBrainIE_Full_Collection_2025/Test_Data/Test_Data/articles_test.json"
     data=load_data(doc_path)
@@ -65,51 +96,108 @@ def main():
     configs={
         "temperature":0.2,
         "max_new_tokens":4096,
-        "quantization":True
+        "quantization":True,
+        "batch_size":8,
+        "token_budget":args.token_budget,
+        "prefix_cache":args.prefix_cache,
+        "stop_on_json":"object" if args.stop_on_json else None,
+        "max_repeats":args.max_repeats,
+        "constrained_schema":"relations" if args.constrained else None,
+        "response_cache":None if args.no_cache else "data/cache/responses",
+        "refresh_cache":args.refresh,
+        "token_cache":"data/cache/tokens",
+        "device":args.device,
+        "num_threads":args.num_threads,
+        "prompt_lookup_num_tokens":args.prompt_lookup,
+        "api_base":args.api_base,
+        "engine":args.engine,
+        "compile":args.compile,
+        "kv_cache_bits":args.kv_cache_bits,
+        "adaptive_max_new_tokens":args.adaptive_max_new_tokens,
+        "adapters":{"re":args.adapter} if args.adapter else None,
+        "adapter":"re" if args.adapter else None,
+        "worker_socket":None if args.no_worker else "data/cache/model_worker.sock"
         }
     #---------------------------------------------------------------------
     #Mistral
-    model_name = "mistralai/Mistral-7B-Instruct-v0.3"
-    mistral=llms_class.Mistral_Pipeline(model_name,configs)
+    model_name = args.model
+    if args.api_base:
+        mistral=llms_class.OpenAI_Pipeline(model_name,configs)
+    else:
+        mistral=llms_class.load_pipeline(llms_class.Mistral_Pipeline,model_name,configs)
     system_prompt = system_prompts['prompt2']
     #---------------------------------------------------------------------
     output_path=f"data/intermediate/{model_name.split("/")[-1]}-raw-baseline-it-outputs.json"
     output_logs=f"data/intermediate/{model_name.split("/")[-1]}-raw-baseline-it-outputs.LOGS"
+    estimator=None
+    if configs["adaptive_max_new_tokens"]:
+        estimator=Budget_Estimator(configs["max_new_tokens"],tokenizer=getattr(mistral,"tokenizer",None),
+                                 calibration=output_path)
+    if args.shard:
+        data,output_path,output_logs=select_shard(data,output_path,output_logs,args.shard)
 
-    with open(output_logs,'w') as logfile:
-        logfile.write(f"Input File {doc_path}\n LLM Config:\n{configs}\nPrompt{str(system_prompt)}\n\n")
-        for annot in data:
-            jbase= data[annot]
+    checkpoint=Checkpoint(output_path)
+    done=checkpoint.load()
+    metrics=Metrics_Log(output_path,resume=bool(done))
 
-            title = jbase['title']
-            abstract = jbase['abstract']
+    records=[]
+    for annot in data:
+        if annot in done:
+            continue
+        jbase= data[annot]
 
-            text = title + "\n " + abstract
+        title = jbase['title']
+        abstract = jbase['abstract']
 
-            messages=messages_format(system_prompt,formated_rel_dict,text)
-            output= mistral.inference(messages)
-            content = output.split("[/INST]")[-1].strip("]</s>").strip()
+        text = title + "\n " + abstract
 
-            logfile.write(f"{annot}\n{output}\n\n")
+        records.append((annot,messages_format(system_prompt,formated_rel_dict,text)))
 
-            try:
-                answer = json.loads(f"[{content}]")
-                jbase['ternary_tag_based_relations_predicted']=answer['ternary_tag_based_relations']
-                jbase['ternary_mention_based_relations_predicted']=answer['ternary_mention_based_relations']
+    budgets=None
+    if estimator is not None and records:
+        estimator.calibrate(dict(records),data)
+        budgets=[estimator.predict(data[annot]) for annot,_ in records]
+        print(estimator.report(budgets))
 
-            except TypeError: #[{'ternary_tag_based_relations': [...], 'ternary_mention_based_relations': [...]}]
-                answer = json.loads(f"[{content}]")[0]
-                jbase['ternary_tag_based_relations_predicted']=answer['ternary_tag_based_relations']
-                jbase['ternary_mention_based_relations_predicted']=answer['ternary_mention_based_relations']
+    with open(output_logs,'a' if done else 'w') as logfile, mistral:
+        logfile.write(f"Input File {doc_path}\n LLM Config:\n{configs}\nPrompt{str(system_prompt)}\n\n")
+        if done:
+            logfile.write(f"Resumed from {checkpoint.path}: {len(done)} documents already done\n\n")
+        for indices,outputs in mistral.inference_scheduled([messages for _,messages in records],budgets=budgets):
+
+            for i,output,call in zip(indices,outputs,mistral.last_metrics):
+                annot=records[i][0]
+                jbase= data[annot]
+                content = output.split("[/INST]")[-1].strip("]</s>").strip()
+
+                logfile.write(log_block(annot,records[i][1],output))
+
+                try:
+                    answer = json.loads(f"[{content}]")
+                    jbase['ternary_tag_based_relations_predicted']=answer['ternary_tag_based_relations']
+                    jbase['ternary_mention_based_relations_predicted']=answer['ternary_mention_based_relations']
+
+                except TypeError: #[{'ternary_tag_based_relations': [...], 'ternary_mention_based_relations': [...]}]
+                    answer = json.loads(f"[{content}]")[0]
+                    jbase['ternary_tag_based_relations_predicted']=answer['ternary_tag_based_relations']
+                    jbase['ternary_mention_based_relations_predicted']=answer['ternary_mention_based_relations']
             
-            except json.decoder.JSONDecodeError:
-                answer= content
+                except json.decoder.JSONDecodeError:
+                    answer= content
               
-                jbase['llm_output']=answer
-            
-            torch.cuda.empty_cache()
+                    jbase['llm_output']=answer
+
+                checkpoint.write(annot,{key:jbase[key] for key in PREDICTED_KEYS if key in jbase})
+                metrics.write(annot,call)
+
+    checkpoint.close()
+    metrics.close()
+    for annot,record in done.items():
+        data[annot].update(record)
+
     with open(output_path, "w") as f: 
         json.dump(data, f, indent=2)
+    checkpoint.remove()
 
 #==================================================================================================
 
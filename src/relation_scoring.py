@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/23 10:05:18
+@author: SIRConceicao
+
+RE BY SCORING the candidate entity pairs, no generation
+
+main_baseline_labels.py generates the whole JSON answer of an abstract, the slowest and
+most fragile step of the system. Here the candidates are enumerated from the tagged text
+instead: every pair of distinct <eN> mentions, at most max_sentence_distance sentences
+apart, whose (subject, object) types defined_relations allows. Each candidate is asked
+(scoring_prompt1) which of its legal predicates, or none, the text states, and every
+answer is scored by its log-likelihood in batched forward passes
+(llms_class.Base_Pipeline.score_continuations). The rows of a document share the prompt
+up to the question, which is run once.
+
+The probabilities of the answers of a pair are the softmax of their scores divided by
+their number of tokens, so that "none" is not favoured for being short; the best
+predicate is kept when its probability reaches the threshold. The mention relations and
+their distinct label triples are written under the *_predicted keys of final_format.py.
+With --dev the gold relations of the dev set give precision/recall/F1 of the mention
+relations at several thresholds, from the same scores.
+'''
+import os
+import re
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import json
+import math
+import argparse
+from prompts.qwen_prompts import system_prompts
+from misc.utils import defined_relations,legal_predicates,normalize_label
+import llms_class
+from checkpoint import Checkpoint
+from parallel_runner import select_shard
+from call_metrics import Metrics_Log
+from joint_ner_re import tag_relations
+
+PREDICTED_KEYS=('ternary_tag_based_relations_predicted','ternary_mention_based_relations_predicted')
+ENTITY=re.compile(r"<e\d+>@([^$<]+)\$\s*(.*?)\s*@/[^$<]+\$</e\d+>")
+SENTENCE_END=re.compile(r"(?<=[.!?])\s+(?=[A-Z<])|\n")
+SWEEP=(0.3,0.4,0.5,0.6,0.7,0.8,0.9)
+#==================================================================================================
+def load_data(doc_path):
+    with open(doc_path, 'r') as file:
+        data = json.load(file)
+    return data
+#==================================================================================================
+def messages_format(system_prompt,tagged_text,candidate,predicates):
+    """mistral and qwen format"""
+    prompt = system_prompt.format(sentence=tagged_text,predicates=", ".join(predicates),**candidate)
+
+    messages = [
+        {"role": "user", "content": prompt}
+    ]
+
+    return messages
+#==================================================================================================
+def candidate_pairs(tagged_text, predicates, max_sentence_distance=1):
+    """[(candidate, legal predicates, sentence distance)]: the distinct (subject, object) mentions
+    at most max_sentence_distance sentences apart whose types have defined relations, with the
+    distance of their closest occurrences."""
+    mentions=[]
+    for sentence,text in enumerate(SENTENCE_END.split(tagged_text)):
+        for label,span in ENTITY.findall(text):
+            mentions.append((sentence,span,label.strip()))
+
+    candidates={}
+    for subject_sentence,subject_span,subject_label in mentions:
+        for object_sentence,object_span,object_label in mentions:
+            distance=abs(subject_sentence-object_sentence)
+            if distance>max_sentence_distance or subject_span.lower()==object_span.lower():
+                continue
+            legal=predicates.get((normalize_label(subject_label),normalize_label(object_label)))
+            key=(subject_span.lower(),normalize_label(subject_label),object_span.lower(),normalize_label(object_label))
+            if legal and (key not in candidates or distance<candidates[key][2]):
+                candidates[key]=({"subject_text_span":subject_span,"subject_label":subject_label,
+                                  "object_text_span":object_span,"object_label":object_label},legal,distance)
+    return list(candidates.values())
+
+def softmax(scores, lengths):
+    """Probabilities of the answers from their summed log-probabilities and token counts. The
+    mean log-probability per token is used, a sum favours the shortest answer ("none")."""
+    means=[score/length for score,length in zip(scores,lengths)]
+    top=max(means)
+    weights=[math.exp(mean-top) for mean in means]
+    return [weight/sum(weights) for weight in weights]
+
+def best_relation(candidate, options, probabilities, threshold):
+    """Mention relation of the most likely predicate, None when it is none or under the threshold."""
+    probability,predicate=max(zip(probabilities,options))
+    if predicate=="none" or probability<threshold:
+        return None
+    return {"subject_text_span":candidate["subject_text_span"],"subject_label":candidate["subject_label"],
+            "predicate":predicate,
+            "object_text_span":candidate["object_text_span"],"object_label":candidate["object_label"]}
+#==================================================================================================
+def relation_key(relation):
+    return (relation["subject_text_span"].lower(),normalize_label(relation["subject_label"]),relation["predicate"],
+            relation["object_text_span"].lower(),normalize_label(relation["object_label"]))
+
+def threshold_sweep(scored, gold):
+    """Precision/recall/F1 of the mention relations at the SWEEP thresholds.
+    scored: {pmid: [(relation at threshold 0, probability)]}, gold: {pmid: gold relations}."""
+    lines=[f"{'threshold':>10}{'P':>8}{'R':>8}{'F1':>8}{'relations':>11}"]
+    for threshold in SWEEP:
+        tp=predicted=expected=0
+        for pmid,relations in gold.items():
+            keys={relation_key(relation) for relation,probability in scored.get(pmid,[]) if probability>=threshold}
+            gold_keys={relation_key(relation) for relation in relations}
+            tp+=len(keys&gold_keys)
+            predicted+=len(keys)
+            expected+=len(gold_keys)
+        precision=tp/predicted if predicted else 0.0
+        recall=tp/expected if expected else 0.0
+        f1=2*precision*recall/(precision+recall) if precision+recall else 0.0
+        lines.append(f"{threshold:>10}{precision:>8.3f}{recall:>8.3f}{f1:>8.3f}{predicted:>11}")
+    return "\n".join(lines)
+#==================================================================================================
+def parse_args():
+    parser = argparse.ArgumentParser(description="RE by scoring the candidate entity pairs")
+    parser.add_argument("--model", default="mistralai/Mistral-7B-Instruct-v0.3", help="Hugging Face model name or local checkpoint")
+    parser.add_argument("--device", default="auto", help="auto, cuda, cuda:N or cpu")
+    parser.add_argument("--num-threads", type=int, default=None, help="torch threads of this process")
+    parser.add_argument("--threshold", type=float, default=0.5, help="probability of the best predicate needed to keep a relation")
+    parser.add_argument("--max-sentence-distance", type=int, default=1, help="sentences between the two mentions of a candidate pair")
+    parser.add_argument("--score-batch-size", type=int, default=16, help="rows of every forward pass")
+    parser.add_argument("--dev", action="store_true", help="score the dev set and print precision/recall/F1 at several thresholds")
+    parser.add_argument("--adapter", default=None, help="LoRA adapter of the RE task (PEFT directory or hub id) on top of --model")
+    parser.add_argument("--no-worker", action="store_true", help="load the model in this process even when src/model_worker.py serves it")
+    parser.add_argument("--shard", default=None, help="k/N: only run the k-th of N blocks of PMIDs (see parallel_runner.py)")
+    return parser.parse_args()
+#==================================================================================================
+def main():
+    args=parse_args()
+    doc_path = "data/GutBrainIE_tagged/Annotations/Test/lasigeBioTM_subtask6_1_NER_Mistral-7B-Instruct-v0.3_fixed_tagged.json"
+    if args.dev:
+        doc_path = "data/GutBrainIE_tagged/Annotations/Dev/dev_tagged.json"
+    data=load_data(doc_path)
+
+    #(subject type, object type) -> predicates
+    predicates=legal_predicates(defined_relations())
+
+    #---------------------------------------------------------------------
+    #LLM CONFIGS
+    configs={
+        "quantization":True,
+        "score_batch_size":args.score_batch_size,
+        "min_prefix_tokens":32,
+        "threshold":args.threshold,
+        "max_sentence_distance":args.max_sentence_distance,
+        "device":args.device,
+        "num_threads":args.num_threads,
+        "adapters":{"re":args.adapter} if args.adapter else None,
+        "adapter":"re" if args.adapter else None,
+        "worker_socket":None if args.no_worker else "data/cache/model_worker.sock"
+        }
+    #---------------------------------------------------------------------
+    #Mistral
+    model_name = args.model
+    llm=llms_class.load_pipeline(llms_class.Mistral_Pipeline,model_name,configs)
+    system_prompt = system_prompts['scoring_prompt1']
+    #---------------------------------------------------------------------
+    split="dev" if args.dev else "it"
+    output_path=f"data/intermediate/{model_name.split("/")[-1]}-relation-scoring-{split}-outputs.json"
+    output_logs=f"data/intermediate/{model_name.split("/")[-1]}-relation-scoring-{split}-outputs.LOGS"
+    if args.shard:
+        data,output_path,output_logs=select_shard(data,output_path,output_logs,args.shard)
+
+    checkpoint=Checkpoint(output_path)
+    done=checkpoint.load()
+    metrics=Metrics_Log(output_path,resume=bool(done))
+
+    scored={}
+    with open(output_logs,'a' if done else 'w') as logfile, llm:
+        logfile.write(f"Input File {doc_path}\nLLM Config:\n{configs}\n\n")
+        if done:
+            logfile.write(f"Resumed from {checkpoint.path}: {len(done)} documents already done\n\n")
+        for annot in data:
+            if annot in done:
+                continue
+            jbase= data[annot]
+            meta= jbase.get('metadata',jbase)
+            tagged_text = meta['title_tagged'] + "\n " + meta['abstract_tagged']
+
+            candidates=candidate_pairs(tagged_text,predicates,configs["max_sentence_distance"])
+            prompts,continuations,rows=[],[],[]
+            for candidate,legal,_ in candidates:
+                prompt=llm.encode(messages_format(system_prompt,tagged_text,candidate,legal))
+                for option in legal+["none"]:
+                    prompts.append(prompt)
+                    continuations.append(llm.tokenizer(option,add_special_tokens=False)["input_ids"])
+                rows.append(len(prompts))
+            scores=llm.score_continuations(prompts,continuations) if prompts else []
+
+            relations,scored[annot]=[],[]
+            logfile.write(f"{annot}\n")
+            first=0
+            for (candidate,legal,_),last in zip(candidates,rows):
+                options=legal+["none"]
+                if None in scores[first:last]:
+                    #a row did not fit in memory, the pair gets no relation
+                    logfile.write(f"{candidate['subject_text_span']} -> {candidate['object_text_span']}: OutOfMemoryError\n")
+                    first=last
+                    continue
+                probabilities=softmax(scores[first:last],[len(answer) for answer in continuations[first:last]])
+                first=last
+                logfile.write(f"{candidate['subject_text_span']} ({candidate['subject_label']}) -> {candidate['object_text_span']} "
+                              f"({candidate['object_label']}): "+", ".join(f"{option} {p:.2f}" for option,p in zip(options,probabilities))+"\n")
+                relation=best_relation(candidate,options,probabilities,0.0)
+                if relation is not None:
+                    scored[annot].append((relation,max(probabilities)))
+                    if max(probabilities)>=configs["threshold"]:
+                        relations.append(relation)
+            logfile.write("\n")
+            print(f"{annot}: {len(candidates)} candidate pairs, {len(prompts)} rows, {len(relations)} relations")
+
+            jbase['ternary_mention_based_relations_predicted']=relations
+            jbase['ternary_tag_based_relations_predicted']=tag_relations(relations)
+            checkpoint.write(annot,{key:jbase[key] for key in PREDICTED_KEYS})
+            if prompts:
+                metrics.write(annot,llm.last_metrics[0])
+
+    print(llm.report())
+    checkpoint.close()
+    metrics.close()
+    for annot,record in done.items():
+        data[annot].update(record)
+
+    with open(output_path, "w") as f:
+        json.dump(data, f, indent=2)
+    checkpoint.remove()
+
+    gold={annot:data[annot]['relations'] for annot in scored if 'relations' in data[annot]}
+    if gold:
+        print(f"Mention relations on {len(gold)} documents (threshold {configs['threshold']} in the output):")
+        print(threshold_sweep(scored,gold))
+
+#==================================================================================================
+
+if __name__ == "__main__":
+    main()
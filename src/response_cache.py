@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/03 16:40:05
+@author: SIRConceicao
+
+Persistent content-addressed cache of LLM responses.
+
+Each response is stored as one JSON file named after the sha256 of the model name,
+the configs, the decoding parameters and the rendered prompt. Reading a response
+refreshes its modification time and the least recently used files are evicted once
+the cache grows over max_bytes.
+'''
+import os
+import json
+import hashlib
+from collections import OrderedDict
+
+#Configs that change how a run is executed but not what the model answers
+RUNTIME_CONFIG_KEYS = {
+    "batch_size", "token_budget", "bucket_size", "prefix_cache", "min_prefix_tokens",
+    "response_cache", "refresh_cache", "cache_max_bytes", "device", "num_threads",
+    "oom_min_new_tokens", "token_cache", "draft_model", "num_assistant_tokens",
+    "prompt_lookup_num_tokens", "max_matching_ngram_size", "api_base", "api_key", "max_concurrency",
+    "max_retries", "request_timeout", "engine", "admit_every", "static_cache", "compile",
+    "compile_mode", "compile_max_shapes", "static_cache_bucket", "adaptive_max_new_tokens",
+    "worker_socket",
+}
+#Configs that change the answers only when set: unset, the keys of earlier runs still match
+OPTIONAL_CONFIG_KEYS = {"kv_cache_bits", "kv_group_size", "kv_residual_length", "adapters", "adapter"}
+#==================================================================================================
+class Response_Cache:
+    def __init__(self, cache_dir, max_bytes=2 * 1024**3, refresh=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.load_index()
+
+    def load_index(self):
+        """Index of {key: size} ordered from least to most recently used."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".json"):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, name[:-len(".json")], stat.st_size))
+        self.index = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self.total_bytes = sum(self.index.values())
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    @staticmethod
+    def key(model_name, configs, decoding, rendered_prompt):
+        configs = {k: v for k, v in configs.items() if k not in RUNTIME_CONFIG_KEYS and (v or k not in OPTIONAL_CONFIG_KEYS)}
+        payload = json.dumps([model_name, configs, decoding, rendered_prompt], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        if self.refresh or key not in self.index:
+            self.misses += 1
+            return None
+        try:
+            with open(self.path(key), "r") as file:
+                output = json.load(file)["output"]
+        except (OSError, ValueError, KeyError):
+            self.index.pop(key, None)
+            self.misses += 1
+            return None
+
+        os.utime(self.path(key))
+        self.index.move_to_end(key)
+        self.hits += 1
+        #json has no tuples, Qwen_Pipeline answers (thinking, content)
+        return tuple(output) if isinstance(output, list) else output
+
+    def put(self, key, output):
+        tmp_path = f"{self.path(key)}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"output": output}, file)
+        os.replace(tmp_path, self.path(key))
+
+        self.total_bytes -= self.index.pop(key, 0)
+        self.index[key] = os.path.getsize(self.path(key))
+        self.total_bytes += self.index[key]
+        self.evict()
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.index) > 1:
+            key, size = self.index.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def report(self):
+        return (f"Response cache: {self.hits} hits, {self.misses} misses, "
+                f"{len(self.index)} entries ({self.total_bytes / 1024**2:.1f} MB)")
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/02 10:12:40
+@author: SIRConceicao
+
+Length bucketed batch scheduler for the LLM drivers.
+
+Documents are sorted by prompt length, grouped into buckets of similar length and
+packed into batches whose padded size (rows * (longest prompt + max_new_tokens))
+stays under a token budget. With per-document max_new_tokens (see budget_estimator.py)
+a batch reserves its largest one, and the documents of a bucket are ordered by it.
+'''
+#==================================================================================================
+class Length_Scheduler:
+    def __init__(self, token_budget, max_new_tokens, bucket_size=128, max_batch_size=None):
+        self.token_budget = token_budget
+        self.max_new_tokens = max_new_tokens
+        self.bucket_size = bucket_size
+        self.max_batch_size = max_batch_size
+
+    def batch_cost(self, lengths, budgets=None):
+        """Padded tokens reserved by a batch: every row is as long as the longest one."""
+        return len(lengths) * (max(lengths) + (max(budgets) if budgets else self.max_new_tokens))
+
+    def schedule(self, lengths, budgets=None):
+        """Returns a list of batches, each a list of indices into lengths. budgets: the
+        max_new_tokens of every prompt, self.max_new_tokens for all when None."""
+        if budgets is None:
+            order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        else:
+            order = sorted(range(len(lengths)), key=lambda i: (lengths[i] // self.bucket_size, budgets[i], lengths[i]))
+
+        batches = []
+        current = []
+        current_bucket = None
+        for i in order:
+            bucket = lengths[i] // self.bucket_size
+            candidate = current + [i]
+
+            full = self.max_batch_size is not None and len(current) >= self.max_batch_size
+            over_budget = self.batch_cost([lengths[j] for j in candidate],
+                                          [budgets[j] for j in candidate] if budgets else None) > self.token_budget
+
+            if current and (bucket != current_bucket or full or over_budget):
+                batches.append(current)
+                candidate = [i]
+            current = candidate
+            current_bucket = bucket
+
+        if current:
+            batches.append(current)
+        return batches
+
+    def padding_ratio(self, lengths, batches):
+        """Fraction of prompt tokens in the scheduled batches that are padding."""
+        padded = sum(len(batch) * max(lengths[i] for i in batch) for batch in batches)
+        real = sum(lengths)
+        return 1 - real / padded if padded else 0.0
@@ -14,13 +14,20 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import re
 import json
+import argparse
 import torch 
 
 from prompts.qwen_prompts import system_prompts
 from prompts.llama_prompts import system_prompts as llama_sysprompt
-from misc.utils import defined_relations,format_defined_relations
+from misc.utils import defined_relations,format_defined_relations,legal_label_pairs
 import llms_class
+from checkpoint import Checkpoint
+from parallel_runner import select_shard
+from call_metrics import Metrics_Log
+from budget_estimator import Budget_Estimator,log_block
 from constituency_parsing import spacy_setup, analyze_sentence_with_entities_no_parsing
+
+PREDICTED_KEYS=('ternary_tag_based_relations_predicted','ternary_mention_based_relations_predicted','llm_output')
 #==================================================================================================
 def load_data(doc_path):
     with open(doc_path, 'r') as file:
@@ -74,7 +81,31 @@ def messages_format_llama(system_prompt,defined_relations,tagged_text):
 
     return messages
 #==================================================================================================
+def parse_args():
+    parser = argparse.ArgumentParser(description="BENTMistralSemantic system")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the LLM response cache")
+    parser.add_argument("--refresh", action="store_true", help="Regenerate every answer and overwrite the cached responses")
+    parser.add_argument("--model", default="mistralai/Mistral-7B-Instruct-v0.3", help="Hugging Face model name or local checkpoint")
+    parser.add_argument("--device", default="auto", help="auto, cuda, cuda:N or cpu")
+    parser.add_argument("--num-threads", type=int, default=None, help="torch threads of this process")
+    parser.add_argument("--engine", default="static", choices=["static", "continuous"], help="static batches or continuous batching (see continuous_batching.py)")
+    parser.add_argument("--compile", action="store_true", help="static KV cache and torch.compile'd decoding (static engine)")
+    parser.add_argument("--kv-cache-bits", type=int, choices=[0, 4, 8], default=None, help="int8/int4 KV cache, larger batches in the same memory (0: full precision)")
+    parser.add_argument("--adaptive-max-new-tokens", action="store_true", help="per-document max_new_tokens calibrated on the .LOGS of data/intermediate (longer answers are cut)")
+    parser.add_argument("--token-budget", type=int, default=None, help="group the prompts by length into batches of at most N prompt + max_new_tokens tokens (default: batches of batch_size in input order)")
+    parser.add_argument("--prefix-cache", action="store_true", help="prefill the block shared by every prompt once and reuse its KV cache in every batch")
+    parser.add_argument("--stop-on-json", action="store_true", help="stop a row as soon as its JSON answer is closed (see stopping_criteria.py)")
+    parser.add_argument("--max-repeats", type=int, default=None, help="stop a row once the same relation/entity object has been generated N times")
+    parser.add_argument("--constrained", action="store_true", help="mask the logits so the answer follows the JSON schema with the legal labels (see constrained_decoding.py)")
+    parser.add_argument("--adapter", default=None, help="LoRA adapter of the RE task (PEFT directory or hub id) on top of --model")
+    parser.add_argument("--no-worker", action="store_true", help="load the model in this process even when src/model_worker.py serves it")
+    parser.add_argument("--api-base", default=None, help="OpenAI-compatible server (e.g. http://localhost:8000/v1) serving --model, instead of loading it")
+    parser.add_argument("--prompt-lookup", type=int, default=None, help="draft N tokens by copying spans of the prompt (one sequence at a time)")
+    parser.add_argument("--shard", default=None, help="k/N: only run the k-th of N blocks of PMIDs (see parallel_runner.py)")
+    return parser.parse_args()
+#==================================================================================================
 def main():
+    args=parse_args()
     doc_path = "data/GutBrainIE_tagged/Annotations/Test/lasigeBioTM_subtask6_1_NER_Mistral-7B-Instruct-v0.3_fixed_tagged.json"
     data=load_data(doc_path)
 
@@ -88,43 +119,91 @@ def main():
     configs={
         "temperature":0.2,
         "max_new_tokens":4096,
-        "quantization":True
+        "quantization":True,
+        "batch_size":8,
+        "token_budget":args.token_budget,
+        "prefix_cache":args.prefix_cache,
+        "stop_on_json":"object" if args.stop_on_json else None,
+        "max_repeats":args.max_repeats,
+        "constrained_schema":"relations" if args.constrained else None,
+        "response_cache":None if args.no_cache else "data/cache/responses",
+        "refresh_cache":args.refresh,
+        "token_cache":"data/cache/tokens",
+        "device":args.device,
+        "num_threads":args.num_threads,
+        "prompt_lookup_num_tokens":args.prompt_lookup,
+        "api_base":args.api_base,
+        "engine":args.engine,
+        "compile":args.compile,
+        "kv_cache_bits":args.kv_cache_bits,
+        "adaptive_max_new_tokens":args.adaptive_max_new_tokens,
+        "adapters":{"re":args.adapter} if args.adapter else None,
+        "adapter":"re" if args.adapter else None,
+        "worker_socket":None if args.no_worker else "data/cache/model_worker.sock"
         }
     #---------------------------------------------------------------------
     #Mistral
-    model_name = "mistralai/Mistral-7B-Instruct-v0.3"
-    llm=llms_class.Mistral_Pipeline(model_name,configs)
+    model_name = args.model
+    if args.api_base:
+        llm=llms_class.OpenAI_Pipeline(model_name,configs)
+    else:
+        llm=llms_class.load_pipeline(llms_class.Mistral_Pipeline,model_name,configs)
     system_prompt = system_prompts['spacy_prompt1']
     #---------------------------------------------------------------------
     output_path=f"data/intermediate/{model_name.split("/")[-1]}-spacy-semantics-it-outputs.json"
     output_logs=f"data/intermediate/{model_name.split("/")[-1]}-spacy-semantics-it-outputs.LOGS"
+    estimator=None
+    if configs["adaptive_max_new_tokens"]:
+        estimator=Budget_Estimator(configs["max_new_tokens"],tokenizer=getattr(llm,"tokenizer",None),
+                                 legal_pairs=legal_label_pairs(defined_relations_dict),
+                                 calibration=output_path)
+    if args.shard:
+        data,output_path,output_logs=select_shard(data,output_path,output_logs,args.shard)
+
+    checkpoint=Checkpoint(output_path)
+    done=checkpoint.load()
+    metrics=Metrics_Log(output_path,resume=bool(done))
 
     nlp=spacy_setup()
 
-    with open(output_logs,'w') as logfile:
-        logfile.write(f"Input File {doc_path}\nLLM Config:\n{configs}\n\n")
-        for annot in data:
-            jbase= data[annot]
+    records=[]
+    for annot in data:
+        if annot in done:
+            continue
+        jbase= data[annot]
 
 
-            title = jbase['title_tagged']
-            abstract = jbase['abstract_tagged']
+        title = jbase['title_tagged']
+        abstract = jbase['abstract_tagged']
 
-            tagged_text = title + " " + abstract
-            try:
-                spacy_out=analyze_sentence_with_entities_no_parsing(nlp,tagged_text,defined_relations_dict)
+        tagged_text = title + " " + abstract
+        try:
+            spacy_out=analyze_sentence_with_entities_no_parsing(nlp,tagged_text,defined_relations_dict)
           
-            except Exception as e:
-                print(f"An error occurred: {e}")
-                spacy_out=[]
-
-            messages=messages_format(system_prompt,formated_rel_dict,spacy_out,tagged_text)
-            
-            try:
-                output= llm.inference(messages)
+        except Exception as e:
+            print(f"An error occurred: {e}")
+            spacy_out=[]
+
+        records.append((annot,messages_format(system_prompt,formated_rel_dict,spacy_out,tagged_text)))
+
+    budgets=None
+    if estimator is not None and records:
+        estimator.calibrate(dict(records),data)
+        budgets=[estimator.predict(data[annot]) for annot,_ in records]
+        print(estimator.report(budgets))
+
+    with open(output_logs,'a' if done else 'w') as logfile, llm:
+        logfile.write(f"Input File {doc_path}\nLLM Config:\n{configs}\n\n")
+        if done:
+            logfile.write(f"Resumed from {checkpoint.path}: {len(done)} documents already done\n\n")
+        for indices,outputs in llm.inference_scheduled([messages for _,messages in records],budgets=budgets):
+
+            for i,output,call in zip(indices,outputs,llm.last_metrics):
+                annot=records[i][0]
+                jbase= data[annot]
                 content = output.split("[/INST]")[-1].strip("]</s>").strip()
 
-                logfile.write(f"{annot}\n{output}\n\n")
+                logfile.write(log_block(annot,records[i][1],output))
 
                 try:
                     answer= json.loads(output.split("[/INST]")[-1].strip("</s>").strip())
@@ -140,16 +219,18 @@ def main():
                     answer=output.split("[/INST]")[-1].strip("</s>").strip()
                     jbase['ternary_tag_based_relations_predicted']=answer
                     jbase['ternary_mention_based_relations_predicted']=answer
-                
 
-            except torch.OutOfMemoryError:
-                jbase['ternary_tag_based_relations_predicted']="OutOfMemoryError"
-                jbase['ternary_mention_based_relations_predicted']="OutOfMemoryError"
+                checkpoint.write(annot,{key:jbase[key] for key in PREDICTED_KEYS if key in jbase})
+                metrics.write(annot,call)
 
-            torch.cuda.empty_cache()
+    checkpoint.close()
+    metrics.close()
+    for annot,record in done.items():
+        data[annot].update(record)
 
     with open(output_path, "w") as f: 
         json.dump(data, f, indent=2)
+    checkpoint.remove()
 
 #==================================================================================================
 
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/05 14:21:47
+@author: SIRConceicao
+
+JSON-aware stopping criteria for model.generate.
+
+Json_Stop scans the generated text of every row of a batch incrementally and stops
+the row when:
+    - json_closed: its top-level JSON value is balanced and closed (mode "object", RE
+      answers) or when what follows a closed value is not another value of a comma
+      separated sequence (mode "sequence", NER answers "{...}, {...}")
+    - repetition: the same leaf object (a relation or an entity) has been generated
+      max_repeats times
+Each row also remembers how many generated tokens to keep, so the decoded answer
+ends at the last complete value instead of the trailing text or the repeated objects.
+
+Budget_Stop stops every row after its own number of new tokens (per-document
+max_new_tokens of budget_estimator.py, generate only takes one for the batch).
+'''
+import re
+import torch
+from collections import defaultdict
+from transformers import StoppingCriteria
+
+_TOKEN_STRINGS = {}
+#==================================================================================================
+def token_strings(tokenizer):
+    """Text that every token id adds when it follows other text, computed once per tokenizer."""
+    key = (tokenizer.name_or_path, len(tokenizer))
+    if key not in _TOKEN_STRINGS:
+        #decode after an anchor token so SentencePiece keeps the leading space of "▁word"
+        anchor = tokenizer.encode("a", add_special_tokens=False)[-1]
+        prefix = tokenizer.decode([anchor], clean_up_tokenization_spaces=False)
+        texts = tokenizer.batch_decode([[anchor, i] for i in range(len(tokenizer))],
+                                       clean_up_tokenization_spaces=False)
+        special = set(tokenizer.all_special_ids)
+        _TOKEN_STRINGS[key] = ["" if i in special else text[len(prefix):] for i, text in enumerate(texts)]
+    return _TOKEN_STRINGS[key]
+#==================================================================================================
+class Json_Row:
+    """Scanner state of one generated sequence."""
+    def __init__(self):
+        self.text = []
+        self.tokens = 0
+        self.in_string = False
+        self.escape = False
+        self.stack = []            # [start position, has nested container, is object]
+        self.after_close = False
+        self.close_tokens = 0
+        self.last_object_tokens = 0
+        self.counts = defaultdict(int)
+        self.reason = None
+        self.keep = None
+
+    def stop(self, reason, keep):
+        self.reason = reason
+        self.keep = keep
+        return True
+
+    def feed(self, text, mode, max_repeats):
+        """Consume the text of one token, returns True when the row must stop."""
+        self.tokens += 1
+        for ch in text:
+            pos = len(self.text)
+            self.text.append(ch)
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                continue
+
+            if self.after_close and not ch.isspace():
+                if mode == "sequence" and ch in ",{":
+                    self.after_close = False
+                else:
+                    return self.stop("json_closed", self.close_tokens)
+
+            if ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                if self.stack:
+                    self.stack[-1][1] = True
+                self.stack.append([pos, False, ch == "{"])
+            elif ch in "}]" and self.stack:
+                start, has_child, is_object = self.stack.pop()
+
+                if max_repeats and is_object and not has_child:
+                    key = re.sub(r"\s+", "", "".join(self.text[start:pos + 1]))
+                    self.counts[key] += 1
+                    if self.counts[key] >= max_repeats:
+                        return self.stop("repetition", self.last_object_tokens)
+                    self.last_object_tokens = self.tokens
+
+                if not self.stack and mode:
+                    self.close_tokens = self.tokens
+                    if mode == "object":
+                        return self.stop("json_closed", self.tokens)
+                    self.after_close = True
+        return False
+#==================================================================================================
+class Json_Stop(StoppingCriteria):
+    def __init__(self, strings, prompt_len, batch_size, mode="object", max_repeats=None):
+        self.strings = strings
+        self.seen = prompt_len
+        self.mode = mode
+        self.max_repeats = max_repeats
+        self.rows = [Json_Row() for _ in range(batch_size)]
+
+    def __call__(self, input_ids, scores, **kwargs):
+        #several tokens can be appended per step with assisted decoding
+        new_tokens = input_ids[:, self.seen:].tolist()
+        self.seen = input_ids.shape[1]
+
+        done = []
+        for row, tokens in zip(self.rows, new_tokens):
+            if row.reason is None:
+                for token in tokens:
+                    if row.feed(self.strings[token], self.mode, self.max_repeats):
+                        break
+            done.append(row.reason is not None)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+#==================================================================================================
+class Budget_Stop(StoppingCriteria):
+    def __init__(self, prompt_len, budgets):
+        self.prompt_len = prompt_len
+        self.budgets = torch.tensor(budgets)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return input_ids.shape[1] - self.prompt_len >= self.budgets.to(input_ids.device)
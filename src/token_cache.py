@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/11 10:17:53
+@author: SIRConceicao
+
+Pre-tokenized prompt cache shared by all systems.
+
+The input ids of every prompt are stored per tokenizer in two NumPy files that are
+memory-mapped on load:
+    index.npy   [(key, start, end)]  key = sha256 of the pipeline and the messages
+    tokens.npy  int32, the input ids of all the prompts one after the other
+A hit skips both apply_chat_template and the tokenizer. New prompts are kept in memory
+and written by save(), which merges them with what other processes saved meanwhile.
+'''
+import os
+import json
+import fcntl
+import hashlib
+import numpy as np
+from contextlib import contextmanager
+
+INDEX_DTYPE = np.dtype([("key", "S64"), ("start", "<i8"), ("end", "<i8")])
+#==================================================================================================
+def tokenizer_namespace(tokenizer):
+    """Directory name of a tokenizer: same vocabulary and chat template, same input ids."""
+    identity = [tokenizer.name_or_path, type(tokenizer).__name__, len(tokenizer), tokenizer.chat_template]
+    return hashlib.sha256(json.dumps(identity, default=str).encode("utf-8")).hexdigest()[:16]
+#==================================================================================================
+class Token_Cache:
+    def __init__(self, cache_dir, namespace):
+        self.dir = os.path.join(cache_dir, namespace)
+        os.makedirs(self.dir, exist_ok=True)
+        self.index_path = os.path.join(self.dir, "index.npy")
+        self.tokens_path = os.path.join(self.dir, "tokens.npy")
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    @contextmanager
+    def lock(self, mode):
+        with open(os.path.join(self.dir, ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_store(self):
+        if not os.path.exists(self.index_path):
+            return np.zeros(0, dtype=INDEX_DTYPE), np.zeros(0, dtype=np.int32)
+        return np.load(self.index_path, mmap_mode="r"), np.load(self.tokens_path, mmap_mode="r")
+
+    def load(self):
+        with self.lock(fcntl.LOCK_SH):
+            self.index, self.tokens = self.read_store()
+        self.lookup = {key.decode("ascii"): i for i, key in enumerate(self.index["key"])}
+
+    @staticmethod
+    def key(encoder, messages):
+        payload = json.dumps([encoder, messages], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        if key in self.pending:
+            return self.pending[key]
+        i = self.lookup.get(key)
+        if i is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.tokens[self.index["start"][i]:self.index["end"][i]].tolist()
+
+    def put(self, key, input_ids):
+        self.pending[key] = list(input_ids)
+
+    def save(self):
+        if not self.pending:
+            return
+        with self.lock(fcntl.LOCK_EX):
+            index, tokens = self.read_store()
+            known = {key.decode("ascii") for key in index["key"]}
+            new = [(key, ids) for key, ids in self.pending.items() if key not in known]
+
+            new_index = np.zeros(len(new), dtype=INDEX_DTYPE)
+            start = len(tokens)
+            for i, (key, ids) in enumerate(new):
+                new_index[i] = (key.encode("ascii"), start, start + len(ids))
+                start += len(ids)
+            new_tokens = np.fromiter((t for _, ids in new for t in ids), dtype=np.int32)
+
+            #tokens first: the old index stays valid on the new tokens file
+            for path, array in ((self.tokens_path, np.concatenate([tokens, new_tokens])),
+                                (self.index_path, np.concatenate([index, new_index]))):
+                tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+                np.save(tmp_path, array)
+                os.replace(tmp_path, path)
+        self.pending = {}
+        self.load()
+
+    def report(self):
+        return f"Token cache: {self.hits} hits, {self.misses} misses, {len(self.lookup)} prompts ({len(self.tokens)} tokens)"
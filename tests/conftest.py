@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/27 14:22:10
+@author: SIRConceicao
+
+A tiny Llama checkpoint with random weights and a byte-level BPE tokenizer trained on a few
+JSON answers, built offline once per test session for the tests that run a pipeline. The
+answers are meaningless, only the code paths around generate are checked.
+'''
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import json
+import pytest
+
+CHAT_TEMPLATE=("{{ bos_token }}{% for m in messages %}{% if m['role']=='user' %}[INST] {{ m['content'] }} [/INST]"
+               "{% else %}{{ m['content'] }}{{ eos_token }}{% endif %}{% endfor %}")
+#==================================================================================================
+def training_texts():
+    from constrained_decoding import LEGAL_ENTITY_LABELS,LEGAL_RELATION_LABELS
+    entity={"start_idx":0,"end_idx":12,"location":"title","text_span":"Gut microbes","label":"microbiome"}
+    texts=[json.dumps(dict(entity,label=label)) for label in LEGAL_ENTITY_LABELS]
+    texts+=[json.dumps({"subject_label":"bacteria","predicate":predicate,"object_label":"microbiome"})
+            for predicate in LEGAL_RELATION_LABELS]
+    return texts+["Extract the entities of the abstract. The gut microbiota of patients with depression."]
+
+@pytest.fixture(scope="session")
+def tiny_model(tmp_path_factory):
+    """Path of the tiny checkpoint, the tests that use it are skipped without torch."""
+    torch=pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    tokenizers=pytest.importorskip("tokenizers")
+    from transformers import PreTrainedTokenizerFast,LlamaConfig,LlamaForCausalLM
+
+    path=str(tmp_path_factory.mktemp("tiny-llama"))
+    tokenizer=tokenizers.Tokenizer(tokenizers.models.BPE())
+    tokenizer.pre_tokenizer=tokenizers.pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder=tokenizers.decoders.ByteLevel()
+    trainer=tokenizers.trainers.BpeTrainer(vocab_size=400,special_tokens=["<s>","</s>"],
+                                           initial_alphabet=tokenizers.pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(training_texts(),trainer)
+    tokenizer=PreTrainedTokenizerFast(tokenizer_object=tokenizer,bos_token="<s>",eos_token="</s>")
+    tokenizer.chat_template=CHAT_TEMPLATE
+    tokenizer.save_pretrained(path)
+
+    torch.manual_seed(0)
+    config=LlamaConfig(vocab_size=len(tokenizer),hidden_size=32,intermediate_size=64,num_hidden_layers=2,
+                       num_attention_heads=4,num_key_value_heads=2,max_position_embeddings=512,
+                       bos_token_id=tokenizer.bos_token_id,eos_token_id=tokenizer.eos_token_id)
+    LlamaForCausalLM(config).save_pretrained(path)
+    return path
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/27 15:31:50
+@author: SIRConceicao
+
+Two LoRA adapters with random weights on the tiny random model of conftest.py, one task
+pipeline each (llms_class.Base_Pipeline.for_task) on the same loaded model. Skipped without
+torch or peft.
+
+    python -m pytest tests
+'''
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import pytest
+torch=pytest.importorskip("torch")
+peft=pytest.importorskip("peft")
+#==================================================================================================
+def random_adapters(model_path, directory):
+    """{name: path} of the ner and re adapters, saved in directory."""
+    from transformers import AutoModelForCausalLM
+    paths={}
+    for k,name in enumerate(("ner","re")):
+        torch.manual_seed(k)
+        lora=peft.get_peft_model(AutoModelForCausalLM.from_pretrained(model_path),
+                                 peft.LoraConfig(r=8,lora_alpha=16,target_modules=["q_proj","v_proj"],init_lora_weights=False))
+        paths[name]=str(directory/name)
+        lora.save_pretrained(paths[name])
+    return paths
+
+def generate(task, prompt):
+    torch.manual_seed(0)
+    return task.generate_ids([prompt])[0]
+#==================================================================================================
+def test_adapters_per_task(tiny_model, tmp_path):
+    import llms_class
+    configs={"device":"cpu","temperature":1.0,"max_new_tokens":12}
+    plain=llms_class.Mistral_Pipeline(tiny_model,dict(configs))
+    prompt=plain.encode([{"role":"user","content":"The gut microbiota of patients with depression."}])
+    base=generate(plain,prompt)
+
+    configs["adapters"]=random_adapters(tiny_model,tmp_path)
+    llm=llms_class.Mistral_Pipeline(tiny_model,dict(configs))
+    tasks={name:llm.for_task(dict(configs,adapter=name)) for name in ("ner","re")}
+    assert all(task.model is llm.model for task in tasks.values())
+
+    outputs={name:generate(task,prompt) for name,task in tasks.items()}
+    assert outputs["ner"]!=outputs["re"] and base not in outputs.values()
+    #no adapter set: the base weights, also after the switches
+    assert generate(llm,prompt)==base
+    assert generate(tasks["ner"],prompt)==outputs["ner"]
+    assert llm.adapter_state["loaded"]==["ner","re"] and llm.adapter_state["switches"]==4
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/27 11:05:44
+@author: SIRConceicao
+
+Calibration of budget_estimator.py on the .LOGS a driver writes, and Budget_Stop
+(stopping_criteria.py).
+
+    python -m pytest tests
+'''
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import pytest
+import torch
+import budget_estimator
+from budget_estimator import Budget_Estimator,log_block,log_answers,prompt_hash
+from stopping_criteria import Budget_Stop
+#==================================================================================================
+def run_inputs(n=25):
+    """({pmid: messages}, {pmid: doc}, {pmid: answer}) of a run, the answers grow with the abstract."""
+    docs={str(1000+k):{"title":"Gut microbes","abstract":"word "*(40*(k+1))} for k in range(n)}
+    prompts={pmid:[{"role":"user","content":f"Extract the entities of:\n{doc['abstract']}"}] for pmid,doc in docs.items()}
+    answers={pmid:'{"text_span": "word", "label": "microbiome"}, '*(k+1) for k,pmid in enumerate(docs)}
+    return prompts,docs,answers
+
+def write_logs(path, blocks):
+    with open(path,"w") as logfile:
+        logfile.write("Input File test.json\nLLM Config:\n{'max_new_tokens': 4096}\n\n")
+        for block in blocks:
+            logfile.write(block)
+
+def estimator(tmp_path, monkeypatch):
+    monkeypatch.setattr(budget_estimator,"OUTPUTS_DIR",str(tmp_path))
+    return Budget_Estimator(4096,calibration=str(tmp_path/"run.json"))
+#==================================================================================================
+def test_log_block_round_trip(tmp_path):
+    prompts,_,answers=run_inputs(2)
+    write_logs(tmp_path/"run.LOGS",[log_block(pmid,prompts[pmid],answers[pmid]) for pmid in prompts])
+    assert log_answers(str(tmp_path/"run.LOGS"))=={pmid:(prompt_hash(prompts[pmid]),answers[pmid].strip()) for pmid in prompts}
+
+def test_calibrate_from_written_logs(tmp_path, monkeypatch):
+    prompts,docs,answers=run_inputs()
+    write_logs(tmp_path/"run.LOGS",[log_block(pmid,prompts[pmid],answers[pmid]) for pmid in prompts])
+    budgets=estimator(tmp_path,monkeypatch)
+    budgets.calibrate(prompts,docs)
+    assert budgets.coef is not None and budgets.docs==25 and budgets.sources==["run.LOGS"]
+    first,last=budgets.predict(docs["1000"]),budgets.predict(docs["1024"])
+    assert budgets.min_new_tokens<=first<last<4096
+
+def test_calibrate_from_decoded_prompts(tmp_path, monkeypatch):
+    #.LOGS written before the hashes, with the decoded prompt in front of the answer
+    prompts,docs,answers=run_inputs()
+    write_logs(tmp_path/"run.LOGS",[f"{pmid}\n<s>[INST] {prompts[pmid][0]['content']} [/INST]{answers[pmid]}</s>\n\n" for pmid in prompts])
+    budgets=estimator(tmp_path,monkeypatch)
+    budgets.calibrate(prompts,docs)
+    assert budgets.coef is not None and budgets.docs==25
+
+def test_calibrate_warns_without_matching_prompts(tmp_path, monkeypatch):
+    prompts,docs,answers=run_inputs()
+    write_logs(tmp_path/"run.LOGS",[log_block(pmid,prompts[pmid],answers[pmid]) for pmid in prompts])
+    changed={pmid:[{"role":"user","content":"Another prompt "+messages[0]["content"]}] for pmid,messages in prompts.items()}
+    budgets=estimator(tmp_path,monkeypatch)
+    with pytest.warns(UserWarning,match="0 answers"):
+        budgets.calibrate(changed,docs)
+    assert budgets.coef is None and budgets.predict(docs["1000"])==4096
+
+def test_budget_stop():
+    stop=Budget_Stop(prompt_len=3,budgets=[2,4])
+    assert stop(torch.zeros(2,5,dtype=torch.long),None).tolist()==[True,False]
+    assert stop(torch.zeros(2,7,dtype=torch.long),None).tolist()==[True,True]
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/26 10:12:05
+@author: SIRConceicao
+
+Checkpoint (checkpoint.py): round trip, and resuming after a crash that tore the last line.
+
+    python -m pytest tests
+'''
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import json
+from checkpoint import Checkpoint
+
+ENTITY={"start_idx":0,"end_idx":12,"location":"title","text_span":"Gut microbes","label":"microbiome"}
+#==================================================================================================
+def test_checkpoint_round_trip(tmp_path):
+    checkpoint=Checkpoint(str(tmp_path/"out.json"))
+    assert checkpoint.path==str(tmp_path/"out.ckpt.jsonl")
+    assert checkpoint.load()=={}
+    checkpoint.write("1",{"entities":[]})
+    checkpoint.write("2",{"entities":[ENTITY]})
+    checkpoint.close()
+    assert Checkpoint(str(tmp_path/"out.json")).load()=={"1":{"entities":[]},"2":{"entities":[ENTITY]}}
+    checkpoint.remove()
+    assert not os.path.exists(checkpoint.path)
+
+def test_checkpoint_torn_line(tmp_path):
+    checkpoint=Checkpoint(str(tmp_path/"out.json"))
+    with open(checkpoint.path,"w") as file:
+        file.write(json.dumps({"pmid":"1","record":{}})+"\n"+'{"pmid": "2", "rec')
+    assert checkpoint.load()=={"1":{}}
+    checkpoint.write("3",{"a":1})
+    checkpoint.close()
+    assert Checkpoint(str(tmp_path/"out.json")).load()=={"1":{},"3":{"a":1}}
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/26 10:12:05
+@author: SIRConceicao
+
+Grammar automaton and Compiled_Schema trie (constrained_decoding.py), with a stub
+tokenizer instead of a model, and Schema_Processor in generate_ids on the tiny random
+model of conftest.py.
+
+    python -m pytest tests
+'''
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import json
+import torch
+from constrained_decoding import SCHEMAS,Compiled_Schema,token_trie,LEGAL_ENTITY_LABELS
+
+RELATION={"subject_label":"bacteria","predicate":"part of","object_label":"microbiome"}
+MENTION={"subject_text_span":"Lactobacillus","subject_outter_label":"<e1>","subject_label":"bacteria",
+         "predicate":"part of","object_text_span":"gut \"microbiota\"","object_outter_label":"<e2>","object_label":"microbiome"}
+ENTITY={"start_idx":0,"end_idx":12,"location":"title","text_span":"Gut microbes","label":"microbiome"}
+#==================================================================================================
+class Stub_Tokenizer:
+    """One token per string of the vocabulary, id 0 is the special </s>. The vocabulary needs
+    "a", the anchor of stopping_criteria.token_strings."""
+    name_or_path="stub"
+    all_special_ids=[0]
+
+    def __init__(self, vocab):
+        self.vocab=["</s>"]+vocab
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def encode(self, text, add_special_tokens=False):
+        return [self.vocab.index(text)]
+
+    def decode(self, ids, clean_up_tokenization_spaces=False):
+        return "".join(self.vocab[i] for i in ids)
+
+    def batch_decode(self, batch, clean_up_tokenization_spaces=False):
+        return [self.decode(ids) for ids in batch]
+
+def run(grammar, text):
+    """Automaton state after text, None when it is rejected."""
+    state=(0,0)
+    for ch in text:
+        state=grammar.advance(state,ch)
+        if state is None:
+            return None
+    return state
+
+def relations_answer(relations, mentions):
+    return json.dumps({"ternary_tag_based_relations":relations,"ternary_mention_based_relations":mentions},indent=4)
+
+#==================================================================================================
+# Grammar
+#==================================================================================================
+def test_relations_grammar_accepts_answer():
+    grammar=SCHEMAS["relations"]()
+    for answer in (relations_answer([RELATION],[MENTION]),relations_answer([],[]),
+                   relations_answer([RELATION,RELATION],[MENTION])):
+        state=run(grammar,answer)
+        assert state is not None and grammar.finished(state)
+
+def test_relations_grammar_rejects_illegal_labels():
+    grammar=SCHEMAS["relations"]()
+    assert run(grammar,relations_answer([dict(RELATION,predicate="causes")],[])) is None
+    assert run(grammar,relations_answer([dict(RELATION,subject_label="Bacteria")],[])) is None
+
+def test_relations_grammar_rejects_missing_and_reordered_keys():
+    grammar=SCHEMAS["relations"]()
+    assert run(grammar,relations_answer([],[{key:value for key,value in MENTION.items() if key!="subject_outter_label"}])) is None
+    assert run(grammar,relations_answer([dict(reversed(list(RELATION.items())))],[])) is None
+    mention={key:value for key,value in MENTION.items() if "outter" not in key}
+    grammar=SCHEMAS["relations_llama"]()
+    state=run(grammar,relations_answer([],[mention]))
+    assert state is not None and grammar.finished(state)
+
+def test_relations_grammar_not_finished_before_the_end():
+    grammar=SCHEMAS["relations"]()
+    answer=relations_answer([RELATION],[MENTION])
+    for cut in (1,len(answer)//2,len(answer)-1):
+        state=run(grammar,answer[:cut])
+        assert state is not None and not grammar.finished(state)
+
+def test_grammar_strings_and_integers():
+    grammar=SCHEMAS["entities"]()
+    assert run(grammar,json.dumps(dict(ENTITY,text_span='a \\"quoted\\" span'))) is not None
+    assert run(grammar,'{"start_idx": "0"') is None
+    assert run(grammar,'{"start_idx": 1234567') is None
+    assert run(grammar,'{"start_idx": 12,') is not None
+
+def test_grammar_whitespace_limit():
+    grammar=SCHEMAS["relations"]()
+    assert run(grammar,"{"+" "*16) is not None
+    assert run(grammar,"{"+" "*17) is None
+
+def test_entities_grammar_sequence():
+    grammar=SCHEMAS["entities"]()
+    one=json.dumps(ENTITY)
+    for answer in (one,one+", "+one,one+",\n"+one):
+        state=run(grammar,answer)
+        assert state is not None and grammar.finished(state)
+    state=run(grammar,one+", ")
+    assert state is not None and not grammar.finished(state)
+    assert run(grammar,"["+one) is None
+
+def test_joint_grammar():
+    grammar=SCHEMAS["joint"]()
+    mention={key:value for key,value in MENTION.items() if "outter" not in key}
+    answer=json.dumps({"entities":[{"text_span":"gut","label":"anatomical location"}],
+                       "ternary_mention_based_relations":[mention]})
+    state=run(grammar,answer)
+    assert state is not None and grammar.finished(state)
+    assert run(grammar,answer.replace("anatomical location","organ")) is None
+def test_every_legal_label_accepted():
+    grammar=SCHEMAS["entities"]()
+    for label in LEGAL_ENTITY_LABELS:
+        assert run(grammar,json.dumps(dict(ENTITY,label=label))) is not None
+#==================================================================================================
+# Compiled_Schema
+#==================================================================================================
+def compiled_entities():
+    vocab=["{",'"',"start","_idx",'":',"0","12"," ",", ","\n","x","title",'{"',"a"]
+    tokenizer=Stub_Tokenizer(vocab)
+    return tokenizer,Compiled_Schema(SCHEMAS["entities"](),token_trie(tokenizer),len(tokenizer),[0])
+
+def test_token_trie_has_every_token():
+    tokenizer,compiled=compiled_entities()
+    for token_id,text in enumerate(tokenizer.vocab[1:],start=1):
+        node=compiled.trie
+        for ch in text:
+            node=node[ch]
+        assert token_id in node[None]
+
+def test_compiled_schema_allowed_ids():
+    tokenizer,compiled=compiled_entities()
+    allowed={tokenizer.vocab[i] for i in compiled.allowed_ids((0,0))}
+    assert allowed=={"{",'{"'," ","\n"}
+    state=compiled.feed((0,0),'{"start_idx":')
+    allowed={tokenizer.vocab[i] for i in compiled.allowed_ids(state)}
+    assert {"0","12"," "}<=allowed and "x" not in allowed and "</s>" not in allowed
+
+def test_compiled_schema_eos_only_when_finished():
+    tokenizer,compiled=compiled_entities()
+    state=compiled.feed((0,0),json.dumps(ENTITY))
+    assert 0 in compiled.allowed_ids(state)
+    assert 0 not in compiled.allowed_ids(compiled.feed((0,0),json.dumps(ENTITY)[:-1]))
+    assert tokenizer.vocab.index(", ") in compiled.allowed_ids(state)
+    assert compiled.feed((0,0),"x") is None
+
+def test_compiled_schema_mask():
+    tokenizer,compiled=compiled_entities()
+    mask=compiled.mask((0,0),"cpu")
+    assert mask.dtype==torch.bool and mask.shape==(len(tokenizer),)
+    assert sorted(mask.nonzero().flatten().tolist())==sorted(compiled.allowed_ids((0,0)))
+    assert compiled.mask((0,0),"cpu") is mask
+#==================================================================================================
+# Schema_Processor in generation
+#==================================================================================================
+def test_schema_processor_through_generate_ids(tiny_model):
+    import llms_class
+    configs={"device":"cpu","temperature":1.0,"max_new_tokens":40,"constrained_schema":"entities"}
+    llm=llms_class.Mistral_Pipeline(tiny_model,configs)
+    prompt=llm.encode([{"role":"user","content":"Extract the entities of the abstract."}])
+    grammar=SCHEMAS["entities"]()
+    torch.manual_seed(0)
+    for output in llm.generate_ids([prompt,prompt]):
+        assert output and run(grammar,output) is not None
+    #the random weights alone do not follow the schema
+    configs["constrained_schema"]=None
+    torch.manual_seed(0)
+    assert any(run(grammar,output) is None for output in llm.generate_ids([prompt,prompt]))
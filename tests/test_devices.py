@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/27 15:02:37
+@author: SIRConceicao
+
+Device and dtype resolution (devices.py) and a CPU run of generate_ids on the tiny random
+model of conftest.py. Skipped without torch.
+
+    python -m pytest tests
+'''
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import pytest
+torch=pytest.importorskip("torch")
+from devices import resolve_device,resolve_dtype
+#==================================================================================================
+def test_cpu_dtype():
+    assert resolve_device("cpu")=="cpu"
+    #half precision matmuls are slow or unsupported on CPU
+    assert resolve_dtype("auto","cpu") is torch.float32
+    assert resolve_dtype(None,"cpu") is torch.float32
+    assert resolve_dtype("bfloat16","cpu") is torch.bfloat16
+    assert resolve_dtype("auto","cuda")=="auto"
+
+def test_generate_ids_on_cpu(tiny_model):
+    import llms_class
+    configs={"device":"cpu","temperature":0.2,"max_new_tokens":8,"quantization":True}
+    llm=llms_class.Mistral_Pipeline(tiny_model,configs)
+    assert llm.device=="cpu" and llm.model.device.type=="cpu" and llm.model.dtype==torch.float32
+    #no bitsandbytes on CPU, the configs must not claim a quantized model
+    assert configs["quantization"] is False
+    prompts=[llm.encode([{"role":"user","content":text}]) for text in ("Gut microbes.","The gut microbiota of patients with depression.")]
+    outputs=llm.generate_ids(prompts)
+    assert len(outputs)==2 and all(isinstance(output,str) for output in outputs)
+    assert [record["prompt_tokens"] for record in llm.last_metrics]==[len(ids) for ids in prompts]
+    assert all(1<=record["generated_tokens"]<=8 for record in llm.last_metrics)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/27 09:40:12
+@author: SIRConceicao
+
+Probabilities of the scored answers of relation_scoring.py and NER/entity_typing.py, from
+the summed log-probabilities of continuations of unequal length.
+
+    python -m pytest tests
+'''
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import math
+from relation_scoring import softmax as relation_softmax
+from NER.entity_typing import softmax as typing_softmax
+#==================================================================================================
+def test_relation_softmax_per_token():
+    #"is linked to" has 4 tokens and a better log-probability per token than the 1 token "none"
+    probabilities=relation_softmax([-4.0,-2.0],[4,1])
+    assert math.isclose(sum(probabilities),1.0)
+    assert probabilities[0]>probabilities[1]
+    assert math.isclose(probabilities[0],1/(1+math.exp(-1.0)))
+
+def test_relation_softmax_equal_means():
+    probabilities=relation_softmax([-6.0,-3.0,-1.5],[4,2,1])
+    assert all(math.isclose(p,1/3) for p in probabilities)
+
+def test_typing_softmax_per_token():
+    #"anatomical location" (3 tokens) beats "none" (1 token) per token, not by the sum
+    probabilities=typing_softmax([-1.5,-0.9,-1.2],[3,1,1])
+    assert math.isclose(sum(probabilities),1.0)
+    assert max(range(3),key=probabilities.__getitem__)==0
+    assert typing_softmax([-2.0,-1.0],[2,1])==[0.5,0.5]
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*-coding:utf-8 -*-
+'''
+Created on 2025/06/26 10:12:05
+@author: SIRConceicao
+
+Json_Row/Json_Stop (stopping_criteria.py) on token texts, no tokenizer or model.
+
+    python -m pytest tests
+'''
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import torch
+from stopping_criteria import Json_Row,Json_Stop
+#==================================================================================================
+def feed(row, tokens, mode="object", max_repeats=None):
+    """Feed token texts to a Json_Row until it stops, returns the number fed."""
+    for k,text in enumerate(tokens):
+        if row.feed(text,mode,max_repeats):
+            return k+1
+    return len(tokens)
+#==================================================================================================
+def test_json_row_object_closed():
+    row=Json_Row()
+    fed=feed(row,['{"a": ','"}"',', "b": [1, {"c": 2}]','}',' trailing'])
+    assert fed==4 and row.reason=="json_closed" and row.keep==4
+
+def test_json_row_braces_in_strings():
+    row=Json_Row()
+    assert feed(row,['{"a": "{[\\"','}"']) == 2 and row.reason is None
+
+def test_json_row_sequence():
+    row=Json_Row()
+    fed=feed(row,['{"a": 1}',', ','{"a": 2}','\n','Done'],mode="sequence")
+    assert fed==5 and row.reason=="json_closed" and row.keep==3
+
+def test_json_row_repetition():
+    row=Json_Row()
+    tokens=['{"r": [','{"x": 1}',', {"y": 2}',', {"x": 1}',', {"x": 1}',']}']
+    fed=feed(row,tokens,max_repeats=3)
+    assert fed==5 and row.reason=="repetition" and row.keep==4
+    row=Json_Row()
+    assert feed(row,tokens,max_repeats=None)==6 and row.reason=="json_closed"
+
+def test_json_stop_batch():
+    strings=["","{",'"a"',": 1","}"," x"]
+    stop=Json_Stop(strings,prompt_len=2,batch_size=2)
+    prompt=[[5,5],[5,5]]
+    assert stop(torch.tensor([row+[1,2] for row in prompt]),None).tolist()==[False,False]
+    assert stop(torch.tensor([row+[1,2,3,4] for row in prompt]),None).tolist()==[True,True]
+    #a stopped row stays stopped whatever comes next
+    assert stop(torch.tensor([row+[1,2,3,4,5] for row in prompt]),None).tolist()==[True,True]
+    assert [row.keep for row in stop.rows]==[4,4]